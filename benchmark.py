@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Micro / macro benchmarks of the framework. The benchmarks run on synthetic data (random smooth RGB images and their
+RGGB Bayer mosaics) and untrained models, so they do not need camera data or trained snapshots. Each case is timed
+after a warm-up run (graph construction & initialization are excluded) and the results are saved as JSON. Results can
+be compared against a stored baseline - cases slower than the threshold are reported as regressions.
+
+Available benchmark groups: dataset, jpeg, codec, djpg, nip, fan, dcn
+
+Sample usage:
+
+    ./benchmark.py --out ./data/benchmarks/baseline.json
+    ./benchmark.py --baseline ./data/benchmarks/baseline.json --out ./data/benchmarks/current.json
+    ./benchmark.py --only jpeg,nip --patch 64 --patch 128 --batch 1 --batch 10
+
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import datetime
+import platform
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+# Disable unimportant logging and import TF
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+BENCHMARKS = ('dataset', 'jpeg', 'codec', 'djpg', 'nip', 'fan', 'dcn')
+PATCH_SIZES = (64, 128)
+BATCH_SIZES = (1, 10)
+REPEATS = 10
+
+# Relative change of the median time reported as a regression / improvement w.r.t. the baseline
+THRESHOLD = 0.2
+
+# Size of synthetic images used to populate the benchmark dataset
+DATASET_SIZE = (512, 768)
+DATASET_IMAGES = 20
+
+
+def synthetic_rgb(n, size, seed=1234):
+    """
+    Random smooth RGB images (sums of low-frequency sinusoids with a small amount of noise).
+    :param n: number of images
+    :param size: patch size (int) or (height, width)
+    :return: float32 array (n, h, w, 3) with values in [0, 1]
+    """
+    h, w = (size, size) if np.isscalar(size) else size
+    rng = np.random.RandomState(seed)
+    yy, xx = np.meshgrid(np.linspace(0, 1, h, dtype=np.float32), np.linspace(0, 1, w, dtype=np.float32), indexing='ij')
+    batch = np.zeros((n, h, w, 3), dtype=np.float32)
+
+    for i in range(n):
+        for c in range(3):
+            for _ in range(4):
+                fy, fx, phase = rng.uniform(0.5, 8), rng.uniform(0.5, 8), rng.uniform(0, 2 * np.pi)
+                batch[i, :, :, c] += np.sin(2 * np.pi * (fy * yy + fx * xx) + phase) / 8
+
+    batch += 0.5 + rng.normal(0, 0.02, batch.shape).astype(np.float32)
+
+    return np.clip(batch, 0, 1)
+
+
+def synthetic_bayer(batch_rgb):
+    """
+    Sample an RGGB Bayer mosaic from RGB images (packed into 4 half-resolution channels, like *.npy training data).
+    :param batch_rgb: float array (n, h, w, 3)
+    :return: float32 array (n, h/2, w/2, 4)
+    """
+    return np.stack([
+        batch_rgb[:, 0::2, 0::2, 0],
+        batch_rgb[:, 0::2, 1::2, 1],
+        batch_rgb[:, 1::2, 0::2, 1],
+        batch_rgb[:, 1::2, 1::2, 2]
+    ], axis=-1).astype(np.float32)
+
+
+def timeit(fn, repeats=REPEATS, warmup=1):
+    """
+    Time a function call.
+    :param fn: function without arguments
+    :param repeats: number of timed calls
+    :param warmup: number of calls before timing (e.g., to exclude lazy graph construction)
+    :return: dict with timing statistics [in ms]
+    """
+    for _ in range(warmup):
+        fn()
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(1000 * (time.perf_counter() - start))
+
+    return OrderedDict([
+        ('median', round(float(np.median(times)), 3)),
+        ('mean', round(float(np.mean(times)), 3)),
+        ('min', round(float(np.min(times)), 3)),
+        ('std', round(float(np.std(times)), 3)),
+        ('repeats', repeats)
+    ])
+
+
+def bench_dataset(patch_sizes, batch_sizes, tmp_dir):
+    """ IPDataset: sampling of training batches from full-resolution images. """
+    import imageio
+    from helpers import dataset
+
+    data_directory = os.path.join(tmp_dir, 'dataset')
+    os.makedirs(data_directory, exist_ok=True)
+
+    for i in range(DATASET_IMAGES):
+        image = synthetic_rgb(1, DATASET_SIZE, seed=i)
+        imageio.imwrite(os.path.join(data_directory, 'image_{:03d}.png'.format(i)), (255 * image[0]).astype(np.uint8))
+        np.save(os.path.join(data_directory, 'image_{:03d}.npy'.format(i)), (65535 * synthetic_bayer(image)[0]).astype(np.uint16))
+
+    data = dataset.IPDataset(data_directory, n_images=DATASET_IMAGES, v_images=0, load='xy', cache_dir=None)
+
+    for patch in patch_sizes:
+        for batch in batch_sizes:
+            if batch > DATASET_IMAGES:
+                continue
+            yield 'dataset/next_training_batch', {'patch': patch, 'batch': batch, 'discard_flat': False}, lambda: data.next_training_batch(0, batch, patch)
+            yield 'dataset/next_training_batch', {'patch': patch, 'batch': batch, 'discard_flat': True}, lambda: data.next_training_batch(0, batch, patch, discard_flat=True)
+
+
+def bench_jpeg(patch_sizes, batch_sizes, tmp_dir):
+    """ Standard JPEG codec: batch compression and bit-stream parsing. """
+    from compression import jpeg_helpers
+
+    for patch in patch_sizes:
+        for batch in batch_sizes:
+            batch_x = synthetic_rgb(batch, patch)
+            yield 'jpeg/compress_batch', {'patch': patch, 'batch': batch}, lambda: jpeg_helpers.compress_batch(batch_x, 50)
+            yield 'jpeg/compress_batch', {'patch': patch, 'batch': batch, 'effective': True}, lambda: jpeg_helpers.compress_batch(batch_x, 50, effective=True)
+
+        data = jpeg_helpers._encode((255 * synthetic_rgb(1, patch)[0]).astype(np.uint8), 50)
+        yield 'jpeg/marker_stats', {'patch': patch}, lambda: jpeg_helpers.JPEGMarkerStats(data).get_effective_bytes()
+
+
+def bench_codec(patch_sizes, batch_sizes, tmp_dir):
+    """ Learned codec: serialization of a single image (DCN inference & entropy coding). """
+    from models.compression import TwitterDCN
+    from compression import codec
+
+    for patch in patch_sizes:
+        dcn = TwitterDCN(None, None, patch_size=patch)
+        dcn.init()
+        batch_x = synthetic_rgb(1, patch)
+        stream = codec.compress(batch_x, dcn)
+        yield 'codec/compress', {'patch': patch}, lambda: codec.compress(batch_x, dcn)
+        yield 'codec/decompress', {'patch': patch}, lambda: codec.decompress(stream, dcn)
+
+
+def bench_djpg(patch_sizes, batch_sizes, tmp_dir):
+    """ Differentiable JPEG: forward pass. """
+    from models.jpeg import DJPG
+
+    for patch in patch_sizes:
+        jpg = DJPG(quality=50, rounding_approximation='sin')
+        for batch in batch_sizes:
+            batch_x = synthetic_rgb(batch, patch)
+            yield 'djpg/forward', {'patch': patch, 'batch': batch}, lambda: jpg.process(batch_x)
+
+
+def bench_nip(patch_sizes, batch_sizes, tmp_dir):
+    """ Neural imaging pipelines: forward pass and a training step. """
+    from models import pipelines
+
+    for model_name in ('INet', 'UNet', 'DNet'):
+        for patch in patch_sizes:
+            model = getattr(pipelines, model_name)(patch_size=patch // 2)
+            model.init()
+            for batch in batch_sizes:
+                batch_y = synthetic_rgb(batch, patch)
+                batch_x = synthetic_bayer(batch_y)
+                params = {'model': model_name, 'patch': patch, 'batch': batch}
+                yield 'nip/forward', params, lambda: model.process(batch_x)
+                yield 'nip/training_step', params, lambda: model.training_step(batch_x, batch_y, 1e-4)
+
+
+def bench_fan(patch_sizes, batch_sizes, tmp_dir):
+    """ Forensic analysis network: a training step. """
+    from models.forensics import FAN
+
+    for patch in patch_sizes:
+        fan = FAN(None, None, n_classes=5, x=None)
+        fan.init()
+        for batch in batch_sizes:
+            batch_x = synthetic_rgb(batch, patch)
+            batch_y = (np.arange(batch) % 5).astype(np.int32)
+            yield 'fan/training_step', {'patch': patch, 'batch': batch}, lambda: fan.training_step(batch_x, batch_y, 1e-4)
+
+
+def bench_dcn(patch_sizes, batch_sizes, tmp_dir):
+    """ Learned compression model: a training step. """
+    from models.compression import TwitterDCN
+
+    for patch in patch_sizes:
+        dcn = TwitterDCN(None, None, patch_size=patch)
+        dcn.init()
+        for batch in batch_sizes:
+            batch_x = synthetic_rgb(batch, patch)
+            yield 'dcn/training_step', {'patch': patch, 'batch': batch}, lambda: dcn.training_step(batch_x, 1e-4)
+
+
+def case_key(name, params):
+    return '{} {}'.format(name, json.dumps(params, sort_keys=True))
+
+
+def environment():
+    """ Returns a dict describing the machine and versions of key libraries. """
+    info = OrderedDict([
+        ('date', datetime.datetime.now().isoformat()),
+        ('host', platform.node()),
+        ('platform', platform.platform()),
+        ('processor', platform.processor()),
+        ('cpus', os.cpu_count()),
+        ('python', platform.python_version()),
+        ('numpy', np.__version__)
+    ])
+
+    try:
+        import tensorflow as tf
+        info['tensorflow'] = tf.__version__
+    except ImportError:
+        info['tensorflow'] = None
+
+    return info
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """
+    Compare median times with a baseline.
+    :param results: list of benchmark results (see 'run')
+    :param baseline: list of benchmark results from the baseline file
+    :param threshold: relative change reported as a regression / improvement
+    :return: list of dicts with keys: key, baseline, current, ratio, status
+    """
+    reference = {case_key(r['name'], r['params']): r for r in baseline}
+    comparison = []
+
+    for r in results:
+        key = case_key(r['name'], r['params'])
+
+        if key not in reference or 'median' not in reference[key] or 'median' not in r:
+            comparison.append({'key': key, 'baseline': None, 'current': r.get('median'), 'ratio': None, 'status': 'new' if 'median' in r else 'error'})
+            continue
+
+        ratio = r['median'] / max(reference[key]['median'], 1e-6)
+        if ratio > 1 + threshold:
+            status = 'regression'
+        elif ratio < 1 - threshold:
+            status = 'improvement'
+        else:
+            status = 'ok'
+
+        comparison.append({'key': key, 'baseline': reference[key]['median'], 'current': r['median'], 'ratio': round(ratio, 3), 'status': status})
+
+    return comparison
+
+
+def run(groups, patch_sizes, batch_sizes, repeats=REPEATS):
+    """
+    Run benchmark groups.
+    :param groups: list of benchmark group names (see BENCHMARKS)
+    :return: list of dicts with keys: name, params, timing stats [ms] and throughput [items / s]
+    """
+    results = []
+    tmp_dir = tempfile.mkdtemp(prefix='benchmark-')
+
+    try:
+        for group in groups:
+            print('\n# {}'.format(group))
+
+            try:
+                for name, params, fn in globals()['bench_{}'.format(group)](patch_sizes, batch_sizes, tmp_dir):
+                    result = OrderedDict([('name', name), ('params', params)])
+
+                    try:
+                        result.update(timeit(fn, repeats))
+                        result['throughput'] = round(1000 * params.get('batch', 1) / max(result['median'], 1e-6), 2)
+                        print('  {:28s} {:60s} {:10.2f} ms'.format(name, json.dumps(params, sort_keys=True), result['median']), flush=True)
+                    except Exception as e:
+                        result['error'] = '{}: {}'.format(type(e).__name__, e)
+                        print('  {:28s} {:60s} ERROR {}'.format(name, json.dumps(params, sort_keys=True), result['error']), flush=True)
+
+                    results.append(result)
+
+            except Exception as e:
+                print('ERROR Benchmark group {} failed: {}'.format(group, e))
+                results.append(OrderedDict([('name', group), ('params', {}), ('error', '{}: {}'.format(type(e).__name__, e))]))
+
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the framework on synthetic data')
+    parser.add_argument('--only', dest='only', action='store', default=','.join(BENCHMARKS),
+                        help='comma-separated list of benchmark groups: {}'.format(', '.join(BENCHMARKS)))
+    parser.add_argument('--patch', dest='patch_sizes', action='append', type=int,
+                        help='RGB patch size (can be given multiple times), default: {}'.format(PATCH_SIZES))
+    parser.add_argument('--batch', dest='batch_sizes', action='append', type=int,
+                        help='batch size (can be given multiple times), default: {}'.format(BATCH_SIZES))
+    parser.add_argument('--repeats', dest='repeats', action='store', default=REPEATS, type=int,
+                        help='number of timed runs of each case')
+    parser.add_argument('--out', dest='out', action='store',
+                        help='output JSON file with results')
+    parser.add_argument('--baseline', dest='baseline', action='store',
+                        help='JSON file with baseline results to compare against')
+    parser.add_argument('--threshold', dest='threshold', action='store', default=THRESHOLD, type=float,
+                        help='relative slow-down reported as a regression')
+    parser.add_argument('--strict', dest='strict', action='store_true', default=False,
+                        help='exit with a non-zero code when a regression is detected')
+
+    args = parser.parse_args()
+
+    groups = [g.strip() for g in args.only.split(',') if len(g.strip()) > 0]
+    unknown = [g for g in groups if g not in BENCHMARKS]
+    if len(unknown) > 0:
+        print('ERROR Unknown benchmarks: {} (available: {})'.format(unknown, ', '.join(BENCHMARKS)))
+        sys.exit(2)
+
+    patch_sizes = args.patch_sizes or list(PATCH_SIZES)
+    batch_sizes = args.batch_sizes or list(BATCH_SIZES)
+
+    if any(p % 16 != 0 for p in patch_sizes):
+        print('ERROR Patch sizes need to be multiples of 16: {}'.format(patch_sizes))
+        sys.exit(2)
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    print('Benchmarks: {} / patches: {} / batches: {} / repeats: {}'.format(', '.join(groups), patch_sizes, batch_sizes, args.repeats))
+    results = run(groups, patch_sizes, batch_sizes, args.repeats)
+
+    output = OrderedDict([
+        ('environment', environment()),
+        ('settings', OrderedDict([('patch_sizes', patch_sizes), ('batch_sizes', batch_sizes), ('repeats', args.repeats)])),
+        ('results', results)
+    ])
+
+    regressions = []
+    if baseline is not None:
+        output['baseline'] = OrderedDict([('file', os.path.abspath(args.baseline)), ('environment', baseline.get('environment'))])
+        output['comparison'] = compare(results, baseline['results'], args.threshold)
+        regressions = [c for c in output['comparison'] if c['status'] == 'regression']
+
+        print('\n# Comparison with {} (threshold {:.0f}%)\n'.format(args.baseline, 100 * args.threshold))
+        for c in output['comparison']:
+            if c['ratio'] is not None:
+                print('  {:90s} {:10.2f} -> {:10.2f} ms  x{:.2f}  {}'.format(c['key'], c['baseline'], c['current'], c['ratio'], c['status']))
+            else:
+                print('  {:90s} {}'.format(c['key'], c['status']))
+
+        print('\n{} regressions / {} cases'.format(len(regressions), len(output['comparison'])))
+
+    if args.out is not None:
+        dirname = os.path.dirname(os.path.abspath(args.out))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with open(args.out, 'w') as f:
+            json.dump(output, f, indent=4)
+        print('Results written to {}'.format(args.out))
+
+    if args.strict and len(regressions) > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
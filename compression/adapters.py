@@ -0,0 +1,152 @@
+"""
+Adapters for standard image codecs with a common interface - compress an image at multiple quality levels and return
+the decoded images along with their sizes. External codecs work in private temporary directories (on tmpfs, if
+available), so concurrent runs do not interfere with each other.
+
+Sample usage:
+
+    adapter = adapters.get('bpg')
+    for q, (image_compressed, image_bytes) in zip(quality_levels, adapter.compress(image, quality_levels)):
+        ...
+
+"""
+import os
+import tempfile
+import subprocess
+
+import numpy as np
+import imageio
+import glymur
+from PIL import Image
+
+from compression import jpeg_helpers, bpg_helpers
+
+# Use in-memory file system for temporary files, if available
+TMPFS_ROOT = '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) else None
+
+
+def private_tempdir(root=None):
+    """ Returns a context manager with a new private temporary directory (on tmpfs by default). """
+    return tempfile.TemporaryDirectory(prefix='codec-', dir=root or TMPFS_ROOT)
+
+
+class CodecAdapter(object):
+    """
+    Base class for codec adapters.
+    """
+
+    name = None
+
+    def compress(self, image, quality_levels, effective_bytes=True, tmp_dir=None):
+        """
+        Compress an image at successive quality levels.
+        :param image: numpy array (h, w, 3) with values in [0, 1]
+        :param quality_levels: list of quality levels (codec-specific)
+        :param effective_bytes: count only the coded image data (no headers)
+        :param tmp_dir: root for temporary files (default: tmpfs or system default)
+        :return: list of tuples (compressed image, size in bytes) - one for each quality level
+        """
+        raise NotImplementedError()
+
+
+class JPEGAdapter(CodecAdapter):
+    """
+    JPEG (libjpeg via PIL) - all processing in memory, see 'jpeg_helpers.quality_curve'.
+    """
+
+    name = 'jpeg'
+
+    def __init__(self, subsampling='4:4:4', n_threads=None):
+        self.subsampling = subsampling
+        self.n_threads = n_threads
+
+    def compress(self, image, quality_levels, effective_bytes=True, tmp_dir=None):
+        curve = jpeg_helpers.quality_curve(image, quality_levels, self.subsampling, self.n_threads)
+        return [(jpeg_helpers.decompress(curve[q]['data']), curve[q]['effective_bytes' if effective_bytes else 'bytes'])
+                for q in quality_levels]
+
+
+class JPEG2000Adapter(CodecAdapter):
+    """
+    JPEG 2000 (OpenJPEG via glymur) - quality levels are target PSNRs.
+    """
+
+    name = 'jpeg2000'
+
+    def compress(self, image, quality_levels, effective_bytes=True, tmp_dir=None):
+        image_np = (255 * image.clip(0, 1)).astype(np.uint8)
+        results = []
+
+        with private_tempdir(tmp_dir) as dirname:
+            for q in quality_levels:
+                image_path = os.path.join(dirname, 'image_{}.jp2'.format(q))
+                glymur.Jp2k(image_path, data=image_np, psnr=[q])
+                if effective_bytes:
+                    image_bytes = jpeg_helpers.jp2bytes(image_path)
+                else:
+                    image_bytes = os.path.getsize(image_path)
+                results.append((imageio.imread(image_path).astype(np.float32) / (2**8 - 1), image_bytes))
+
+        return results
+
+
+class BPGAdapter(CodecAdapter):
+    """
+    BPG (the reference command-line codec) - quality levels are quantization parameters. The PNG input is written
+    once and all intermediate files are kept in a private (tmpfs) directory. The encoder & decoder are called
+    directly (no shell).
+    """
+
+    name = 'bpg'
+
+    def __init__(self, chroma_fmt='444'):
+        self.chroma_fmt = chroma_fmt
+
+    def compress(self, image, quality_levels, effective_bytes=True, tmp_dir=None):
+        results = []
+
+        with private_tempdir(tmp_dir) as dirname:
+            input_path = os.path.join(dirname, 'image.png')
+            bpg_paths = [os.path.join(dirname, 'image_q{}.bpg'.format(q)) for q in quality_levels]
+            png_paths = [os.path.join(dirname, 'image_q{}.png'.format(q)) for q in quality_levels]
+
+            Image.fromarray((255 * image.clip(0, 1)).astype(np.uint8)).save(input_path, format='PNG', compress_level=1)
+
+            for q, bpg_path, png_path in zip(quality_levels, bpg_paths, png_paths):
+                self._run(self._encoder_args(input_path, q, bpg_path))
+                self._run(self._decoder_args(bpg_path, png_path))
+
+            for bpg_path, png_path in zip(bpg_paths, png_paths):
+                if effective_bytes:
+                    image_bytes = bpg_helpers.bpg_image_info(bpg_path).num_bytes_for_picture
+                else:
+                    image_bytes = os.path.getsize(bpg_path)
+                results.append((imageio.imread(png_path).astype(np.float32) / (2**8 - 1), image_bytes))
+
+        return results
+
+    def _encoder_args(self, input_path, q, output_path):
+        return [bpg_helpers.BPGENC, '-q', str(q), input_path, '-o', output_path, '-f', self.chroma_fmt]
+
+    def _decoder_args(self, input_path, output_path):
+        return [bpg_helpers.BPGDEC, '-o', output_path, input_path]
+
+    @staticmethod
+    def _run(args):
+        process = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if process.returncode != 0:
+            raise RuntimeError('BPG codec failed ({}): {}'.format(process.returncode, process.stderr.decode(errors='replace').strip()))
+
+
+_adapters = {
+    'jpeg': JPEGAdapter,
+    'jpeg2000': JPEG2000Adapter,
+    'bpg': BPGAdapter,
+}
+
+
+def get(codec, **kwargs):
+    """ Returns an adapter for a given codec ('jpeg', 'jpeg2000', 'bpg'). """
+    if codec not in _adapters:
+        raise ValueError('Unsupported codec: {}! Available: {}'.format(codec, list(_adapters.keys())))
+    return _adapters[codec](**kwargs)
@@ -3,10 +3,14 @@ These functions have been adopted from https://github.com/fab-jul/imgcomp-cvpr
 """
 import os
 import subprocess
+from collections import OrderedDict
 
 
 _BPG_QUANTIZATION_PARAMETER_RANGE = (1, 51)  # smaller means better
 BPGENC = os.environ.get('BPGENC', 'bpgenc')
+BPGDEC = os.environ.get('BPGDEC', 'bpgdec')
+_BPG_MAGIC = bytes.fromhex('425047fb')
+_BPG_MAX_HEADER_SIZE = 64  # magic, header stuff and 3 ue7 fields (up to 5 bytes each for 32-bit values)
 
 
 def bpg_compress(input_image_p, q, tmp_dir=None, chroma_fmt='444'):
@@ -23,7 +27,7 @@ def bpg_compress(input_image_p, q, tmp_dir=None, chroma_fmt='444'):
 
 def decode_bpg_to_png(bpg_p):  # really fast
     png_p = bpg_p.replace('.bpg', '_as_png.png')
-    subprocess.call(['bpgdec', '-o', png_p, bpg_p])
+    subprocess.call([BPGDEC, '-o', png_p, bpg_p])
     return png_p
 
 
@@ -47,20 +51,44 @@ def bpg_image_info(p):
     width                 variable, ue7
     height                variable, ue7
     picture_data_length   variable, ue7. If zero: remaining data is image
+
+    Only the header is read from the file - the size of the remaining data is taken from the file system.
     """
     with open(p, 'rb') as f:
-        magic = f.read(4)
-        expected_magic = bytearray.fromhex('425047fb')
-        assert magic == expected_magic, 'Not a BPG file it seems: {}'.format(p)
-        header_info = f.read(2)
-        width = _read_ue7(f)
-        height = _read_ue7(f)
-        picture_data_length = _read_ue7(f)
-        num_bytes_for_picture = _number_of_bytes_until_eof(f) if picture_data_length == 0 else picture_data_length
-        return BPGImageInfo(width, height, num_bytes_for_picture)
-
-
-def _read_ue7(f):
+        file_size = os.fstat(f.fileno()).st_size
+        header = f.read(_BPG_MAX_HEADER_SIZE)
+    return _parse_header(header, file_size, p)
+
+
+def bpg_image_info_from_bytes(data):
+    """ Same as 'bpg_image_info' but for an in-memory bit-stream. """
+    return _parse_header(data, len(data), '<bytes>')
+
+
+def bpg_directory_info(dirname, extension='.bpg'):
+    """
+    Get basic info about all BPG images in a directory.
+    :param dirname: directory to scan
+    :param extension: file extension of BPG images
+    :return: OrderedDict filename -> BPGImageInfo (sorted by filename)
+    """
+    filenames = sorted(entry.name for entry in os.scandir(dirname) if entry.is_file() and entry.name.endswith(extension))
+    return OrderedDict((filename, bpg_image_info(os.path.join(dirname, filename))) for filename in filenames)
+
+
+def _parse_header(data, total_bytes, source):
+    view = memoryview(data)
+    assert view[:4].tobytes() == _BPG_MAGIC, 'Not a BPG file it seems: {}'.format(source)
+    # Skip magic number and header stuff
+    offset = 6
+    width, offset = _read_ue7(view, offset)
+    height, offset = _read_ue7(view, offset)
+    picture_data_length, offset = _read_ue7(view, offset)
+    num_bytes_for_picture = total_bytes - offset if picture_data_length == 0 else picture_data_length
+    return BPGImageInfo(width, height, num_bytes_for_picture)
+
+
+def _read_ue7(view, offset):
     """
     ue7 means it's a bunch of bytes all starting with a 1 until one byte starts
     with 0. from all those bytes you take all bits except the first one and
@@ -69,26 +97,13 @@ def _read_ue7(f):
     some ue7-encoded number:      10001001 01000010
     take all bits except first ->  0001001  1000010 
     merge ->                            10011000010 = 1218
+
+    Returns the decoded value and the offset of the next byte.
     """
     bits = 0
-    first_bit_mask = 1 << 7
-    value_holding_bits_mask = int(7 * '1', 2) 
-    for byte in _byte_generator(f):
-        byte_as_int = byte[0]
-        more_bits_are_coming = byte_as_int & first_bit_mask
-        bits_from_this_byte = byte_as_int & value_holding_bits_mask
-        bits = (bits << 7) | bits_from_this_byte
-        if not more_bits_are_coming:
-            return bits
-
-
-def _number_of_bytes_until_eof(f):
-    return sum(1 for _ in _byte_generator(f))
-
-
-def _byte_generator(f):
-    while True:
-        byte = f.read(1)
-        if byte == b"":
-            break
-        yield byte
+    for offset in range(offset, len(view)):
+        byte_as_int = view[offset]
+        bits = (bits << 7) | (byte_as_int & 0x7f)
+        if not byte_as_int & 0x80:
+            return bits, offset + 1
+    raise ValueError('Truncated BPG header (incomplete ue7 field)')
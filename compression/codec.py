@@ -7,11 +7,10 @@ from collections import Counter
 from pathlib import Path
 
 from scipy.cluster.vq import vq
-from skimage.measure import compare_ssim, compare_psnr
 
 from pyfse import pyfse
 from models import compression
-from helpers import utils
+from helpers import utils, metrics
 
 
 dcn_presets = {
@@ -55,10 +54,11 @@ def compress_n_stats(batch_x, dcn):
         batch_z = dcn.compress(batch_x[image_id:image_id + 1])
         stats['bytes'][image_id] = image_bytes
         stats['entropy'][image_id] = utils.entropy(batch_z, dcn.get_codebook())
-        stats['ssim'][image_id] = compare_ssim(batch_x[image_id], batch_y[image_id], multichannel=True, data_range=1)
-        stats['psnr'][image_id] = compare_psnr(batch_x[image_id], batch_y[image_id], data_range=1)
         stats['bpp'][image_id] = 8 * image_bytes / batch_x[image_id].shape[0] / batch_x[image_id].shape[1]
 
+    stats['ssim'] = metrics.ssim(batch_x, batch_y, data_range=1)
+    stats['psnr'] = metrics.psnr(batch_x, batch_y, data_range=1)
+
     if batch_x.shape[0] == 1:
         for k in stats.keys():
             stats[k] = stats[k][0]
@@ -197,9 +197,11 @@ def compress(batch_x, model, verbose=False):
     return image_stream.getvalue()
 
 
-def decompress(stream, model=None, verbose=False):
+def decompress(stream, model=None, verbose=False, decoder=None):
     """
     Decompress an image from the given bytes sequence. See docs of compress for stream details.
+
+    :param decoder: optional serving graph of the model's decoder (see 'restore_decoder')
     """
 
     if type(stream) is bytes:
@@ -274,6 +276,9 @@ def decompress(stream, model=None, verbose=False):
         print('[l3ic decoder]', 'Layer {} hist:'.format(n), layer_stats)
 
     # Use the DCN decoder to decompress the RGB image
+    if decoder is not None:
+        return decoder.process(batch_z).clip(0, 1)
+
     return model.decompress(batch_z)
 
 
@@ -284,7 +289,25 @@ def global_compress(dcn, batch_x):
     return pyfse.compress(bytes(indices.astype(np.uint8)))
 
 
-def restore_model(dir_name, patch_size=128, fetch_stats=False, sess=None, graph=None, x=None, nip_input=None):
+def restore_decoder(dcn, precision='float32', batch_x=None):
+    """
+    Build a frozen serving graph of the DCN decoder (quantized latent representation -> RGB image) for faster
+    decompression.
+
+    :param dcn: DCN model with loaded weights
+    :param precision: 'float32' or 'int8' (see models.inference)
+    :param batch_x: validation images used to calibrate int8 weights and check accuracy (optional)
+    """
+    calibration = {'z': dcn.compress(batch_x, direct=True)} if batch_x is not None else None
+    decoder = dcn.inference_model(precision, inputs={'z': dcn.latent_post}, calibration=calibration)
+
+    if 'psnr' in decoder.report:
+        print('[l3ic decoder]', '{} decoder: PSNR w.r.t. float32 {:.1f} dB'.format(decoder.precision, decoder.report['psnr']))
+
+    return decoder
+
+
+def restore_model(dir_name, patch_size=128, fetch_stats=False, sess=None, graph=None, x=None, nip_input=None, label=None):
     """
     Utility function to restore a DCN model from a training directory. By default,
     a standalone instance is created. Can also be used for chaining when sess,
@@ -297,6 +320,7 @@ def restore_model(dir_name, patch_size=128, fetch_stats=False, sess=None, graph=
     :param graph: existing TF graph or None
     :param x: input to the model
     :param nip_input: input to the NIP model (useful for chaining)
+    :param label: optional label for the model (needed when multiple DCNs are used in a single graph)
     """
     training_progress_path = None
 
@@ -326,6 +350,8 @@ def restore_model(dir_name, patch_size=128, fetch_stats=False, sess=None, graph=
         parameters['x'] = x
     if nip_input is not None:
         parameters['nip_input'] = nip_input
+    if label is not None:
+        parameters['label'] = label
 
     model = getattr(compression, training_progress['dcn']['model'])(sess, graph, **parameters)
     model.load_model(dir_name)
@@ -1,15 +1,24 @@
+import os
 import re
 import io
+import pickle
+import hashlib
 import numpy as np
-import imageio
-from skimage.measure import compare_ssim
+from PIL import Image
 from collections import OrderedDict
-from struct import unpack
+from concurrent.futures import ThreadPoolExecutor
+from struct import unpack_from
 from jpylyzer import jpylyzer
 
+from helpers import utils, metrics
+
 app_markers = (0xffe0, 0xffe1, 0xffe2, 0xffe3, 0xffe4, 0xffe5, 0xffe6, 0xffe7, 0xffe8, 0xffe9, 0xffea, 0xffeb, 0xffec,
                0xffed, 0xffee, 0xffef)
 
+# Start of frame markers (0xffc4, 0xffc8 and 0xffcc denote other segments)
+sof_markers = (0xffc0, 0xffc1, 0xffc2, 0xffc3, 0xffc5, 0xffc6, 0xffc7, 0xffc9, 0xffca, 0xffcb, 0xffcd, 0xffce, 0xffcf)
+progressive_markers = (0xffc2, 0xffc6, 0xffca, 0xffce)
+
 markers = {
     'SOS': 'Start of Stream',
     'SOI': 'Start of Image',
@@ -20,98 +29,344 @@ markers = {
     'ECD': 'Entropy Coded Data'
 }
 
+# Cached JPEG trade-off curves (image hash -> quality -> stats), see 'quality_curve()'
+CURVE_CACHE_SIZE = 32
+_curve_cache = OrderedDict()
+
+# Default directory of the persistent curve cache shared by processes (None - in-memory cache only)
+CURVE_CACHE_DIR = os.environ.get('JPEG_CURVE_CACHE', None)
+
+# Quality levels evaluated before refining the bracket with the target, see 'match_quality_batch()'
+COARSE_LEVELS = (1, 10, 20, 30, 40, 50, 60, 70, 80, 90, 95)
+
+# Constants for the DCT-domain JPEG simulator, see 'simulate_jpeg()'
+_ycbcr_F = np.array([[0.299, 0.587, 0.114], [-0.168736, -0.331264, 0.5], [0.5, -0.418688, -0.081312]], np.float32)
+_ycbcr_I = np.array([[1, 0, 1.402], [1, -0.344136, -0.714136], [1, 1.772, 0]], np.float32)
+_dct_matrix = np.array([[np.sqrt((1 if k == 0 else 2) / 8) * np.cos((2 * m + 1) * k * np.pi / 16) for m in range(8)]
+                        for k in range(8)], np.float32)
+_subsampling_factors = {'4:4:4': (1, 1), '4:2:2': (1, 2), '4:2:0': (2, 2)}
+
+# Shared thread pool for JPEG coding, see '_get_executor()'
+_executor = None
+
 
-def match_quality(image, target=0.95, match='ssim', subsampling='4:4:4'):
+def quality_curve(image, quality_levels=None, subsampling='4:4:4', n_threads=None, cache_dir=CURVE_CACHE_DIR):
+    """
+    Get the JPEG trade-off curve for an image, i.e., the compressed bit-streams and their basic stats for successive
+    quality levels. The curves are cached (keyed by the image hash) so each quality level is encoded only once, and
+    the missing levels are encoded in parallel. With a cache directory, the curves are also stored on disk (one file
+    per image and quality level), so they are shared between processes, e.g., rate-distortion sweep workers.
+    :param image: numpy array (h, w, 3)
+    :param quality_levels: quality levels to include (default: all levels from 1 to 95)
+    :param subsampling: chrominance sub-sampling, 4:4:4, 4:2:2, 4:2:0
+    :param n_threads: number of encoding threads (default: number of CPUs)
+    :param cache_dir: directory of the persistent curve cache (None - in-memory cache only)
+    :return: dict quality -> {'data', 'bytes', 'effective_bytes', 'bpp', 'ssim', 'psnr'}
+    """
+
+    assert image.ndim == 3, 'Only RGB images supported'
+
+    if image.max() > 1:
+        image = image.astype(np.float32) / (2**8 - 1)
+
+    image_u8 = (255 * image).astype(np.uint8)
+
+    # Find the cached curve & mark it as recently used
+    digest = hashlib.sha1(image_u8.tobytes())
+    digest.update('{}/{}'.format(image_u8.shape, subsampling).encode())
+    key = digest.hexdigest()
+
+    curve = _curve_cache.pop(key, {})
+    _curve_cache[key] = curve
+    while len(_curve_cache) > CURVE_CACHE_SIZE:
+        _curve_cache.popitem(last=False)
+
+    quality_levels = range(1, 96) if quality_levels is None else quality_levels
+    missing = sorted({int(q) for q in quality_levels}.difference(curve.keys()))
+
+    if cache_dir is not None:
+        curve.update(_load_curve(cache_dir, key, missing))
+        missing = [q for q in missing if q not in curve]
+
+    def encode(q):
+        data = _encode(image_u8, q, subsampling)
+        image_j = decompress(data)
+        return q, {
+            'data': data,
+            'bytes': len(data),
+            'effective_bytes': JPEGMarkerStats(data).get_effective_bytes(),
+            'bpp': 8 * len(data) / image.shape[0] / image.shape[1],
+            'ssim': metrics.ssim(image, image_j, data_range=1),
+            'psnr': metrics.psnr(image, image_j, data_range=1)
+        }
+
+    if n_threads is None:
+        encoded = dict(_get_executor().map(encode, missing))
+    else:
+        with ThreadPoolExecutor(n_threads) as executor:
+            encoded = dict(executor.map(encode, missing))
+
+    curve.update(encoded)
+
+    if cache_dir is not None:
+        _store_curve(cache_dir, key, encoded)
+
+    return curve
+
+
+def _load_curve(cache_dir, key, quality_levels):
+    """ Load the available quality levels of a trade-off curve from the persistent cache. """
+    curve = {}
+    for q in quality_levels:
+        filename = os.path.join(cache_dir, key, 'q{:03d}.pkl'.format(q))
+        if os.path.isfile(filename):
+            try:
+                with open(filename, 'rb') as f:
+                    curve[q] = pickle.load(f)
+            except (IOError, EOFError, pickle.UnpicklingError) as e:
+                print('WARNING Corrupted JPEG curve cache entry {} - ignoring ({})'.format(filename, e))
+    return curve
+
+
+def _store_curve(cache_dir, key, curve):
+    """ Store quality levels of a trade-off curve in the persistent cache (atomic writes, safe for concurrent use). """
+    dirname = os.path.join(cache_dir, key)
+    os.makedirs(dirname, exist_ok=True)
+    for q, stats in curve.items():
+        filename = os.path.join(dirname, 'q{:03d}.pkl'.format(q))
+        with open('{}.{}.tmp'.format(filename, os.getpid()), 'wb') as f:
+            pickle.dump(stats, f)
+        os.replace('{}.{}.tmp'.format(filename, os.getpid()), filename)
+
+
+def interpolate_quality(curve, target, match='ssim'):
+    """
+    Find a (fractional) quality level which matches a given SSIM or bpp target on a JPEG trade-off curve.
+    :param curve: the trade-off curve (see 'quality_curve()')
+    :param target: target value of ssim / bpp
+    :param match: string 'ssim' or 'bpp'
+    :return: interpolated quality level (float)
+    """
+
+    qualities, deviations, i = _bracket(curve, target, match)
+
+    if deviations[i] == deviations[i + 1]:
+        return qualities[i]
+
+    return qualities[i] - deviations[i] * (qualities[i + 1] - qualities[i]) / (deviations[i + 1] - deviations[i])
+
+
+def _bracket(curve, target, match):
+    """ Returns sorted qualities, deviations from the target and the index of the first sign change. """
+
+    if match not in ('ssim', 'bpp'):
+        raise ValueError('Invalid argument: match')
+
+    if len(curve) == 0:
+        raise ValueError('Empty trade-off curve!')
+
+    qualities = np.array(sorted(curve.keys()), dtype=np.float64)
+    deviations = np.array([curve[q][match] for q in sorted(curve.keys())]) - target
+
+    # Look for the first bracket where the deviation changes sign
+    crossings = np.nonzero(deviations[:-1] * deviations[1:] <= 0)[0]
+
+    if len(crossings) == 0:
+        raise ValueError('Same deviation for both end-points {:.0f} - {:.0f}'.format(qualities[0], qualities[-1]))
+
+    return qualities, deviations, crossings[0]
+
+
+def match_quality(image, target=0.95, match='ssim', subsampling='4:4:4', cache_dir=CURVE_CACHE_DIR):
     """
     Find JPEG quality level which matches a given SSIM or bpp target.
     :param image:
     :param target: target value of ssim / bpp
     :param match: string 'ssim' or 'bpp'
     :param subsampling: chrominance sub-sampling, 4:4:4, 4:2:2, 4:2:0
+    :param cache_dir: directory of the persistent curve cache (see 'quality_curve()')
     :return: jpeg quality level (integer from 1 to 95)
     """
 
     assert image.ndim == 3, 'Only RGB images supported'
 
-    def get_ssim(q):
-        image_j = compress_batch(image, q, subsampling=subsampling)[0].squeeze()
-        c_ssim = compare_ssim(image, image_j, multichannel=True, data_range=1)
-        return c_ssim - target
-
-    def get_bpp(q):
-        bytes_arr = compress_batch(image, q, subsampling=subsampling)[1]
-        bpp = 8 * np.mean(bytes_arr) / image.shape[0] / image.shape[1]
-        return bpp - target
+    return match_quality_batch(image[np.newaxis], [target], match, subsampling, cache_dir=cache_dir)[0]
 
-    if match == 'ssim':
-        fun = get_ssim
-    elif match == 'bpp':
-        fun = get_bpp
-    else:
-        raise ValueError('Invalid argument: match')
 
-    low = 1
-    high = 95
-    low_obj = fun(low)
-    high_obj = fun(high)
+def match_quality_batch(batch_x, targets, match='ssim', subsampling='4:4:4', quality_levels=None, cache_dir=CURVE_CACHE_DIR):
+    """
+    Find JPEG quality levels which match given SSIM or bpp targets for a batch of images. By default, a coarse grid of
+    quality levels is encoded first and only the levels inside the bracket with the target are added. The trade-off
+    curves are cached, so subsequent queries (and rate-distortion sweeps) for the same images do not re-encode them.
+    :param batch_x: numpy array (n, h, w, 3)
+    :param targets: target values of ssim / bpp (one per image)
+    :param match: string 'ssim' or 'bpp'
+    :param subsampling: chrominance sub-sampling, 4:4:4, 4:2:2, 4:2:0
+    :param quality_levels: quality levels to evaluate (default: coarse grid refined around the target)
+    :param cache_dir: directory of the persistent curve cache (see 'quality_curve()')
+    :return: list of jpeg quality levels (integers from 1 to 95)
+    """
 
-    while True:
+    if len(batch_x) != len(targets):
+        raise ValueError('The number of targets ({}) does not match the batch size ({})'.format(len(targets), len(batch_x)))
 
-        if high - low <= 1:
-            if abs(high_obj) > abs(low_obj):
-                return low
-            else:
-                return high
+    qualities = []
+    for image, target in zip(batch_x, targets):
+        if quality_levels is None:
+            curve = quality_curve(image, COARSE_LEVELS, subsampling, cache_dir=cache_dir)
+            levels, _, i = _bracket({q: curve[q] for q in COARSE_LEVELS}, target, match)
+            curve = quality_curve(image, range(int(levels[i]), int(levels[i + 1]) + 1), subsampling, cache_dir=cache_dir)
+        else:
+            curve = quality_curve(image, quality_levels, subsampling, cache_dir=cache_dir)
+        qualities.append(int(np.round(interpolate_quality(curve, target, match))))
 
-        if low_obj * high_obj > 0:
-            raise ValueError('Same deviation for both end-points {} - {}'.format(low, high))
+    return qualities
 
-        mid = int((low + high)/2)
-        mid_obj = fun(mid)
 
-        if mid_obj * high_obj > 0:
-            high = mid
-            high_obj = mid_obj
-        else:
-            low = mid
-            low_obj = mid_obj
+def decompress(data):
+    """ Decode a JPEG bit-stream into a float32 image in [0, 1]. """
+    return _decode(data).astype(np.float32) / (2 ** 8 - 1)
 
 
-def compress_batch(batch_x, jpeg_quality, effective=False, subsampling='4:4:4'):
+def compress_batch(batch_x, jpeg_quality, effective=False, subsampling='4:4:4', decode=True):
     """
     Compress an image batch with the standard JPEG codec. Returns compressed images and their sizes in bytes.
+    Images are processed in parallel (libjpeg releases the GIL) and decoded into a pre-allocated output batch.
     :param batch_x: numpy array (n, h, w, 3)
     :param jpeg_quality: quality level (integer from 1 to 95); For some reason levels 95 - 100 return the same results
     :param effective: whether to return the entire file size or only the coded image data (w. Huffman tables)
     :param subsampling: chrominance sub-sampling, 4:4:4, 4:2:2, 4:2:0
+    :param decode: set to False to skip decoding if only the sizes are needed (None is returned instead of images)
     :return: tuple with a batch of compressed images, and their corresponding sizes in bytes
     """
 
     if batch_x.max() > 1:
         batch_x = batch_x.astype(np.float32) / (2**8 - 1)
 
+    if batch_x.ndim not in (3, 4):
+        raise ValueError('Unsupported batch shape {}! Expected (n, h, w, c) or (h, w, c)'.format(batch_x.shape))
+
+    batch_u8 = (255 * batch_x).astype(np.uint8)
     if batch_x.ndim == 3:
-        s = io.BytesIO()
-        imageio.imsave(s, (255 * batch_x).astype(np.uint8).squeeze(), format='jpg', quality=jpeg_quality, subsampling=subsampling)
-        image_compressed = imageio.imread(s.getvalue())
-        image_bytes = len(s.getvalue()) if not effective else JPEGMarkerStats(s.getvalue()).get_effective_bytes()
-
-        return image_compressed / (2 ** 8 - 1), image_bytes
-
-    elif batch_x.ndim == 4:
-        batch_j = np.zeros_like(batch_x)
-        bytes_arr = []
-        for r in range(batch_x.shape[0]):
-            s = io.BytesIO()
-            imageio.imsave(s, (255 * batch_x[r]).astype(np.uint8).squeeze(), format='jpg', quality=jpeg_quality, subsampling=subsampling)
-            image_compressed = imageio.imread(s.getvalue())
-            batch_j[r] = image_compressed.astype(np.float32) / (2 ** 8 - 1)
-            image_bytes = len(s.getvalue()) if not effective else JPEGMarkerStats(s.getvalue()).get_effective_bytes()
-            bytes_arr.append(image_bytes)
+        batch_u8 = batch_u8[np.newaxis]
+
+    batch_j = np.empty(batch_u8.shape, dtype=np.float32) if decode else None
+
+    def process(r):
+        data = _encode(batch_u8[r].squeeze(), jpeg_quality, subsampling)
+        if decode:
+            np.divide(_decode(data).reshape(batch_u8.shape[1:]), 2 ** 8 - 1, out=batch_j[r])
+        return len(data) if not effective else JPEGMarkerStats(data).get_effective_bytes()
 
+    if len(batch_u8) == 1:
+        bytes_arr = [process(0)]
+    else:
+        bytes_arr = list(_get_executor().map(process, range(len(batch_u8))))
+
+    if batch_x.ndim == 3:
+        return batch_j[0] if decode else None, bytes_arr[0]
+    else:
         return batch_j, bytes_arr
 
 
+def _get_executor():
+    """ Returns a shared thread pool for JPEG encoding / decoding. """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(os.cpu_count())
+    return _executor
+
+
+def _encode(image_u8, quality, subsampling='4:4:4'):
+    """ Encode an uint8 image as JPEG (directly with PIL). """
+    s = io.BytesIO()
+    Image.fromarray(image_u8).save(s, format='JPEG', quality=int(quality), subsampling=subsampling)
+    return s.getvalue()
+
+
+def _decode(data):
+    """ Decode a JPEG bit-stream into an uint8 array (directly with PIL). """
+    with Image.open(io.BytesIO(data)) as image:
+        return np.asarray(image)
+
+
+def simulate_jpeg(batch_x, jpeg_quality, subsampling='4:4:4'):
+    """
+    Simulate JPEG compression in the DCT domain (vectorized NumPy implementation, no entropy coding). The whole batch
+    is processed at once: colour conversion, chrominance sub-sampling (box filters), 8x8 block DCT, quantization with
+    standard IJG tables and the corresponding inverse steps. Deterministic and cheap - a handy reference for the
+    differentiable approximation in 'models.jpeg.DJPG'.
+    :param batch_x: numpy array (n, h, w, 3) or (h, w, 3)
+    :param jpeg_quality: quality level (1 - 100) or a sequence of quality levels (one per image)
+    :param subsampling: chrominance sub-sampling, 4:4:4, 4:2:2, 4:2:0
+    :return: batch of compressed images in [0, 1] (float32)
+    """
+
+    if subsampling not in _subsampling_factors:
+        raise ValueError('Unsupported chrominance sub-sampling: {}'.format(subsampling))
+
+    if batch_x.max() > 1:
+        batch_x = batch_x.astype(np.float32) / (2**8 - 1)
+
+    if batch_x.ndim == 3:
+        return simulate_jpeg(batch_x[np.newaxis], jpeg_quality, subsampling)[0]
+
+    n_images, height, width = batch_x.shape[:3]
+
+    # Quantization tables for each image (n, 2, 8, 8) - luminance & chrominance
+    qualities = np.broadcast_to(np.asarray(jpeg_quality), (n_images,))
+    q_tables = np.array([[utils.jpeg_qtable(q, 0), utils.jpeg_qtable(q, 1)] for q in qualities])
+
+    # RGB -> YCbCr (JFIF, integer samples)
+    ycbcr = np.matmul(255 * batch_x.astype(np.float32), _ycbcr_F.T) + [0, 128, 128]
+    ycbcr = np.clip(np.round(ycbcr), 0, 255)
+
+    batch_y = np.empty_like(ycbcr)
+
+    for channel in range(3):
+        fy, fx = _subsampling_factors[subsampling] if channel > 0 else (1, 1)
+
+        plane = ycbcr[..., channel]
+        if fy > 1 or fx > 1:
+            plane = _pad_to_multiple(plane, (fy, fx))
+            plane = plane.reshape((n_images, plane.shape[1] // fy, fy, plane.shape[2] // fx, fx)).mean(axis=(2, 4))
+
+        # Split into 8x8 blocks (n, blocks_y, blocks_x, 8, 8)
+        ph, pw = plane.shape[1:]
+        blocks = _pad_to_multiple(plane - 128, (8, 8))
+        blocks = blocks.reshape((n_images, blocks.shape[1] // 8, 8, blocks.shape[2] // 8, 8)).transpose((0, 1, 3, 2, 4))
+
+        # DCT, quantization & inverse DCT
+        Q = q_tables[:, min(channel, 1), np.newaxis, np.newaxis]
+        coeffs = np.matmul(np.matmul(_dct_matrix, blocks), _dct_matrix.T)
+        coeffs = np.round(coeffs / Q) * Q
+        blocks = np.matmul(np.matmul(_dct_matrix.T, coeffs), _dct_matrix)
+
+        # Merge blocks and clip to the valid range
+        plane = blocks.transpose((0, 1, 3, 2, 4)).reshape((n_images, blocks.shape[1] * 8, blocks.shape[2] * 8))
+        plane = np.clip(np.round(plane[:, :ph, :pw] + 128), 0, 255)
+
+        if fy > 1 or fx > 1:
+            plane = plane.repeat(fy, axis=1).repeat(fx, axis=2)
+
+        batch_y[..., channel] = plane[:, :height, :width]
+
+    # YCbCr -> RGB
+    batch_y = np.matmul(batch_y - [0, 128, 128], _ycbcr_I.T)
+    batch_y = np.clip(np.round(batch_y), 0, 255) / (2**8 - 1)
+
+    return batch_y.astype(np.float32)
+
+
+def _pad_to_multiple(planes, factors):
+    """ Pad a batch of planes (n, h, w) by edge replication so that (h, w) are multiples of the given factors. """
+    pad_y = -planes.shape[1] % factors[0]
+    pad_x = -planes.shape[2] % factors[1]
+    if pad_y == 0 and pad_x == 0:
+        return planes
+    return np.pad(planes, ((0, 0), (0, pad_y), (0, pad_x)), 'edge')
+
+
 def jp2bytes(filename):
     """ Gets JPEG 2000 payload size in bytes (using jpylyzer). Not thoroughly tested. Should sum all tiles. """
     out = jpylyzer.checkOneFile(filename).toxml()
@@ -123,14 +378,11 @@ def jp2bytes(filename):
     return sum(data_length)
 
 
-def get_byte_array(chunk):
-    """ Convert a chunk of bytes to a corresponding array """
-    return list(unpack("B" * len(chunk), chunk))
-
-
 class JPEGMarkerStats:
     """
-    Provides basic statistics about the markers in the JPEG bit-stream.
+    Provides basic statistics about the markers in the JPEG bit-stream. The stream is scanned once (using offsets into
+    the original buffer), and the image shape is read from the SOF segment. Both baseline and progressive JPEGs are
+    supported.
     """
 
     def __init__(self, image):
@@ -138,100 +390,128 @@ class JPEGMarkerStats:
         Get JPEG marker stats for an image.
         :param image: filename or bytes
         """
-        self.l_decode = 0
-        self.len_chunk = 0
         self.blocks = OrderedDict()
+        self.shape = None
+        self.progressive = False
+        self.n_scans = 0
 
         if type(image) is str:
             with open(image, 'rb') as f:
                 image = f.read()
-        elif type(image) is bytes:
+        elif type(image) in (bytes, bytearray):
             pass
+        elif type(image) is memoryview:
+            image = image.tobytes()
         else:
             raise ValueError('Image not supported! Supported: str, bytes')
 
         self._process(image)
-        self.shape = imageio.imread(image).shape
 
-    def _process_quantization_tables(self, data):
+        if self.shape is None:
+            raise IOError('Parsing error: missing SOF segment')
+
+    def _process_quantization_tables(self, data, pos, end, offset):
         """ Extracts the quantization tables and updates the marker stats. """
-        while len(data) > 0:
-            # get the ID of the table [Luma(0), Chroma(1)]
-            marker, = unpack("B", data[0:1])
-            # get the complete table of 64 elements in one go
-            self.blocks['DQT:{}'.format(marker & 0xf)] = self.l_decode
-            # remove the quantization table chunk
-            data = data[65:]
-
-    def _process_huffman_tables(self, data):
+        while pos < end:
+            # get the ID of the table [Luma(0), Chroma(1)] and its precision (8 or 16 bits)
+            marker = data[pos]
+            self.blocks['DQT:{}'.format(marker & 0xf)] = offset
+            # skip the complete table of 64 elements in one go
+            pos += 65 if marker >> 4 == 0 else 129
+
+    def _process_huffman_tables(self, data, pos, end, offset):
         """ Extracts the Huffman tables and updates the marker stats. """
-        while len(data) > 0:
-            id, = unpack("B", data[0: 1])
-            lengths = get_byte_array(data[1: 17])
-            data = data[17:]
-            for i in lengths:
-                data = data[i:]
-            self.blocks['DHT:{}'.format(id)] = self.l_decode
+        while pos < end:
+            id = data[pos]
+            # skip the code lengths and the symbols - progressive streams re-define tables, keep the first occurrence
+            pos += 17 + sum(data[pos + 1:pos + 17])
+            self.blocks.setdefault('DHT:{}'.format(id), offset)
+
+    def _process_frame_header(self, data, pos):
+        """ Reads image dimensions from the SOF segment. """
+        height, width, n_components = unpack_from('>HHB', data, pos + 5)
+        self.shape = (height, width) if n_components == 1 else (height, width, n_components)
+
+    def _skip_entropy_coded_data(self, data, pos):
+        """ Returns the offset of the first marker after the entropy coded data (stuffed bytes and RST markers are skipped). """
+        while True:
+            pos = data.find(b'\xff', pos)
+            if pos < 0 or pos + 1 >= len(data):
+                raise IOError('Parsing error: truncated entropy coded data')
+            marker = data[pos + 1]
+            if marker == 0x00 or 0xd0 <= marker <= 0xd7:
+                pos += 2
+            elif marker == 0xff:
+                pos += 1
+            else:
+                return pos
 
     def _process(self, data):
-        """ Parse the JPEG bit-stream and find the locations of markers. Returns  """
-        temp_data = data
-        rst_marker_index = 0
+        """ Parse the JPEG bit-stream and find the locations of markers. Returns the blocks dictionary. """
+        view = memoryview(data)
+        length = len(view)
         app_marker_index = 0
+
+        if length < 4 or view[0] != 0xff or view[1] != 0xd8:
+            raise IOError('Parsing error: missing SOI marker')
+
         self.blocks['SOI'] = 0
-        try:
-            while len(data) > 0:
-                # unpacking big endian hexadecimal marker
-                marker, = unpack(">H", data[0:2])
-                # start of image
-                if marker == 0xffd8:
-                    self.len_chunk = 2
-                    self.l_decode = 2
-                # end of image
-                elif marker == 0xffd9:
-                    self.l_decode += 2
-                    self.blocks['EOI'] = self.l_decode
-                    return self.blocks
-                else:
-                    # decode the image chunk by chunk
-                    self.len_chunk, = unpack(">H", data[2:4])
-                    # add the length of the 2 bytes marker
-                    self.len_chunk += 2
-                    # get the chunk after removing marker and length bytes
-                    chunk = data[4:self.len_chunk]
-                    if marker == 0xffdb:
-                        self._process_quantization_tables(chunk)
-                    elif marker == 0xffc0:
-                        self.blocks['DCT'] = self.l_decode
-                    elif marker == 0xffc2:
-                        print("Skipping progressive mode fragments")
-                        raise NotImplementedError('Progressive JPEG images not supported yet')
-                    elif marker == 0xffc4:
-                        self._process_huffman_tables(chunk)
-                    elif marker == 0xffda:
-                        # assuming valid JPEG
-                        self.blocks['SOS'] = self.l_decode
-                        self.len_chunk, = unpack(">H", data[2:4])
-                        self.len_chunk += 2
-                        self.l_decode += self.len_chunk
-                        data = data[self.len_chunk:]
-                        self.len_chunk = len(temp_data) - self.l_decode - 2
-                        self.blocks['ECD'] = self.l_decode
-                    elif marker in app_markers:
-                        # suppose header contains two app markers then for ex, ffed -> app_13_0 and ffe0 -> app_0_1
-                        self.blocks['APP:{}/{}'.format(0xf & marker, app_marker_index)] = self.l_decode
-                        app_marker_index += 1
-                    elif marker in (0xfffe, 0xffdd):
-                        self.blocks['RST'] = self.l_decode
-                        rst_marker_index += 1
-                    else:
-                        break
-                    self.l_decode += self.len_chunk
-                data = data[self.len_chunk:]
-        except Exception as e:
-            raise IOError('Parsing error: {}'.format(e))
-
-        return None
+        pos = 2
+
+        while pos + 1 < length:
+
+            if view[pos] != 0xff:
+                raise IOError('Parsing error: expected a marker at offset {}'.format(pos))
+
+            marker = 0xff00 | view[pos + 1]
+
+            # fill bytes and stand-alone markers
+            if marker == 0xffff:
+                pos += 1
+                continue
+            elif marker == 0xff01 or 0xffd0 <= marker <= 0xffd7:
+                pos += 2
+                continue
+            # end of image
+            elif marker == 0xffd9:
+                self.blocks['EOI'] = pos + 2
+                return self.blocks
+
+            if pos + 4 > length:
+                break
+
+            # segment length (including the 2 length bytes, excluding the marker)
+            end = pos + 2 + ((view[pos + 2] << 8) | view[pos + 3])
+
+            if end > length:
+                break
+
+            if marker == 0xffdb:
+                self._process_quantization_tables(view, pos + 4, end, pos)
+            elif marker in sof_markers:
+                self.blocks['DCT'] = pos
+                self.progressive = marker in progressive_markers
+                self._process_frame_header(view, pos)
+            elif marker == 0xffc4:
+                self._process_huffman_tables(view, pos + 4, end, pos)
+            elif marker == 0xffda:
+                # progressive streams contain multiple scans - report the first one
+                self.n_scans += 1
+                if 'SOS' not in self.blocks:
+                    self.blocks['SOS'] = pos
+                    self.blocks['ECD'] = end
+                pos = self._skip_entropy_coded_data(data, end)
+                continue
+            elif marker in app_markers:
+                # suppose header contains two app markers then for ex, ffed -> app_13_0 and ffe0 -> app_0_1
+                self.blocks['APP:{}/{}'.format(0xf & marker, app_marker_index)] = pos
+                app_marker_index += 1
+            elif marker in (0xfffe, 0xffdd):
+                self.blocks['RST'] = pos
+
+            pos = end
+
+        raise IOError('Parsing error: truncated bit-stream (no EOI marker)')
 
     def get_bytes(self):
         return self.blocks['EOI']
@@ -1,252 +1,425 @@
 import os
+import json
+import shutil
+import tempfile
+import multiprocessing
 import tqdm
 import imageio
 import pandas as pd
 import numpy as np
 import seaborn as sns
 import matplotlib.pyplot as plt
-import glymur
 from pathlib import Path
-from skimage.measure import compare_ssim, compare_psnr
-from sewar.full_ref import msssim
 
 from scipy.optimize import curve_fit
 
-from helpers import loading, utils, coreutils
-from compression import jpeg_helpers, codec, bpg_helpers
+from helpers import loading, utils, coreutils, metrics
+from compression import jpeg_helpers, codec, adapters
 
+RESULTS_COLUMNS = ['image_id', 'filename', 'codec', 'quality', 'ssim', 'psnr', 'msssim', 'msssim_db', 'bytes', 'bpp']
+DCN_RESULTS_COLUMNS = ['image_id', 'filename', 'model_dir', 'codec', 'ssim', 'psnr', 'msssim', 'msssim_db', 'entropy',
+                       'bytes', 'bpp', 'layers', 'quantization', 'entropy_reg', 'codebook', 'latent', 'latent_shape',
+                       'n_features']
 
-def get_jpeg_df(directory, write_files=False, effective_bytes=True, force_calc=False):
+# Filenames for compressed images (when requested)
+_image_filenames = {
+    'jpeg': 'jpeg_q{:03d}.png',
+    'jpeg2000': 'jp2_q{:.1f}dB.png',
+    'bpg': 'bpg_q{:03d}.png'
+}
+
+# State of the current sweep worker (image batch and a private temporary directory), see 'run_sweep()'
+_sweep_state = {}
+
+
+class ResultsWriter:
     """
-    Compute and return (as Pandas DF) the rate distortion curve for JPEG. The result is saved
-    as a CSV file in the source directory. If the file exists, the DF is loaded and returned.
+    Incrementally saves rate-distortion results. Rows are appended (in chunks) to a partial CSV file next to the
+    target file, so an interrupted sweep can be resumed - rows with already completed keys are skipped. The final table
+    (sorted by the keys) is written to the target file (CSV or Parquet, depending on the extension) once all rows are
+    collected.
+
+    Sample usage:
+
+        writer = ResultsWriter('jpeg.csv', columns, keys=('filename', 'codec', 'quality'))
+        for ...:
+            if not writer.is_done(filename, 'jpeg', q):
+                writer.append({...})
+        df = writer.finish()
 
-    Files are saved as JPEG using imageio.
     """
 
-    files, _ = loading.discover_files(directory, n_images=-1, v_images=0)
-    batch_x = loading.load_images(files, directory, load='y')
-    batch_x = batch_x['y'].astype(np.float32) / (2 ** 8 - 1)
+    def __init__(self, filename, columns, keys, chunk_size=100, resume=True):
+        """
+        :param filename: path to the target CSV / Parquet file
+        :param columns: list of table columns
+        :param keys: columns which identify a single measurement
+        :param chunk_size: number of rows buffered in memory before appending them to the partial file
+        :param resume: resume from the partial file (if it exists); otherwise the partial file is discarded
+        """
+        self.filename = filename
+        self.partial_filename = '{}.partial.csv'.format(os.path.splitext(filename)[0])
+        self.columns = list(columns)
+        self.keys = list(keys)
+        self.chunk_size = chunk_size
+        self._rows = []
+        self._completed = set()
+
+        if os.path.isfile(self.partial_filename):
+            if resume:
+                df = pd.read_csv(self.partial_filename, index_col=False)
+                self._completed = {self._key(row) for row in df[self.keys].values.tolist()}
+                print('Resuming from {} ({} rows completed)'.format(self.partial_filename, len(df)))
+            else:
+                os.remove(self.partial_filename)
+
+    @staticmethod
+    def _key(values):
+        return tuple(str(v) for v in values)
+
+    def is_done(self, *key):
+        """ Check if a row with given key values (in the order of 'keys') has already been saved. """
+        return self._key(key) in self._completed
+
+    def append(self, row):
+        self._rows.append(row)
+        self._completed.add(self._key(row[k] for k in self.keys))
+        if len(self._rows) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if len(self._rows) == 0:
+            return
+        pd.DataFrame(self._rows, columns=self.columns).to_csv(self.partial_filename, mode='a', index=False,
+                                                              header=not os.path.isfile(self.partial_filename))
+        self._rows = []
+
+    def finish(self):
+        """ Save the complete table to the target file and return it as a Pandas DF. """
+        self.flush()
+
+        if os.path.isfile(self.partial_filename):
+            df = pd.read_csv(self.partial_filename, index_col=False)
+            df = df.sort_values(self.keys, kind='mergesort').reset_index(drop=True)
+        else:
+            df = pd.DataFrame(columns=self.columns)
 
-    # Get trade-off for JPEG
-    quality_levels = np.arange(95, 5, -5)
-    df_jpeg_path = os.path.join(directory, 'jpeg.csv')
+        write_table(df, self.filename)
 
-    if os.path.isfile(df_jpeg_path) and not force_calc:
-        print('Restoring JPEG stats from {}'.format(df_jpeg_path))
-        df = pd.read_csv(df_jpeg_path, index_col=False)
+        if os.path.isfile(self.partial_filename):
+            os.remove(self.partial_filename)
+
+        return df
+
+
+def read_table(filename):
+    """ Read a table of results (CSV or Parquet, depending on the extension). """
+    if filename.endswith('.parquet'):
+        return pd.read_parquet(filename)
     else:
-        df = pd.DataFrame(columns=['image_id', 'filename', 'codec', 'quality', 'ssim', 'psnr', 'msssim', 'msssim_db', 'bytes', 'bpp'])
+        return pd.read_csv(filename, index_col=False)
 
-        with tqdm.tqdm(total=len(files) * len(quality_levels), ncols=120, desc='JPEG') as pbar:
 
-            for image_id, filename in enumerate(files):
+def write_table(df, filename):
+    """ Save a table of results (CSV or Parquet, depending on the extension). """
+    if filename.endswith('.parquet'):
+        df.to_parquet(filename, index=False)
+    else:
+        df.to_csv(filename, index=False)
 
-                # Read the original image
-                image = batch_x[image_id]
 
-                for qi, q in enumerate(quality_levels):
+def run_sweep(tasks, task_fn, writer, batch_x, desc, n_processes=None):
+    """
+    Run a rate-distortion sweep: evaluate independent tasks (e.g., image x quality level) in a pool of worker processes
+    and stream the resulting rows to a results writer. Rows are written in the order of the tasks, regardless of the
+    order in which they complete. Each worker has a copy of the image batch and a private temporary directory (see
+    '_sweep_state').
+
+    :param tasks: list of tuples with arguments for 'task_fn'
+    :param task_fn: module-level function which takes the task arguments and returns a list of rows (dicts)
+    :param writer: ResultsWriter
+    :param batch_x: batch of images (uint8) shared with the workers
+    :param desc: label for the progress bar
+    :param n_processes: number of worker processes (default: number of CPUs); 1 runs the tasks in the current process
+    """
 
-                    # Compress images and get effective bytes (only image data - no headers)
-                    image_compressed, image_bytes = jpeg_helpers.compress_batch(image, q, effective=effective_bytes)
+    n_processes = min(n_processes or os.cpu_count(), len(tasks))
+    tmp_root = tempfile.mkdtemp(prefix='ratedistortion-', dir=adapters.TMPFS_ROOT)
+    pool = None
 
-                    if write_files:
-                        image_dir = os.path.join(directory, os.path.splitext(filename)[0])
-                        if not os.path.isdir(image_dir):
-                            os.makedirs(image_dir)
+    try:
+        if n_processes <= 1:
+            _init_worker(batch_x, tmp_root)
+            results = (task_fn(*task) for task in tasks)
+        else:
+            # Spawned (not forked) workers are safe to use even if the parent process holds TF sessions
+            pool = multiprocessing.get_context('spawn').Pool(n_processes, _init_worker, (batch_x, tmp_root))
+            results = pool.imap(_run_task, [(task_fn, task) for task in tasks])
 
-                        image_path = os.path.join(image_dir, 'jpeg_q{:03d}.png'.format(q))
-                        imageio.imwrite(image_path, (255 * image_compressed).astype(np.uint8))
+        with tqdm.tqdm(total=len(tasks), ncols=120, desc=desc) as pbar:
+            for rows in results:
+                for row in rows:
+                    writer.append(row)
+                pbar.update(1)
 
-                    msssim_value = msssim(image, image_compressed, MAX=1).real
+        if pool is not None:
+            pool.close()
+            pool.join()
 
-                    df = df.append({'image_id': image_id,
-                                    'filename': filename,
-                                    'codec': 'jpeg',
-                                    'quality': q,
-                                    'ssim': compare_ssim(image, image_compressed, multichannel=True, data_range=1),
-                                    'psnr': compare_psnr(image, image_compressed, data_range=1),
-                                    'msssim': msssim_value,
-                                    'msssim_db': -10 * np.log10(1 - msssim_value),
-                                    'bytes': image_bytes,
-                                    'bpp': 8 * image_bytes / image.shape[0] / image.shape[1]
-                                    }, ignore_index=True)
+    finally:
+        if pool is not None:
+            pool.terminate()
+        writer.flush()
+        _sweep_state.clear()
+        shutil.rmtree(tmp_root, ignore_errors=True)
 
-                    pbar.set_postfix(image_id=image_id, quality=q)
-                    pbar.update(1)
 
-        df.to_csv(os.path.join(directory, 'jpeg.csv'), index=False)
+def _init_worker(batch_x, tmp_root):
+    _sweep_state['batch_x'] = batch_x.astype(np.float32) / (2 ** 8 - 1)
+    _sweep_state['tmp_dir'] = tempfile.mkdtemp(dir=tmp_root)
 
-    return df
 
+def _run_task(args):
+    task_fn, task = args
+    return task_fn(*task)
 
-def get_jpeg2k_df(directory, write_files=False, effective_bytes=True, force_calc=False):
-    """
-    Compute and return (as Pandas DF) the rate distortion curve for JPEG 2000. The result is saved
-    as a CSV file in the source directory. If the file exists, the DF is loaded and returned.
 
-    Files are saved as JPEG using glymur.
-    """
+def _save_image(image_dir, filename, image):
+    if not os.path.isdir(image_dir):
+        os.makedirs(image_dir, exist_ok=True)
+    imageio.imwrite(os.path.join(image_dir, filename), (255 * image).astype(np.uint8))
 
-    files, _ = loading.discover_files(directory, n_images=-1, v_images=0)
-    batch_x = loading.load_images(files, directory, load='y')
-    batch_x = batch_x['y'].astype(np.float32) / (2 ** 8 - 1)
 
-    # Get trade-off for JPEG
-    quality_levels = np.arange(25, 45, 1)
-    df_jpeg_path = os.path.join(directory, 'jpeg2000.csv')
+def _measure(image, images_compressed):
+    """ Returns a list of dicts with quality metrics for successive compressed versions of an image. """
+    batch_y = np.stack(images_compressed)
+    batch_x = np.broadcast_to(image, batch_y.shape)
+    ssim_values = metrics.ssim(batch_x, batch_y, data_range=1)
+    psnr_values = metrics.psnr(batch_x, batch_y, data_range=1)
+    msssim_values = metrics.msssim(batch_x, batch_y, data_range=1)
+    return [{
+        'ssim': ssim_value,
+        'psnr': psnr_value,
+        'msssim': msssim_value,
+        'msssim_db': -10 * np.log10(1 - msssim_value)
+    } for ssim_value, psnr_value, msssim_value in zip(ssim_values, psnr_values, msssim_values)]
 
-    if os.path.isfile(df_jpeg_path) and not force_calc:
-        print('Restoring JPEG 2000 stats from {}'.format(df_jpeg_path))
-        df = pd.read_csv(df_jpeg_path, index_col=False)
-    else:
-        df = pd.DataFrame(columns=['image_id', 'filename', 'codec', 'quality', 'ssim', 'psnr', 'msssim', 'msssim_db', 'bytes', 'bpp'])
 
-        with tqdm.tqdm(total=len(files) * len(quality_levels), ncols=120, desc='JP2k') as pbar:
+def _jpeg_task(image_id, filename, quality_levels, effective_bytes, image_dir, n_threads, cache_dir=None):
+    image = _sweep_state['batch_x'][image_id]
+    rows = []
 
-            for image_id, filename in enumerate(files):
+    # Get the (cached) trade-off curve - missing quality levels are encoded in parallel
+    curve = jpeg_helpers.quality_curve(image, quality_levels, n_threads=n_threads, cache_dir=cache_dir)
 
-                # Read the original image
-                image = batch_x[image_id]
+    images_compressed = [jpeg_helpers.decompress(curve[q]['data']) for q in quality_levels]
+    msssim_values = metrics.msssim(np.broadcast_to(image, (len(quality_levels),) + image.shape), np.stack(images_compressed), data_range=1)
 
-                for qi, q in enumerate(quality_levels):
+    for q, image_compressed, msssim_value in zip(quality_levels, images_compressed, msssim_values):
 
-                    # TODO Use Glymur to save JPEG 2000 images to a temp file
-                    image_np = (255 * image.clip(0, 1)).astype(np.uint8)
-                    glymur.Jp2k('/tmp/image.jp2', data=image_np, psnr=[q])
-                    if effective_bytes:
-                        image_bytes = jpeg_helpers.jp2bytes('/tmp/image.jp2')
-                    else:
-                        image_bytes = os.path.getsize('/tmp/image.jp2')
-                    image_compressed = imageio.imread('/tmp/image.jp2').astype(np.float) / (2**8 - 1)
+        # Get effective bytes (only image data - no headers)
+        image_bytes = curve[q]['effective_bytes'] if effective_bytes else curve[q]['bytes']
 
-                    # TODO Use Pillow to save JPEG 2000 images to a memory buffer
-                    # TODO This has been disabled = their implementation seems to be invalid
-                    # with io.BytesIO() as output:
-                    #     image_pillow = PIL.Image.fromarray((255*image.clip(0, 1)).astype(np.uint8))
-                    #     image_pillow.save(output, format='jpeg2000', quality_layers=[q])
-                    #     image_compressed = imageio.imread(output.getvalue()).astype(np.float) / (2**8 - 1)
-                    #     image_bytes = len(output.getvalue())
+        if image_dir is not None:
+            _save_image(image_dir, _image_filenames['jpeg'].format(q), image_compressed)
 
-                    if write_files:
-                        image_dir = os.path.join(directory, os.path.splitext(filename)[0])
-                        if not os.path.isdir(image_dir):
-                            os.makedirs(image_dir)
+        rows.append({'image_id': image_id,
+                     'filename': filename,
+                     'codec': 'jpeg',
+                     'quality': q,
+                     'ssim': curve[q]['ssim'],
+                     'psnr': curve[q]['psnr'],
+                     'msssim': msssim_value,
+                     'msssim_db': -10 * np.log10(1 - msssim_value),
+                     'bytes': image_bytes,
+                     'bpp': 8 * image_bytes / image.shape[0] / image.shape[1]
+                     })
 
-                        image_path = os.path.join(image_dir, 'jp2_q{:.1f}dB.png'.format(q))
-                        imageio.imwrite(image_path, (255*image_compressed).astype(np.uint8))
+    return rows
 
-                    msssim_value = msssim(image, image_compressed, MAX=1).real
 
-                    df = df.append({'image_id': image_id,
-                                    'filename': filename,
-                                    'codec': 'jpeg2000',
-                                    'quality': q,
-                                    'ssim': compare_ssim(image, image_compressed, multichannel=True, data_range=1),
-                                    'psnr': compare_psnr(image, image_compressed, data_range=1),
-                                    'msssim': msssim_value,
-                                    'msssim_db': -10 * np.log10(1 - msssim_value),
-                                    'bytes': image_bytes,
-                                    'bpp': 8 * image_bytes / image.shape[0] / image.shape[1]
-                                    }, ignore_index=True)
+def _codec_task(codec_name, image_id, filename, quality_levels, effective_bytes, image_dir):
+    image = _sweep_state['batch_x'][image_id]
+    adapter = adapters.get(codec_name)
+    rows = []
 
-                    pbar.set_postfix(image_id=image_id, quality=q)
-                    pbar.update(1)
+    # All quality levels are compressed together (in a private temporary directory)
+    results = adapter.compress(image, quality_levels, effective_bytes, tmp_dir=_sweep_state['tmp_dir'])
 
-        df.to_csv(df_jpeg_path, index=False)
+    measurements = _measure(image, [image_compressed for image_compressed, _ in results])
 
-    return df
+    for q, (image_compressed, image_bytes), measurement in zip(quality_levels, results, measurements):
 
+        if image_dir is not None:
+            _save_image(image_dir, _image_filenames[codec_name].format(q), image_compressed)
 
-def get_bpg_df(directory, write_files=False, effective_bytes=True, force_calc=False):
-    """
-    Compute and return (as Pandas DF) the rate distortion curve for BPG. The result is saved
-    as a CSV file in the source directory. If the file exists, the DF is loaded and returned.
+        row = {'image_id': image_id, 'filename': filename, 'codec': codec_name, 'quality': q}
+        row.update(measurement)
+        row.update({'bytes': image_bytes, 'bpp': 8 * image_bytes / image.shape[0] / image.shape[1]})
+        rows.append(row)
 
-    The files are saved using the reference codec: https://bellard.org/bpg/
-    """
+    return rows
+
+
+def _dcn_task(model_dir, model_label, images, directory):
+    batch_x = _sweep_state['batch_x']
+    dcn = codec.restore_model(model_dir, batch_x.shape[1])
+    rows = []
+
+    # Dump compressed images
+    for image_id, filename in images:
+
+        try:
+            batch_y, image_bytes = codec.simulate_compression(batch_x[image_id:image_id + 1], dcn)
+            batch_z = dcn.compress(batch_x[image_id:image_id + 1])
+            entropy = utils.entropy(batch_z, dcn.get_codebook())
+        except Exception as e:
+            print('Error while processing {} with {} : {}'.format(filename, dcn.model_code, e))
+            raise e
+
+        if directory is not None:
+            _save_image(os.path.join(directory, os.path.splitext(filename)[0]), dcn.model_code.replace('/', '-') + '.png', batch_y[0])
+
+        row = {'image_id': image_id, 'filename': filename, 'model_dir': model_label, 'codec': dcn.model_code}
+        row.update(_measure(batch_x[image_id], batch_y)[0])
+        row.update({'entropy': entropy,
+                    'bytes': image_bytes,
+                    'bpp': 8 * image_bytes / batch_x[image_id].shape[0] / batch_x[image_id].shape[1],
+                    'layers': dcn.n_layers if 'n_layers' in dcn._h else None,
+                    'quantization': '{}-{:.0f}bpf'.format(dcn._h.rounding, dcn.latent_bpf),
+                    'entropy_reg': dcn.entropy_weight,
+                    'codebook': dcn._h.rounding,
+                    'latent': dcn.n_latent,
+                    'latent_shape': '{}x{}x{}'.format(*dcn.latent_shape[1:]),
+                    'n_features': dcn.latent_shape[-1]})
+        rows.append(row)
 
+    dcn.sess.close()
+
+    return rows
+
+
+def _codec_tasks(codec_name, files, quality_levels, writer, effective_bytes, directory):
+    """ Returns sweep tasks for '_codec_task' - one per image with all missing quality levels. """
+    tasks = []
+    for image_id, filename in enumerate(files):
+        todo = [int(q) for q in quality_levels if not writer.is_done(filename, codec_name, q)]
+        if len(todo) > 0:
+            image_dir = os.path.join(directory, os.path.splitext(filename)[0]) if directory is not None else None
+            tasks.append((codec_name, image_id, filename, todo, effective_bytes, image_dir))
+    return tasks
+
+
+def _load_sweep_images(directory):
     files, _ = loading.discover_files(directory, n_images=-1, v_images=0)
     batch_x = loading.load_images(files, directory, load='y')
-    batch_x = batch_x['y'].astypre(np.float32) / (2 ** 8 - 1)
+    return files, batch_x['y']
 
-    quality_levels = np.arange(10, 40, 1)
-    df_jpeg_path = os.path.join(directory, 'bpg.csv')
+
+def jpeg_curve_dir(directory):
+    """ Returns the directory of the persistent JPEG curve cache for a sweep (see 'jpeg_helpers.quality_curve'). """
+    return os.path.join(directory, 'jpeg_curves')
+
+
+def get_jpeg_df(directory, write_files=False, effective_bytes=True, force_calc=False, n_processes=None):
+    """
+    Compute and return (as Pandas DF) the rate distortion curve for JPEG. The result is saved
+    as a CSV file in the source directory. If the file exists, the DF is loaded and returned.
+    Interrupted computations are resumed, unless 'force_calc' is set. Images are processed in
+    parallel by 'n_processes' workers (default: number of CPUs). Trade-off curves are shared
+    with other tools (e.g., JPEG matching in test_dcn.py) via a cache next to the results (see
+    'jpeg_curve_dir').
+
+    Files are saved as JPEG using imageio.
+    """
+
+    # Get trade-off for JPEG
+    quality_levels = np.arange(95, 5, -5)
+    df_jpeg_path = os.path.join(directory, 'jpeg.csv')
 
     if os.path.isfile(df_jpeg_path) and not force_calc:
-        print('Restoring BPG stats from {}'.format(df_jpeg_path))
-        df = pd.read_csv(df_jpeg_path, index_col=False)
-    else:
-        df = pd.DataFrame(columns=['image_id', 'filename', 'codec', 'quality', 'ssim', 'psnr', 'msssim', 'msssim_db', 'bytes', 'bpp'])
+        print('Restoring JPEG stats from {}'.format(df_jpeg_path))
+        return read_table(df_jpeg_path)
 
-        with tqdm.tqdm(total=len(files) * len(quality_levels), ncols=120, desc='BPG') as pbar:
+    files, batch_x = _load_sweep_images(directory)
+    writer = ResultsWriter(df_jpeg_path, RESULTS_COLUMNS, keys=('filename', 'codec', 'quality'), resume=not force_calc)
 
-            for image_id, filename in enumerate(files):
+    # One task per image - all quality levels are encoded together (threaded only if running in the main process)
+    n_threads = None if n_processes == 1 else 1
+    tasks = []
+    for image_id, filename in enumerate(files):
+        todo = [int(q) for q in quality_levels if not writer.is_done(filename, 'jpeg', q)]
+        if len(todo) > 0:
+            image_dir = os.path.join(directory, os.path.splitext(filename)[0]) if write_files else None
+            tasks.append((image_id, filename, todo, effective_bytes, image_dir, n_threads, jpeg_curve_dir(directory)))
 
-                # Read the original image
-                image = batch_x[image_id]
+    run_sweep(tasks, _jpeg_task, writer, batch_x, 'JPEG', n_processes)
 
-                for qi, q in enumerate(quality_levels):
+    return writer.finish()
 
-                    # Compress to BPG
-                    # Save as temporary file
-                    imageio.imwrite('/tmp/image.png', (255*image).astype(np.uint8))
-                    bpp_path = bpg_helpers.bpg_compress('/tmp/image.png', q, '/tmp')
-                    image_compressed = imageio.imread(bpg_helpers.decode_bpg_to_png(bpp_path)).astype(np.float) / (2**8 - 1)
-                    
-                    if effective_bytes:
-                        bpp = bpg_helpers.bpp_of_bpg_image(bpp_path)
-                        image_bytes = round(bpp * image.shape[0] * image.shape[1] / 8)
-                    else:
-                        image_bytes = os.stat(bpp_path).st_size
-                        bpp = 8 * image_bytes / image.shape[0] / image.shape[1]
 
-                    if write_files:
-                        image_dir = os.path.join(directory, os.path.splitext(filename)[0])
-                        if not os.path.isdir(image_dir):
-                            os.makedirs(image_dir)
+def get_jpeg2k_df(directory, write_files=False, effective_bytes=True, force_calc=False, n_processes=None):
+    """
+    Compute and return (as Pandas DF) the rate distortion curve for JPEG 2000. The result is saved
+    as a CSV file in the source directory. If the file exists, the DF is loaded and returned.
+    Interrupted computations are resumed, unless 'force_calc' is set. Images are processed in
+    parallel by 'n_processes' workers (default: number of CPUs).
+
+    Files are saved as JPEG using glymur.
+    """
+
+    # Get trade-off for JPEG
+    quality_levels = np.arange(25, 45, 1)
+    df_jpeg_path = os.path.join(directory, 'jpeg2000.csv')
+
+    if os.path.isfile(df_jpeg_path) and not force_calc:
+        print('Restoring JPEG 2000 stats from {}'.format(df_jpeg_path))
+        return read_table(df_jpeg_path)
 
-                        image_path = os.path.join(image_dir, 'bpg_q{:03d}.png'.format(q))
-                        imageio.imwrite(image_path, (255 * image_compressed).astype(np.uint8))
+    files, batch_x = _load_sweep_images(directory)
+    writer = ResultsWriter(df_jpeg_path, RESULTS_COLUMNS, keys=('filename', 'codec', 'quality'), resume=not force_calc)
 
-                    msssim_value = msssim(image, image_compressed, MAX=1).real
+    tasks = _codec_tasks('jpeg2000', files, quality_levels, writer, effective_bytes, directory if write_files else None)
+    run_sweep(tasks, _codec_task, writer, batch_x, 'JP2k', n_processes)
 
-                    df = df.append({'image_id': image_id,
-                                    'filename': filename,
-                                    'codec': 'bpg',
-                                    'quality': q,
-                                    'ssim': compare_ssim(image, image_compressed, multichannel=True, data_range=1),
-                                    'psnr': compare_psnr(image, image_compressed, data_range=1),
-                                    'msssim': msssim_value,
-                                    'msssim_db': -10 * np.log10(1 - msssim_value),
-                                    'bytes': image_bytes,
-                                    'bpp': bpp
-                                    }, ignore_index=True)
+    return writer.finish()
 
-                    pbar.set_postfix(image_id=image_id, quality=q)
-                    pbar.update(1)
 
-        df.to_csv(df_jpeg_path, index=False)
+def get_bpg_df(directory, write_files=False, effective_bytes=True, force_calc=False, n_processes=None):
+    """
+    Compute and return (as Pandas DF) the rate distortion curve for BPG. The result is saved
+    as a CSV file in the source directory. If the file exists, the DF is loaded and returned.
+    Interrupted computations are resumed, unless 'force_calc' is set. Images are processed in
+    parallel by 'n_processes' workers (default: number of CPUs).
+
+    The files are saved using the reference codec: https://bellard.org/bpg/
+    """
 
-    return df
+    quality_levels = np.arange(10, 40, 1)
+    df_jpeg_path = os.path.join(directory, 'bpg.csv')
 
+    if os.path.isfile(df_jpeg_path) and not force_calc:
+        print('Restoring BPG stats from {}'.format(df_jpeg_path))
+        return read_table(df_jpeg_path)
 
-def get_dcn_df(directory, model_directory, write_files=False, force_calc=False):
+    files, batch_x = _load_sweep_images(directory)
+    writer = ResultsWriter(df_jpeg_path, RESULTS_COLUMNS, keys=('filename', 'codec', 'quality'), resume=not force_calc)
+
+    tasks = _codec_tasks('bpg', files, quality_levels, writer, effective_bytes, directory if write_files else None)
+    run_sweep(tasks, _codec_task, writer, batch_x, 'BPG', n_processes)
+
+    return writer.finish()
+
+
+def get_dcn_df(directory, model_directory, write_files=False, force_calc=False, n_processes=1):
     """
     Compute and return (as Pandas DF) the rate distortion curve for the learned DCN codec.
     The result is saved as a CSV file in the source directory. If the file exists, the DF
-    is loaded and returned.
+    is loaded and returned. Interrupted computations are resumed, unless 'force_calc' is set.
+    Models can be evaluated in parallel by 'n_processes' workers (by default, a single process
+    is used since TF already uses all cores).
     """
 
-    # Discover test files
-    files, _ = loading.discover_files(directory, n_images=-1, v_images=0)
-    batch_x = loading.load_images(files, directory, load='y')
-    batch_x = batch_x['y'].astype(np.float32) / (2 ** 8 - 1)
-
-    # Create a new table for the DCN
-    df = pd.DataFrame(
-        columns=['image_id', 'filename', 'model_dir', 'codec', 'ssim', 'psnr', 'msssim', 'msssim_db', 'entropy', 'bytes', 'bpp', 'layers', 'quantization', 'entropy_reg', 'codebook', 'latent', 'latent_shape', 'n_features'])
-
     # Discover available models
     model_dirs = list(Path(model_directory).glob('**/progress.json'))
     print('Found {} models'.format(len(model_dirs)))
@@ -255,57 +428,26 @@ def get_dcn_df(directory, model_directory, write_files=False, force_calc=False):
 
     if os.path.isfile(df_path) and not force_calc:
         print('Restoring DCN stats from {}'.format(df_path))
-        df = pd.read_csv(df_path, index_col=False)
-    else:
+        return read_table(df_path)
 
-        for model_dir in model_dirs:
-            print('Processing: {}'.format(model_dir))
-            dcn = codec.restore_model(os.path.split(str(model_dir))[0], batch_x.shape[1])
+    # Discover test files
+    files, batch_x = _load_sweep_images(directory)
+    writer = ResultsWriter(df_path, DCN_RESULTS_COLUMNS, keys=('model_dir', 'filename'), resume=not force_calc)
 
-            # Dump compressed images
-            for image_id, filename in enumerate(files):
+    # One task per model
+    tasks = []
+    for model_dir in model_dirs:
+        with open(str(model_dir)) as f:
+            scoped_name = json.load(f)['dcn']['model'].lower()
+        model_dir = os.path.split(str(model_dir))[0]
+        model_label = os.path.relpath(model_dir, model_directory).replace(scoped_name, '')
+        todo = [(image_id, filename) for image_id, filename in enumerate(files) if not writer.is_done(model_label, filename)]
+        if len(todo) > 0:
+            tasks.append((model_dir, model_label, todo, directory if write_files else None))
 
-                try:
-                    batch_y, image_bytes = codec.simulate_compression(batch_x[image_id:image_id + 1], dcn)
-                    batch_z = dcn.compress(batch_x[image_id:image_id + 1])
-                    entropy = utils.entropy(batch_z, dcn.get_codebook())
-                except Exception as e:
-                    print('Error while processing {} with {} : {}'.format(filename, dcn.model_code, e))
-                    raise e
-
-                if write_files:
-                    image_dir = os.path.join(directory, os.path.splitext(filename)[0])
-                    if not os.path.isdir(image_dir):
-                        os.makedirs(image_dir)
-
-                    image_path = os.path.join(image_dir, dcn.model_code.replace('/', '-') + '.png')
-                    imageio.imwrite(image_path, (255 * batch_y[0]).astype(np.uint8))
-
-                msssim_value = msssim(batch_x[image_id], batch_y[0], MAX=1).real
-
-                df = df.append({'image_id': image_id,
-                                'filename': filename,
-                                'model_dir': os.path.relpath(os.path.split(str(model_dir))[0], model_directory).replace(dcn.scoped_name, ''),
-                                'codec': dcn.model_code,
-                                'ssim': compare_ssim(batch_x[image_id], batch_y[0], multichannel=True, data_range=1),
-                                'psnr': compare_psnr(batch_x[image_id], batch_y[0], data_range=1),
-                                'msssim': msssim_value,
-                                'msssim_db': -10 * np.log10(1 - msssim_value),
-                                'entropy': entropy,
-                                'bytes': image_bytes,
-                                'bpp': 8 * image_bytes / batch_x[image_id].shape[0] / batch_x[image_id].shape[1],
-                                'layers': dcn.n_layers if 'n_layers' in dcn._h else None,
-                                'quantization': '{}-{:.0f}bpf'.format(dcn._h.rounding, dcn.latent_bpf),
-                                'entropy_reg': dcn.entropy_weight,
-                                'codebook': dcn._h.rounding,
-                                'latent': dcn.n_latent,
-                                'latent_shape': '{}x{}x{}'.format(*dcn.latent_shape[1:]),
-                                'n_features': dcn.latent_shape[-1]
-                                }, ignore_index=True)
-
-        df.to_csv(df_path, index=False)
-
-    return df
+    run_sweep(tasks, _dcn_task, writer, batch_x, 'DCN', n_processes)
+
+    return writer.finish()
 
 
 def load_data(plots, dirname):
@@ -331,7 +473,7 @@ def load_data(plots, dirname):
     if isinstance(plots, list):
         for filename, selectors in plots:
             labels.append(os.path.splitext(filename)[0])
-            df = pd.read_csv(os.path.join(dirname, filename), index_col=False)
+            df = read_table(os.path.join(dirname, filename))
             for k, v in selectors.items():
                 if isinstance(v, str) and '*' in v:
                     df = df[df[k].str.match(v)]
@@ -344,7 +486,7 @@ def load_data(plots, dirname):
     elif isinstance(plots, dict):
         for key, (filename, selectors) in plots.items():
             labels.append(key)
-            df = pd.read_csv(os.path.join(dirname, filename), index_col=False)
+            df = read_table(os.path.join(dirname, filename))
             for k, v in selectors.items():
                 if isinstance(v, str) and '*' in v:
                     df = df[df[k].str.match(v)]
@@ -19,7 +19,7 @@ raw_extensions = ['.nef', '.dng', '.NEF', '.DNG']
 supported_pipelines = ['libRAW', 'Python', 'INet', 'DNet', 'UNet']
 
 
-def develop_images(camera, pipeline, n_images=0, root_dir='./data', model_dir='nip', dev_dir='developed', nip_params=None):
+def develop_images(camera, pipeline, n_images=0, root_dir='./data', model_dir='nip', dev_dir='developed', nip_params=None, precision=None):
 
     if pipeline not in supported_pipelines:
         raise ValueError('Unsupported pipeline model ({})! Available models: {}'.format(pipeline, ', '.join(supported_pipelines)))
@@ -57,8 +57,13 @@ def develop_images(camera, pipeline, n_images=0, root_dir='./data', model_dir='n
     # Setup the NIP model
     if pipeline.endswith('Net'):
         sess = tf.Session()
-        model = getattr(pipelines, pipeline)(sess, tf.get_default_graph(), loss_metric='L2', **nip_params)
-        model.load_model(camera, out_directory_root=dir_models)
+        model = getattr(pipelines, pipeline)(sess, tf.get_default_graph(), loss_metric='L2', **(nip_params or {}))
+        model.load_model(os.path.join(dir_models, camera))
+
+        # Use a frozen serving graph (optionally with int8 weights calibrated on training data)
+        if precision is not None:
+            model = model.inference_model(precision, calibration={'x': calibration_batch(nip_directory, npy_filenames)})
+            print('Inference: {}'.format(model.report))
 
     # Limit the number of images
     if n_images > 0:
@@ -98,6 +103,19 @@ def develop_images(camera, pipeline, n_images=0, root_dir='./data', model_dir='n
             imageio.imwrite(out_png, rgb.astype(np.uint8))
 
 
+def calibration_batch(nip_directory, npy_filenames, n_images=4, patch_size=256):
+    """ Central crops of the first Bayer stacks - used to calibrate quantized models. """
+    import numpy as np
+
+    batch = []
+    for npy_file in npy_filenames[:n_images]:
+        bayer_stack = np.load(os.path.join(nip_directory, npy_file)).astype(np.float32) / (2**16 - 1)
+        h, w = bayer_stack.shape[0] // 2, bayer_stack.shape[1] // 2
+        batch.append(bayer_stack[h - patch_size // 2:h + patch_size // 2, w - patch_size // 2:w + patch_size // 2])
+
+    return np.stack(batch)
+
+
 def main():
     parser = argparse.ArgumentParser(description='Develops RAW images with a selected pipeline')
     parser.add_argument('--cam', dest='camera', action='store', help='camera')
@@ -112,6 +130,8 @@ def main():
     parser.add_argument('--params', dest='nip_params', default=None, help='Extra parameters for NIP constructor (JSON string)')    
     parser.add_argument('--images', dest='images', action='store', default=0, type=int,
                         help='number of images to process')
+    parser.add_argument('--precision', dest='precision', action='store', default=None, choices=['float32', 'int8'],
+                        help='use a frozen serving graph of the NIP model (float32 or int8 weight storage, computed in float32)')
 
     args = parser.parse_args()
 
@@ -128,7 +148,7 @@ def main():
         sys.exit(2)
 
     try:
-        develop_images(args.camera, args.pipeline, args.images, args.dir, args.model_dir, args.dev_dir, nip_params=args.nip_params)
+        develop_images(args.camera, args.pipeline, args.images, args.dir, args.model_dir, args.dev_dir, nip_params=args.nip_params, precision=args.precision)
     except Exception as error:
         log.error(error)
 
@@ -132,8 +132,7 @@ def compare_nips(camera, pipeline, model_a_dirname, model_b_dirname, ps=128, ima
 
 
 def compare_images_ab_ref(img_ref, img_a, img_b, labels=None):
-    from helpers import plotting
-    from skimage.measure import compare_psnr, compare_ssim
+    from helpers import plotting, metrics
 
     labels = labels or ['target', '', '']
 
@@ -146,13 +145,13 @@ def compare_images_ab_ref(img_ref, img_a, img_b, labels=None):
     plotting.quickshow(img_ref, '(T) {}'.format(labels[0]), axes=axes[0])
 
     label_a = '(A) {}: {:.1f} dB / {:.3f}'.format(labels[1],
-                                              compare_psnr(img_ref, img_a, data_range=1.0),
-                                              compare_ssim(img_ref, img_a, data_range=1.0, multichannel=True))
+                                              metrics.psnr(img_ref, img_a, data_range=1.0),
+                                              metrics.ssim(img_ref, img_a, data_range=1.0))
     plotting.quickshow(img_a, label_a, axes=axes[1])
 
     label_b = '(B) {}: {:.1f} dB / {:.3f}'.format(labels[2],
-                                              compare_psnr(img_ref, img_b, data_range=1.0),
-                                              compare_ssim(img_ref, img_b, data_range=1.0, multichannel=True))
+                                              metrics.psnr(img_ref, img_b, data_range=1.0),
+                                              metrics.ssim(img_ref, img_b, data_range=1.0))
     plotting.quickshow(img_b, label_b, axes=axes[3])
 
     # Compute and plot difference images
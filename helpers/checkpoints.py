@@ -0,0 +1,298 @@
+"""
+Resumable training state. In addition to model snapshots (see TFModel.save_model), which contain only model parameters,
+a training state includes:
+
+- all variables needed to continue optimization (model variables, optimizer slots and counters),
+- the epoch counter,
+- arbitrary (picklable) Python state of the trainer, e.g., loss buffers and performance history,
+- the state of numpy's random number generator.
+
+Sample usage:
+
+    state = checkpoints.TrainingState(sess, variables, os.path.join(out_dir, 'resume'))
+    ...
+    state.save(epoch + 1, {'performance': model.performance, ...})
+    ...
+    start_epoch, extra = state.restore()
+
+Checkpoints can also be written asynchronously (AsyncCheckpointWriter) - variables are fetched with a single sess.run
+and written to disk by a background thread, so the training loop only waits for reading the variables:
+
+    writer = checkpoints.AsyncCheckpointWriter(keep=5)
+    model.save_model(dirname, epoch, writer=writer)
+    ...
+    writer.close()
+
+Each asynchronous snapshot is written to a temporary directory and moved in place (dirname/<prefix>-<step>/) with an
+atomic rename. The standard 'checkpoint' file in dirname is updated afterwards, so tf.train.latest_checkpoint (and
+TFModel.load_model) work as usual.
+"""
+import os
+import re
+import queue
+import pickle
+import shutil
+import threading
+import numpy as np
+import tensorflow as tf
+from collections import OrderedDict
+
+_STATE_FILE = 'state.pkl'
+
+# Default number of snapshots kept by the asynchronous writer
+MAX_TO_KEEP = 5
+
+
+def optimization_variables(models, optimizers=()):
+    """
+    Collect variables needed to resume training: all variables of the models (including optimizer slots created for
+    model parameters) and all variables of the given optimizers (e.g., Adam's beta powers). Duplicates are removed.
+
+    :param models: list of TFModel instances (None entries are ignored)
+    :param optimizers: list of tf.train.Optimizer instances (None entries are ignored)
+    :return: list of variables
+    """
+    variables = OrderedDict()
+
+    for model in models:
+        if model is not None and hasattr(model, 'variables'):
+            for v in model.variables:
+                variables[v.name] = v
+
+    for optimizer in optimizers:
+        if optimizer is not None:
+            for v in optimizer.variables():
+                variables[v.name] = v
+
+    return list(variables.values())
+
+
+class TrainingState(object):
+    """
+    Saves and restores the complete state of a training session in a dedicated directory.
+    """
+
+    def __init__(self, sess, variables, dirname):
+        """
+        :param sess: TF session
+        :param variables: list of variables to be stored (see 'optimization_variables')
+        :param dirname: directory for the training state (created when needed)
+        """
+        self.sess = sess
+        self.dirname = dirname
+        self.variables = variables
+        self._saver = None
+
+    @property
+    def saver(self):
+        if self._saver is None:
+            with self.sess.graph.as_default():
+                self._saver = tf.train.Saver(self.variables, max_to_keep=1)
+        return self._saver
+
+    @property
+    def exists(self):
+        return os.path.isfile(os.path.join(self.dirname, _STATE_FILE))
+
+    def save(self, epoch, state=None, finished=False, writer=None):
+        """
+        Save the training state.
+
+        :param epoch: the next epoch to be run after resuming
+        :param state: dict with additional (picklable) state of the trainer
+        :param finished: mark the training as finished (nothing to resume)
+        :param writer: AsyncCheckpointWriter - if given, the state is written in the background (the trainer state is
+               serialized immediately, the meta-data file is replaced once the variables are on disk)
+        """
+        meta = {
+            'epoch': epoch,
+            'finished': finished,
+            'checkpoint': None,
+            'rng': np.random.get_state(),
+            'state': state or {}
+        }
+
+        if writer is not None:
+            meta['checkpoint'] = '{0}-{1}/{0}-{1}'.format('state', epoch)
+            payload = pickle.dumps(meta)
+            variables = OrderedDict((v.op.name, v) for v in self.variables)
+            writer.save(self.sess, [{'variables': variables, 'dirname': self.dirname, 'prefix': 'state', 'keep': 1,
+                                     'callback': lambda path: self._write_meta(payload)}], epoch)
+        else:
+            if not os.path.exists(self.dirname):
+                os.makedirs(self.dirname)
+
+            checkpoint = self.saver.save(self.sess, os.path.join(self.dirname, 'state'), global_step=epoch)
+            meta['checkpoint'] = os.path.basename(checkpoint)
+            self._write_meta(pickle.dumps(meta))
+
+    def _write_meta(self, payload):
+        # Write to a temporary file and swap, so an interrupted save leaves the previous state intact
+        filename = os.path.join(self.dirname, _STATE_FILE)
+        with open(filename + '.tmp', 'wb') as f:
+            f.write(payload)
+        os.replace(filename + '.tmp', filename)
+
+    def load(self):
+        """ Load the saved meta-data (epoch, finished flag, trainer state) without restoring variables. """
+        if not self.exists:
+            raise FileNotFoundError('Training state not found in {}'.format(self.dirname))
+
+        with open(os.path.join(self.dirname, _STATE_FILE), 'rb') as f:
+            return pickle.load(f)
+
+    def restore(self, restore_rng=True):
+        """
+        Restore variables (and optionally the RNG state) from the saved training state.
+
+        :param restore_rng: whether to restore the state of numpy's RNG
+        :return: tuple (epoch, trainer state)
+        """
+        meta = self.load()
+        self.saver.restore(self.sess, os.path.join(self.dirname, meta['checkpoint']))
+
+        if restore_rng:
+            np.random.set_state(meta['rng'])
+
+        return meta['epoch'], meta['state']
+
+    @property
+    def is_finished(self):
+        return self.exists and self.load()['finished']
+
+
+class AsyncCheckpointWriter(object):
+    """
+    Writes TF checkpoints in a background thread. Variable values are fetched with a single sess.run and loaded into a
+    separate writer graph (cached for each set of variables), which saves them to disk.
+    """
+
+    def __init__(self, keep=MAX_TO_KEEP, keep_every=None, max_pending=2):
+        """
+        :param keep: number of most recent snapshots to keep in each directory
+        :param keep_every: additionally keep snapshots whose step is a multiple of this number (None - disabled)
+        :param max_pending: maximum number of snapshots held in memory - saving blocks when the writer falls behind
+        """
+        self.keep = keep
+        self.keep_every = keep_every
+        self._queue = queue.Queue(max_pending)
+        self._graphs = {}
+        self._error = None
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def save(self, sess, jobs, step):
+        """
+        Snapshot variables and schedule writing.
+
+        :param sess: TF session with the variables
+        :param jobs: list of dicts with keys:
+                     variables - dict {name in checkpoint: variable}
+                     dirname   - output directory
+                     prefix    - checkpoint name prefix
+                     keep      - (optional) number of snapshots to keep (overrides the writer's setting)
+                     callback  - (optional) function called with the checkpoint path once it is written
+        :param step: global step (appended to the checkpoint name)
+        """
+        self._check()
+
+        with sess.graph.as_default():
+            values = sess.run([job['variables'] for job in jobs])
+
+        for job, job_values in zip(jobs, values):
+            self._queue.put((dict(job, variables=None), job_values, step))
+
+    def save_models(self, models, dirnames, step):
+        """ Snapshot multiple models (sharing a session) with a single sess.run (see TFModel.save_model). """
+        jobs = [{'variables': model.checkpoint_variables, 'dirname': dirname, 'prefix': model.class_name.lower()}
+                for model, dirname in zip(models, dirnames)]
+        self.save(models[0].sess, jobs, step)
+
+    def wait(self):
+        """ Wait until all pending snapshots are written. """
+        self._queue.join()
+        self._check()
+
+    def close(self):
+        """ Write pending snapshots and stop the background thread. """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._check()
+
+    def _check(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('Writing checkpoint failed: {}'.format(error))
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+
+            if item is None:
+                self._queue.task_done()
+                break
+
+            try:
+                self._write(*item)
+            except Exception as e:
+                print('WARNING Writing checkpoint failed: {}'.format(e))
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _writer_graph(self, values):
+        key = tuple((name, value.dtype.str, value.shape) for name, value in values.items())
+
+        if key not in self._graphs:
+            graph = tf.Graph()
+            with graph.as_default():
+                variables = OrderedDict((name, tf.Variable(tf.zeros(value.shape, dtype=value.dtype), trainable=False)) for name, value in values.items())
+                saver = tf.train.Saver(variables, max_to_keep=None)
+            self._graphs[key] = (tf.Session(graph=graph), variables, saver)
+
+        return self._graphs[key]
+
+    def _write(self, job, values, step):
+        dirname, prefix = job['dirname'], job['prefix']
+        name = '{}-{}'.format(prefix, step)
+
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        # Load the values into the writer graph (feeding the initial values of the variables)
+        sess, variables, saver = self._writer_graph(values)
+        sess.run([v.initializer for v in variables.values()], {v.initializer.inputs[1]: values[k] for k, v in variables.items()})
+
+        # Write into a temporary directory and swap it in place
+        tmp_dirname = os.path.join(dirname, '.{}.tmp'.format(name))
+        shutil.rmtree(tmp_dirname, ignore_errors=True)
+        saver.save(sess, os.path.join(tmp_dirname, name), write_meta_graph=False, write_state=False)
+
+        snapshot_dirname = os.path.join(dirname, name)
+        if os.path.exists(snapshot_dirname):
+            shutil.rmtree(snapshot_dirname)
+        os.rename(tmp_dirname, snapshot_dirname)
+
+        # Select snapshots to keep
+        snapshots = sorted((int(m.group(1)), m.group(0)) for m in (re.match('^{}-(\\d+)$'.format(re.escape(prefix)), f) for f in os.listdir(dirname)) if m)
+        keep = job.get('keep', self.keep)
+        kept, removed = [], []
+
+        for index, (snapshot_step, snapshot) in enumerate(snapshots):
+            if index >= len(snapshots) - keep or (self.keep_every is not None and snapshot_step % self.keep_every == 0):
+                kept.append('{0}/{0}'.format(snapshot))
+            else:
+                removed.append(snapshot)
+
+        # Point the checkpoint state (and the callback, e.g., the training state file) to the new snapshot first - old
+        # snapshots are removed afterwards, so an interruption never leaves references to deleted files
+        path = '{0}/{0}'.format(name)
+        tf.train.update_checkpoint_state(dirname, path, [p for p in kept if p != path] + [path])
+
+        if job.get('callback') is not None:
+            job['callback'](os.path.join(dirname, path))
+
+        for snapshot in removed:
+            shutil.rmtree(os.path.join(dirname, snapshot), ignore_errors=True)
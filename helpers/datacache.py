@@ -0,0 +1,148 @@
+"""
+Disk cache for decoded datasets (see helpers.dataset.IPDataset). Loaded arrays are stored as .npy files and attached
+as read-only memory-mapped arrays, so repeated experiments (and parallel workers) do not decode the same images again
+and share the data through the page cache.
+
+Entries are keyed by the dataset parameters (directory, split, seed, load mode, patch settings and the list of
+files). Least recently used entries are removed when the cache exceeds its disk budget.
+
+The default cache directory can be set with the IPDATASET_CACHE environment variable (budget in GB with
+IPDATASET_CACHE_BUDGET).
+"""
+import os
+import json
+import time
+import pickle
+import shutil
+import hashlib
+
+import numpy as np
+
+DEFAULT_CACHE_DIR = os.environ.get('IPDATASET_CACHE', None)
+DEFAULT_BUDGET = float(os.environ.get('IPDATASET_CACHE_BUDGET', 20)) * 1024 ** 3
+
+_META_FILE = 'meta.json'
+_RNG_FILE = 'rng.pkl'
+
+
+def _size(dirname):
+    return sum(entry.stat().st_size for entry in os.scandir(dirname) if entry.is_file())
+
+
+class DatasetCache(object):
+    """
+    A directory with cached datasets (one sub-directory per entry).
+    """
+
+    def __init__(self, cache_dir, budget=DEFAULT_BUDGET):
+        """
+        :param cache_dir: cache directory (created if needed)
+        :param budget: maximum size of the cache [in bytes]
+        """
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.budget = budget
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(params):
+        """ Returns a hash of the dataset parameters (dict with JSON-serializable values). """
+        return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+    def get(self, params):
+        """
+        Attach to a cached dataset.
+
+        :param params: dataset parameters (see 'key')
+        :return: tuple (data, rng_state) - data is a dict {split: {'x'/'y': memory-mapped array}} and rng_state is the
+                 state of numpy's RNG after the dataset was loaded - or None if the entry is not available
+        """
+        dirname = os.path.join(self.cache_dir, self.key(params))
+
+        if not os.path.isfile(os.path.join(dirname, _META_FILE)):
+            return None
+
+        try:
+            with open(os.path.join(dirname, _META_FILE)) as f:
+                meta = json.load(f)
+
+            data = {}
+            for split, arrays in meta['arrays'].items():
+                data[split] = {k: np.load(os.path.join(dirname, filename), mmap_mode='r') for k, filename in arrays.items()}
+
+            with open(os.path.join(dirname, _RNG_FILE), 'rb') as f:
+                rng_state = pickle.load(f)
+
+        except (IOError, ValueError, KeyError, pickle.UnpicklingError) as e:
+            print('WARNING Corrupted dataset cache entry {} - ignoring ({})'.format(dirname, e))
+            return None
+
+        # Mark as recently used
+        os.utime(dirname)
+
+        return data, rng_state
+
+    def put(self, params, data, rng_state):
+        """
+        Store a dataset in the cache. The entry is written to a temporary directory and moved in place atomically.
+
+        :param params: dataset parameters (see 'key')
+        :param data: dict {split: {'x'/'y': numpy array}}
+        :param rng_state: state of numpy's RNG after loading the dataset (np.random.get_state())
+        :return: path of the cache entry
+        """
+        key = self.key(params)
+        dirname = os.path.join(self.cache_dir, key)
+        tmp_dirname = os.path.join(self.cache_dir, '.{}-{}'.format(key, os.getpid()))
+
+        meta = {'params': params, 'created': time.time(), 'arrays': {}}
+
+        os.makedirs(tmp_dirname, exist_ok=True)
+
+        try:
+            for split, arrays in data.items():
+                meta['arrays'][split] = {}
+                for k, array in arrays.items():
+                    filename = '{}_{}.npy'.format(split, k)
+                    np.save(os.path.join(tmp_dirname, filename), array)
+                    meta['arrays'][split][k] = filename
+
+            with open(os.path.join(tmp_dirname, _RNG_FILE), 'wb') as f:
+                pickle.dump(rng_state, f)
+
+            with open(os.path.join(tmp_dirname, _META_FILE), 'w') as f:
+                json.dump(meta, f, indent=4)
+
+            os.rename(tmp_dirname, dirname)
+
+        except OSError:
+            # Another process has stored the same entry in the meantime (or the disk is full)
+            shutil.rmtree(tmp_dirname, ignore_errors=True)
+
+        self.evict(keep=key)
+
+        return dirname
+
+    def entries(self):
+        """ Returns a list of (path, size, last access time) of cache entries - sorted from the least recently used. """
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_dir() and not entry.name.startswith('.'):
+                entries.append((entry.path, _size(entry.path), entry.stat().st_mtime))
+
+        return sorted(entries, key=lambda e: e[2])
+
+    def evict(self, keep=None):
+        """ Remove least recently used entries until the cache fits in the budget (the 'keep' entry is not removed). """
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+
+        for path, size, _ in entries:
+            if total <= self.budget:
+                break
+            if os.path.basename(path) == keep:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            print('Removed dataset cache entry {} ({:.1f} MB)'.format(path, size / 1024 / 1024))
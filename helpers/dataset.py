@@ -1,10 +1,19 @@
+import os
+import hashlib
 import numpy as np
-from helpers import loading
+from helpers import loading, datacache
 
 
 class IPDataset(object):
 
-    def __init__(self, data_directory, *, randomize=2468, load='xy', n_images=120, v_images=30, val_rgb_patch_size=128, val_n_patches=1):
+    def __init__(self, data_directory, *, randomize=2468, load='xy', n_images=120, v_images=30, val_rgb_patch_size=128, val_n_patches=1, cache_dir=datacache.DEFAULT_CACHE_DIR, cache_budget=datacache.DEFAULT_BUDGET):
+        """
+        Loads training images and samples validation patches from a directory.
+
+        :param cache_dir: directory of the dataset cache (see helpers.datacache) - loaded images are stored there and
+               attached as memory-mapped arrays by subsequent instances with the same parameters (None - no caching)
+        :param cache_budget: maximum size of the cache [in bytes]
+        """
 
         if not any(load == allowed for allowed in ['xy', 'x', 'y']):
             raise ValueError('Invalid X/Y data requested!')
@@ -14,10 +23,35 @@ class IPDataset(object):
         self._data_directory = data_directory
         self.files['training'], self.files['validation'] = loading.discover_files(data_directory, randomize=randomize, n_images=n_images, v_images=v_images)
 
-        self.data = {
-            'training': loading.load_images(self.files['training'], data_directory=data_directory, load=load),
-            'validation': loading.load_patches(self.files['validation'], data_directory=data_directory, patch_size=val_rgb_patch_size // 2, n_patches=val_n_patches, load=load, discard_flat=True)
-        }
+        cache = datacache.DatasetCache(cache_dir, cache_budget) if cache_dir is not None else None
+        cached = None
+
+        if cache is not None:
+            cache_params = {
+                'directory': os.path.abspath(data_directory),
+                'files': self.files,
+                'stats': self._file_stats(data_directory, self.files['training'] + self.files['validation'], load),
+                'randomize': randomize,
+                'load': load,
+                'val_rgb_patch_size': val_rgb_patch_size,
+                'val_n_patches': val_n_patches
+            }
+            # Without shuffling, validation patches depend on the current state of the RNG
+            if not randomize:
+                cache_params['rng'] = hashlib.sha1(np.random.get_state()[1].tobytes()).hexdigest()
+            cached = cache.get(cache_params)
+
+        if cached is not None:
+            self.data, rng_state = cached
+            np.random.set_state(rng_state)
+            print('Attached to cached dataset in {}'.format(cache.cache_dir))
+        else:
+            self.data = {
+                'training': loading.load_images(self.files['training'], data_directory=data_directory, load=load),
+                'validation': loading.load_patches(self.files['validation'], data_directory=data_directory, patch_size=val_rgb_patch_size // 2, n_patches=val_n_patches, load=load, discard_flat=True)
+            }
+            if cache is not None:
+                cache.put(cache_params, self.data, np.random.get_state())
 
         if 'y' in self.data['training']:
             self.H, self.W = self.data['training']['y'].shape[1:3]
@@ -26,6 +60,17 @@ class IPDataset(object):
 
         print('Loaded dataset with {}x{} images'.format(self.W, self.H))
 
+    @staticmethod
+    def _file_stats(data_directory, files, load):
+        """ Returns (size, mtime) of the source files (keys the cache, so regenerated files are not served stale). """
+        stats = {}
+        for file in files:
+            names = ([file] if 'y' in load else []) + ([file.replace('.png', '.npy')] if 'x' in load else [])
+            for name in names:
+                info = os.stat(os.path.join(data_directory, name))
+                stats[name] = (info.st_size, info.st_mtime_ns)
+        return stats
+
     def __getitem__(self, key):
         if key in ['training', 'validation']:
             return self.data[key]
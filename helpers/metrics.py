@@ -0,0 +1,175 @@
+"""
+Batched image quality metrics (SSIM, PSNR, MS-SSIM).
+
+All functions accept either a single image (h, w, c) or a batch (n, h, w, c) and return a scalar or a vector of
+per-image values, respectively. Filtering is separable and works on float32 data. The results are consistent with the
+reference implementations used previously in the project:
+
+- ssim   - skimage.measure.compare_ssim(..., multichannel=True) [uniform 7x7 window, sample covariance]
+- psnr   - skimage.measure.compare_psnr
+- msssim - sewar.full_ref.msssim (real part) [Gaussian 11x11 window, sigma 1.5]
+
+TF variants (ssim_tf, psnr_tf) build equivalent ops for use inside a session (TF is imported lazily).
+"""
+import numpy as np
+from scipy import ndimage
+
+MSSSIM_WEIGHTS = (0.0448, 0.2856, 0.3001, 0.2363, 0.1333)
+
+
+def _as_batch(x):
+    x = np.asarray(x, dtype=np.float32)
+    if x.ndim == 2:
+        return x.reshape((1,) + x.shape + (1,)), True
+    elif x.ndim == 3:
+        return x.reshape((1,) + x.shape), True
+    elif x.ndim == 4:
+        return x, False
+    else:
+        raise ValueError('Unsupported image shape: {}! Expected (h, w, c) or (n, h, w, c)'.format(x.shape))
+
+
+def _gaussian_kernel(sigma=1.5, radius=5):
+    x = np.arange(-radius, radius + 1, dtype=np.float64)
+    kernel = np.exp(-x**2 / (2 * sigma**2))
+    return (kernel / kernel.sum()).astype(np.float32)
+
+
+def _filter(x, kernel):
+    """ Separable filtering along the spatial axes of a (n, h, w, c) batch ('valid' part is kept). """
+    if kernel is None:
+        x = ndimage.uniform_filter1d(x, 7, axis=1)
+        x = ndimage.uniform_filter1d(x, 7, axis=2)
+        crop = 3
+    else:
+        x = ndimage.correlate1d(x, kernel, axis=1)
+        x = ndimage.correlate1d(x, kernel, axis=2)
+        crop = len(kernel) // 2
+    return x[:, crop:-crop, crop:-crop, :]
+
+
+def _ssim_maps(batch_x, batch_y, data_range, kernel, sample_covariance):
+    n_pixels = 49 if kernel is None else len(kernel)**2
+    cov_norm = n_pixels / (n_pixels - 1) if sample_covariance else 1.0
+
+    ux = _filter(batch_x, kernel)
+    uy = _filter(batch_y, kernel)
+    vx = cov_norm * (_filter(batch_x * batch_x, kernel) - ux * ux)
+    vy = cov_norm * (_filter(batch_y * batch_y, kernel) - uy * uy)
+    vxy = cov_norm * (_filter(batch_x * batch_y, kernel) - ux * uy)
+
+    c1 = (0.01 * data_range) ** 2
+    c2 = (0.03 * data_range) ** 2
+
+    cs_map = (2 * vxy + c2) / (vx + vy + c2)
+    ssim_map = (2 * ux * uy + c1) / (ux * ux + uy * uy + c1) * cs_map
+    return ssim_map, cs_map
+
+
+def ssim(batch_x, batch_y, data_range=1.0, gaussian_weights=False):
+    """
+    Structural similarity (mean over all channels).
+
+    :param batch_x: reference image(s) (h, w, c) or (n, h, w, c)
+    :param batch_y: distorted image(s) of the same shape
+    :param data_range: dynamic range of the images
+    :param gaussian_weights: use a Gaussian 11x11 window (sigma 1.5) instead of a uniform 7x7 window
+    :return: scalar or a vector of per-image values
+    """
+    batch_x, single = _as_batch(batch_x)
+    batch_y, _ = _as_batch(batch_y)
+    kernel = _gaussian_kernel() if gaussian_weights else None
+    ssim_map, _ = _ssim_maps(batch_x, batch_y, data_range, kernel, True)
+    values = ssim_map.mean(axis=(1, 2, 3), dtype=np.float64)
+    return values[0] if single else values
+
+
+def mse(batch_x, batch_y):
+    """ Mean squared error - returns a scalar or a vector of per-image values. """
+    batch_x, single = _as_batch(batch_x)
+    batch_y, _ = _as_batch(batch_y)
+    values = np.mean(np.square(batch_x - batch_y), axis=(1, 2, 3), dtype=np.float64)
+    return values[0] if single else values
+
+
+def psnr(batch_x, batch_y, data_range=1.0):
+    """ Peak signal to noise ratio [dB] - returns a scalar or a vector of per-image values. """
+    with np.errstate(divide='ignore'):
+        return 10 * np.log10(data_range ** 2 / mse(batch_x, batch_y))
+
+
+def msssim(batch_x, batch_y, data_range=1.0, weights=MSSSIM_WEIGHTS):
+    """
+    Multi-scale structural similarity (real part - intermediate values are raised to fractional powers in the complex
+    domain, which may happen for negative similarities).
+
+    :param batch_x: reference image(s) (h, w, c) or (n, h, w, c)
+    :param batch_y: distorted image(s) of the same shape
+    :param data_range: dynamic range of the images
+    :param weights: weights of successive scales
+    :return: scalar or a vector of per-image values
+    """
+    batch_x, single = _as_batch(batch_x)
+    batch_y, _ = _as_batch(batch_y)
+    weights = np.array(weights, dtype=np.float64)
+    kernel = _gaussian_kernel()
+
+    mssim = np.zeros((len(batch_x), len(weights)))
+    mcs = np.zeros((len(batch_x), len(weights)))
+
+    for scale in range(len(weights)):
+        ssim_map, cs_map = _ssim_maps(batch_x, batch_y, data_range, kernel, False)
+        mssim[:, scale] = ssim_map.mean(axis=(1, 2, 3), dtype=np.float64)
+        mcs[:, scale] = cs_map.mean(axis=(1, 2, 3), dtype=np.float64)
+        # Down-sample (2x2 box filter applied also across channels, as in the reference implementation)
+        batch_x = ndimage.uniform_filter(batch_x, (1, 2, 2, 2))[:, ::2, ::2, :]
+        batch_y = ndimage.uniform_filter(batch_y, (1, 2, 2, 2))[:, ::2, ::2, :]
+
+    values = np.prod(mcs[:, :-1].astype(np.complex128) ** weights[:-1], axis=1)
+    values = (values * mssim[:, -1].astype(np.complex128) ** weights[-1]).real
+    return values[0] if single else values
+
+
+def ssim_tf(batch_x, batch_y, data_range=1.0, gaussian_weights=False):
+    """
+    TF version of 'ssim' - returns a tensor with per-image values for (n, h, w, c) input tensors.
+    """
+    import tensorflow as tf
+
+    kernel = _gaussian_kernel() if gaussian_weights else np.ones(7, dtype=np.float32) / 7
+    n_pixels = len(kernel) ** 2
+    cov_norm = n_pixels / (n_pixels - 1)
+
+    def _filter_tf(x):
+        # Treat channels as separate images and apply the separable filter ('valid' padding)
+        shape = tf.shape(x)
+        x = tf.reshape(tf.transpose(x, [0, 3, 1, 2]), [-1, shape[1], shape[2], 1])
+        x = tf.nn.conv2d(x, kernel.reshape((-1, 1, 1, 1)), [1, 1, 1, 1], 'VALID')
+        x = tf.nn.conv2d(x, kernel.reshape((1, -1, 1, 1)), [1, 1, 1, 1], 'VALID')
+        return tf.reshape(x, [shape[0], shape[3], tf.shape(x)[1], tf.shape(x)[2]])
+
+    with tf.name_scope('ssim'):
+        batch_x = tf.cast(batch_x, tf.float32)
+        batch_y = tf.cast(batch_y, tf.float32)
+        ux = _filter_tf(batch_x)
+        uy = _filter_tf(batch_y)
+        vx = cov_norm * (_filter_tf(batch_x * batch_x) - ux * ux)
+        vy = cov_norm * (_filter_tf(batch_y * batch_y) - uy * uy)
+        vxy = cov_norm * (_filter_tf(batch_x * batch_y) - ux * uy)
+
+        c1 = (0.01 * data_range) ** 2
+        c2 = (0.03 * data_range) ** 2
+
+        ssim_map = (2 * ux * uy + c1) * (2 * vxy + c2) / ((ux * ux + uy * uy + c1) * (vx + vy + c2))
+        return tf.reduce_mean(ssim_map, axis=[1, 2, 3])
+
+
+def psnr_tf(batch_x, batch_y, data_range=1.0):
+    """
+    TF version of 'psnr' - returns a tensor with per-image values for (n, h, w, c) input tensors.
+    """
+    import tensorflow as tf
+
+    with tf.name_scope('psnr'):
+        mse_value = tf.reduce_mean(tf.square(tf.cast(batch_x, tf.float32) - tf.cast(batch_y, tf.float32)), axis=[1, 2, 3])
+        return 10 * tf.log(data_range ** 2 / mse_value) / np.log(10)
@@ -0,0 +1,143 @@
+"""
+Per-stage profiling of training loops. The profiler accumulates wall time of named stages (e.g., data sampling,
+sess.run, validation, plotting, checkpointing) and records the totals for each epoch together with the memory usage
+(RSS) of the process. Every N steps, sess.run can be executed with full tracing - the step traces (tf.RunMetadata) are
+saved as Chrome trace files (chrome://tracing) and attached to TensorBoard.
+
+Sample usage:
+
+    profiler = profiling.Profiler(trace_every=1000, trace_dir=os.path.join(out_dir, 'traces'))
+    model.profiler = profiler  # TFModel.training_step goes through the profiler
+    ...
+    with profiler.stage('sampling'):
+        batch_x = data.next_training_batch(...)
+    model.training_step(batch_x, ...)
+    ...
+    profiler.end_epoch(epoch)
+    profiler.write_summaries(summary_writer, epoch)
+    json.dump({'profiling': profiler.summary(), ...})
+
+"""
+import os
+import time
+import contextlib
+from collections import OrderedDict
+
+import tensorflow as tf
+
+from helpers import coreutils
+
+STAGES = ('sampling', 'sess.run', 'validation', 'plotting', 'checkpointing')
+
+
+def memory_usage():
+    """ Returns the memory usage (RSS) of the process [in MB] - or the peak RSS if /proc is not available. """
+    try:
+        return coreutils.memory_usage_proc()
+    except IOError:
+        return coreutils.memory_usage_resource()
+
+
+class Profiler(object):
+    """
+    Accumulates wall time of training stages per epoch, tracks RSS and captures step traces on demand.
+    """
+
+    def __init__(self, trace_every=None, trace_dir=None, stages=STAGES):
+        """
+        :param trace_every: capture a full trace of every N-th profiled sess.run (None - disabled)
+        :param trace_dir: directory for Chrome trace files (None - traces are only sent to TensorBoard)
+        :param stages: names of stages reported even if they were not used in an epoch
+        """
+        self.trace_every = trace_every
+        self.trace_dir = trace_dir
+        self.step = 0
+        self.history = OrderedDict([('epoch', []), ('rss', []), ('stages', OrderedDict((s, []) for s in stages))])
+        self.traces = []
+        self._current = OrderedDict()
+        self._pending_traces = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ Context manager measuring the wall time of a stage (accumulated until the end of the epoch). """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._current[name] = self._current.get(name, 0.0) + time.perf_counter() - start
+
+    def run(self, sess, fetches, feed_dict=None):
+        """ sess.run measured as the 'sess.run' stage (with full tracing every 'trace_every' steps). """
+        self.step += 1
+
+        if self.trace_every is not None and self.step % self.trace_every == 0:
+            run_metadata = tf.RunMetadata()
+            with self.stage('sess.run'):
+                outputs = sess.run(fetches, feed_dict=feed_dict, run_metadata=run_metadata,
+                                   options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE))
+            self._save_trace(run_metadata)
+            return outputs
+
+        with self.stage('sess.run'):
+            return sess.run(fetches, feed_dict=feed_dict)
+
+    def _save_trace(self, run_metadata):
+        self._pending_traces.append((self.step, run_metadata))
+
+        if self.trace_dir is not None:
+            from tensorflow.python.client import timeline
+
+            if not os.path.exists(self.trace_dir):
+                os.makedirs(self.trace_dir)
+
+            filename = os.path.join(self.trace_dir, 'timeline_{:08d}.json'.format(self.step))
+            with open(filename, 'w') as f:
+                f.write(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format())
+            self.traces.append(filename)
+
+    def end_epoch(self, epoch):
+        """ Record stage totals & memory usage for the epoch and reset the counters. """
+        for name in self._current:
+            if name not in self.history['stages']:
+                self.history['stages'][name] = [0.0] * len(self.history['epoch'])
+
+        self.history['epoch'].append(epoch)
+        self.history['rss'].append(round(memory_usage(), 1))
+
+        for name, values in self.history['stages'].items():
+            values.append(round(self._current.get(name, 0.0), 4))
+
+        self._current = OrderedDict()
+
+    def last(self):
+        """ Returns a dict with stage times [s] from the last recorded epoch. """
+        return OrderedDict((name, values[-1]) for name, values in self.history['stages'].items() if len(values) > 0)
+
+    def summary(self):
+        """ Returns profiling history (JSON-serializable) - for progress files. """
+        output = OrderedDict(self.history)
+        output['total'] = OrderedDict((name, round(sum(values), 2)) for name, values in self.history['stages'].items())
+        output['traces'] = self.traces
+        return output
+
+    def write_summaries(self, summary_writers, epoch):
+        """
+        Write stage times & RSS from the last epoch and pending step traces to TensorBoard.
+        :param summary_writers: a tf.summary.FileWriter or a list of writers (e.g., for replicas sharing the session)
+        """
+        if not isinstance(summary_writers, (list, tuple)):
+            summary_writers = [summary_writers]
+
+        summary = tf.Summary()
+        for name, value in self.last().items():
+            summary.value.add(tag='profiling/{}'.format(name), simple_value=value)
+        if len(self.history['rss']) > 0:
+            summary.value.add(tag='profiling/rss', simple_value=self.history['rss'][-1])
+
+        for summary_writer in summary_writers:
+            summary_writer.add_summary(summary, epoch)
+            for step, run_metadata in self._pending_traces:
+                summary_writer.add_run_metadata(run_metadata, 'step_{:08d}'.format(step), epoch)
+            summary_writer.flush()
+
+        self._pending_traces = []
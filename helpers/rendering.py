@@ -0,0 +1,154 @@
+"""
+Background rendering of figures and summaries produced during training.
+
+Rendering jobs are module-level functions which receive plain data (numpy arrays, numbers, strings) and write their
+output (figures, thumbnails, TensorBoard events) to disk. They are executed in a separate process, so the training
+loop does not wait for plotting and matplotlib memory is not accumulated in the trainer. The job queue is bounded - if
+the renderer cannot keep up, new jobs are dropped.
+
+Sample usage:
+
+    with rendering.AsyncRenderer() as renderer:
+        ...
+        renderer.submit(plot_function, filename=filename, images=images)
+
+"""
+import os
+import queue
+import traceback
+import multiprocessing
+
+import numpy as np
+
+# Default number of pending jobs before new jobs are dropped
+MAX_QUEUE_SIZE = 4
+
+
+def _render_loop(job_queue):
+    # Render off-screen, before job functions get a chance to import pyplot
+    import matplotlib
+    matplotlib.use('Agg')
+
+    while True:
+        fn, kwargs = job_queue.get()
+
+        if fn is None:
+            break
+
+        try:
+            fn(**kwargs)
+        except Exception:
+            print('WARNING Rendering job {} failed:\n{}'.format(getattr(fn, '__name__', fn), traceback.format_exc()))
+
+
+class AsyncRenderer(object):
+    """
+    Executes rendering jobs in a background process with a bounded job queue. If the background process cannot be
+    started (or is disabled), jobs are rendered inline.
+    """
+
+    def __init__(self, max_queue=MAX_QUEUE_SIZE, enabled=True):
+        """
+        :param max_queue: maximum number of pending jobs - new jobs are dropped when the queue is full
+        :param enabled: set to False to render all jobs inline (in the calling process)
+        """
+        self.dropped = 0
+        self._queue = None
+        self._process = None
+
+        if enabled:
+            try:
+                context = multiprocessing.get_context('spawn')
+                self._queue = context.Queue(max_queue)
+                self._process = context.Process(target=_render_loop, args=(self._queue,), daemon=True)
+                self._process.start()
+            except (OSError, ValueError) as e:
+                print('WARNING Could not start the background renderer - rendering inline ({})'.format(e))
+                self._queue = None
+                self._process = None
+
+    @property
+    def is_async(self):
+        return self._process is not None and self._process.is_alive()
+
+    def submit(self, fn, **kwargs):
+        """
+        Schedule a rendering job: fn(**kwargs). The function needs to be defined at module level.
+        :return: True if the job was accepted (or rendered inline), False if it was dropped
+        """
+        if not self.is_async:
+            fn(**kwargs)
+            return True
+
+        try:
+            self._queue.put_nowait((fn, kwargs))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def close(self, timeout=None):
+        """ Wait for pending jobs and stop the background process. """
+        if self._process is not None:
+            if self._process.is_alive():
+                self._queue.put((None, None))
+                self._process.join(timeout)
+            if self.dropped > 0:
+                print('WARNING Background renderer dropped {} jobs (queue full)'.format(self.dropped))
+            self._queue.close()
+            self._process = None
+            self._queue = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def submit(renderer, fn, **kwargs):
+    """ Schedule a job with a given renderer or render it inline if the renderer is None. """
+    if renderer is None:
+        fn(**kwargs)
+        return True
+    return renderer.submit(fn, **kwargs)
+
+
+def to_uint8(images):
+    """ Convert images in [0, 1] to uint8 (4x less data to send to the renderer). """
+    return (255 * np.clip(images, 0, 1)).round().astype(np.uint8)
+
+
+def save_image_grid(filename, images, titles=None, n_cols=10, figwidth=20, fontsize=None, dpi=100, **kwargs):
+    """
+    Render a grid of images (with optional titles) to a file.
+
+    :param filename: output file (the directory is created if needed)
+    :param images: array of images (n, h, w, c)
+    :param titles: list of titles for successive images
+    :param n_cols: number of columns
+    :param figwidth: figure width (the height is set automatically)
+    :param fontsize: font size of the titles
+    :param dpi: resolution of the figure
+    :param kwargs: extra arguments for 'savefig'
+    """
+    import matplotlib.pyplot as plt
+    from helpers import plotting
+
+    n_cols = int(np.minimum(len(images), n_cols))
+    n_rows = int(np.ceil(len(images) / n_cols))
+    aspect = images.shape[1] / images.shape[2]
+    fig = plt.figure(figsize=(figwidth, figwidth / n_cols * n_rows * aspect))
+
+    for b in range(len(images)):
+        ax = fig.add_subplot(n_rows, n_cols, b + 1)
+        plotting.quickshow(images[b], titles[b] if titles is not None else '', axes=ax)
+        if fontsize is not None:
+            ax.title.set_fontsize(fontsize)
+
+    dirname = os.path.dirname(filename)
+    if len(dirname) > 0 and not os.path.exists(dirname):
+        os.makedirs(dirname, exist_ok=True)
+
+    fig.savefig(filename, bbox_inches='tight', dpi=dpi, **kwargs)
+    plt.close(fig)
@@ -0,0 +1,221 @@
+"""
+A simple local scheduler for experiment grids. Jobs (shell commands) are executed in parallel in a pool of worker
+processes limited by the number of available CPU cores and memory. Each job declares its CPU & memory requirements.
+
+- stdout/stderr of each job is written to a separate log file,
+- the state of all jobs is stored in a JSON file - re-running the same grid resumes it (finished jobs are skipped,
+  failed jobs are restarted),
+- jobs whose outputs already exist are skipped,
+- failed jobs are retried (up to a given number of attempts).
+
+Sample usage:
+
+    jobs = [scheduler.Job('run-{}'.format(i), ['python3', 'train_nip.py', ...], outputs=[...], cpus=4) for i in ...]
+    scheduler.LocalScheduler('./data/logs/nip', cpus=16).run(jobs)
+
+"""
+import os
+import re
+import json
+import time
+import datetime
+import subprocess
+from collections import OrderedDict
+
+
+def available_memory():
+    """ Returns the total memory [in MB] of the machine (reads MemTotal from /proc/meminfo) or None if unknown. """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f.readlines():
+                if line.startswith('MemTotal'):
+                    return float(line.split(':')[-1].split()[0]) / 1024
+    except IOError:
+        return None
+
+
+class Job(object):
+    """
+    A single experiment - a shell command with resource requirements and (optional) expected outputs.
+    """
+
+    def __init__(self, name, command, outputs=None, cpus=1, memory=0, env=None):
+        """
+        :param name: unique name of the job (used for the log file name and in the state file)
+        :param command: command to execute (list of arguments or a string executed by the shell)
+        :param outputs: list of files created by the job - the job is skipped if any of them exists
+        :param cpus: number of CPU cores needed by the job
+        :param memory: memory needed by the job [in MB]
+        :param env: additional environment variables
+        """
+        if cpus < 1:
+            raise ValueError('Invalid number of CPU cores ({}) for job {}'.format(cpus, name))
+
+        self.name = name
+        self.command = command
+        self.outputs = outputs or []
+        self.cpus = cpus
+        self.memory = memory
+        self.env = env or {}
+
+    @property
+    def is_done(self):
+        return any(os.path.exists(filename) for filename in self.outputs)
+
+    @property
+    def command_string(self):
+        return self.command if isinstance(self.command, str) else ' '.join(self.command)
+
+    @property
+    def log_name(self):
+        return '{}.log'.format(re.sub('[^a-zA-Z0-9_.+-]', '_', self.name))
+
+    def __repr__(self):
+        return 'Job({}, cpus={}, memory={})'.format(self.name, self.cpus, self.memory)
+
+
+class LocalScheduler(object):
+    """
+    Runs jobs in a pool of local worker processes with CPU and memory slots.
+    """
+
+    def __init__(self, log_dir, cpus=None, memory=None, retries=1, state_file=None, poll_interval=1.0):
+        """
+        :param log_dir: directory for job logs
+        :param cpus: number of CPU cores available for jobs (default: all cores)
+        :param memory: memory available for jobs [in MB] (default: total memory of the machine)
+        :param retries: number of times a failed job is restarted
+        :param state_file: JSON file with the state of jobs (default: 'scheduler.json' in the log directory)
+        :param poll_interval: time between checks of running jobs [s]
+        """
+        self.log_dir = log_dir
+        self.cpus = cpus or os.cpu_count() or 1
+        self.memory = memory or available_memory() or float('inf')
+        self.retries = retries
+        self.state_file = state_file or os.path.join(log_dir, 'scheduler.json')
+        self.poll_interval = poll_interval
+        self.state = OrderedDict()
+
+    def load_state(self):
+        if os.path.isfile(self.state_file):
+            with open(self.state_file) as f:
+                self.state = json.load(f, object_pairs_hook=OrderedDict)
+        return self.state
+
+    def save_state(self):
+        # Write to a temporary file and swap, so the state file is never left incomplete
+        with open(self.state_file + '.tmp', 'w') as f:
+            json.dump(self.state, f, indent=4)
+        os.replace(self.state_file + '.tmp', self.state_file)
+
+    def _update(self, job, **kwargs):
+        self.state.setdefault(job.name, OrderedDict([('command', job.command_string), ('attempts', 0)]))
+        self.state[job.name].update(kwargs)
+        self.save_state()
+
+    def _start(self, job):
+        env = dict(os.environ)
+        env.update({'OMP_NUM_THREADS': str(job.cpus), 'MKL_NUM_THREADS': str(job.cpus)})
+        env.update(job.env)
+
+        log_file = open(os.path.join(self.log_dir, job.log_name), 'a')
+        log_file.write('\n# {} : {}\n'.format(datetime.datetime.now().isoformat(), job.command_string))
+        log_file.flush()
+
+        process = subprocess.Popen(job.command, stdout=log_file, stderr=subprocess.STDOUT, env=env, shell=isinstance(job.command, str))
+
+        self._update(job, status='running', attempts=self.state.get(job.name, {}).get('attempts', 0) + 1, returncode=None,
+                     log=os.path.join(self.log_dir, job.log_name), started=datetime.datetime.now().isoformat())
+
+        return process, log_file, time.time()
+
+    def run(self, jobs, dry=False):
+        """
+        Run all jobs and wait until they finish.
+
+        :param jobs: list of jobs (instances of Job) - the order is preserved when starting jobs, but smaller jobs may
+               be started earlier if the next job does not fit in the free resources
+        :param dry: only print the jobs which would be started
+        :return: dict with job names for each final status (done, skipped, failed)
+        """
+        names = [job.name for job in jobs]
+        if len(set(names)) != len(names):
+            raise ValueError('Job names need to be unique!')
+
+        for job in jobs:
+            if job.cpus > self.cpus or job.memory > self.memory:
+                raise ValueError('Job {} requires more resources than available ({} cpus, {} MB)'.format(job.name, self.cpus, self.memory))
+
+        self.load_state()
+        summary = {'done': [], 'skipped': [], 'failed': []}
+
+        # Skip completed jobs (finished in a previous session or with existing outputs)
+        pending = []
+        for job in jobs:
+            if job.is_done or self.state.get(job.name, {}).get('status') == 'done':
+                summary['skipped'].append(job.name)
+            else:
+                pending.append(job)
+
+        print('# Scheduler: {} jobs ({} skipped) / {} cpus / {:.0f} MB -> {}'.format(len(jobs), len(summary['skipped']), self.cpus, self.memory, self.log_dir))
+
+        if dry:
+            for job in pending:
+                print('  {} : {}'.format(job.name, job.command_string))
+            return summary
+
+        if not os.path.exists(self.log_dir):
+            os.makedirs(self.log_dir)
+
+        running = {}
+        free_cpus, free_memory = self.cpus, self.memory
+
+        try:
+            while len(pending) > 0 or len(running) > 0:
+
+                # Start all jobs that fit in the free resources
+                for job in list(pending):
+                    if job.cpus <= free_cpus and job.memory <= free_memory:
+                        pending.remove(job)
+                        running[job.name] = (job,) + self._start(job)
+                        free_cpus -= job.cpus
+                        free_memory -= job.memory
+                        print('[{}] started {} (attempt {})'.format(datetime.datetime.now().strftime('%H:%M:%S'), job.name, self.state[job.name]['attempts']), flush=True)
+
+                time.sleep(self.poll_interval)
+
+                # Collect finished jobs
+                for name, (job, process, log_file, start_time) in list(running.items()):
+                    returncode = process.poll()
+                    if returncode is None:
+                        continue
+
+                    log_file.close()
+                    del running[name]
+                    free_cpus += job.cpus
+                    free_memory += job.memory
+
+                    status = 'done' if returncode == 0 else 'failed'
+                    self._update(job, status=status, returncode=returncode, duration=round(time.time() - start_time, 1))
+                    print('[{}] {} {} ({:.0f} s)'.format(datetime.datetime.now().strftime('%H:%M:%S'), status, name, time.time() - start_time), flush=True)
+
+                    if status == 'done':
+                        summary['done'].append(name)
+                    elif self.state[name]['attempts'] <= self.retries:
+                        pending.append(job)
+                    else:
+                        summary['failed'].append(name)
+
+        except KeyboardInterrupt:
+            # Stop running jobs - they will be restarted when the scheduler is run again
+            for name, (job, process, log_file, start_time) in running.items():
+                process.terminate()
+                process.wait()
+                log_file.close()
+                self._update(job, status='interrupted', returncode=process.returncode)
+            raise
+
+        if len(summary['failed']) > 0:
+            print('WARNING {} jobs failed: {}'.format(len(summary['failed']), summary['failed']))
+
+        return summary
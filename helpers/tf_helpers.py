@@ -178,7 +178,7 @@ def show_graph(graph_def=None, width=1200, height=800, max_const_size=32, ungrou
     display(HTML(iframe))
 
 
-def quantization(x, scope, name, rounding='soft', approx_steps=1, codebook_tensor=None, v=50, gamma=25):
+def quantization(x, scope, name, rounding='soft', approx_steps=1, codebook_tensor=None, v=50, gamma=25, window=None):
 
     with tf.name_scope(scope):
 
@@ -201,6 +201,20 @@ def quantization(x, scope, name, rounding='soft', approx_steps=1, codebook_tenso
         elif rounding == 'identity':
             x = x
 
+        elif rounding == 'soft-codebook' and window is not None:
+
+            # Windowed soft quantization - only the nearest code words are evaluated (see 'soft_codebook_weights')
+            weights, indices = soft_codebook_weights(x, codebook_tensor, window, v, gamma)
+            codewords = tf.gather(tf.reshape(codebook_tensor, (-1,)), indices)
+
+            soft = tf.reshape(tf.reduce_sum(weights * codewords, axis=1), tf.shape(x))
+
+            hard = tf.reduce_sum(tf.one_hot(tf.argmax(weights, axis=1), tf.shape(weights)[1]) * codewords, axis=1)
+            hard = tf.reshape(hard, tf.shape(x))
+
+            x = tf.stop_gradient(hard - soft) + soft
+            x = tf.identity(x, name=name)
+
         elif rounding == 'soft-codebook':
 
             prec_dtype = tf.float64
@@ -271,11 +285,86 @@ def nm(x):
     return w0*x + w1*slim.batch_norm(x) # the parameter "is_training" in slim.batch_norm does not seem to help so I do not use it
 
 
-def entropy(values, codebook, v=50, gamma=25):
+def soft_codebook_weights(values, codebook, window=2, v=50, gamma=25):
+    """
+    Windowed soft assignment of values to code words. Only 2 * window + 1 code words around the nearest one are
+    evaluated, so memory grows with the window size instead of the codebook size. The nearest code word is estimated
+    assuming a sorted, uniform codebook - with non-uniform (e.g., trained) codebooks the true nearest code word may
+    fall outside of the window, so use the dense variant for them. Weights are normalized in the log domain, so
+    float32 precision is sufficient.
+
+    :param values: tensor with values (flattened)
+    :param codebook: uniform codebook tensor (1, n_codewords) sorted in ascending order
+    :param window: number of neighboring code words on each side
+    :param v: degrees of freedom of the t-Student kernel (v <= 0 - Gaussian kernel)
+    :param gamma: kernel scaling
+    :return: tuple (weights (n, n_window), indices of code words (n, n_window))
+    """
+    assert (codebook.shape[0] == 1)
+    assert (codebook.shape[1] > 1)
+
+    n_codewords = int(codebook.shape[1])
+    n_window = min(2 * window + 1, n_codewords)
+
+    values = tf.reshape(values, (-1, 1))
+    codebook = tf.reshape(codebook, (-1,))
+
+    # Nearest code word & the first code word in the window (shifted at the ends of the codebook to avoid duplicates)
+    step = (codebook[-1] - codebook[0]) / (n_codewords - 1)
+    nearest = tf.cast(tf.round((values - codebook[0]) / step), tf.int32)
+    first = tf.clip_by_value(nearest - n_window // 2, 0, n_codewords - n_window)
+    indices = first + tf.range(n_window)[None, :]
+
+    dff = values - tf.gather(codebook, indices)
+
+    if v <= 0:
+        log_weights = -gamma * tf.pow(dff, 2)
+    else:
+        log_weights = -(v + 1) / 2 * tf.log1p(tf.pow(gamma * dff, 2) / v)
+
+    weights = tf.exp(log_weights - tf.reduce_logsumexp(log_weights, axis=1, keepdims=True))
+
+    return weights, indices
+
+
+def soft_histogram(weights, indices, n_codewords, n_samples=None):
+    """
+    Soft histogram of code words (scatter-add of windowed weights, see 'soft_codebook_weights').
+
+    :param weights: soft quantization weights (n, n_window)
+    :param indices: indices of code words (n, n_window)
+    :param n_codewords: size of the codebook
+    :param n_samples: compute separate histograms for n_samples equal consecutive chunks of values (None - global)
+    :return: normalized histogram (n_codewords,) or (n_samples, n_codewords)
+    """
+    if n_samples is None:
+        histogram = tf.unsorted_segment_sum(tf.reshape(weights, (-1,)), tf.reshape(indices, (-1,)), n_codewords)
+        return histogram / tf.reduce_sum(histogram)
+
+    n_values = tf.shape(weights)[0]
+    sample_ids = tf.range(n_values) // (n_values // n_samples)
+    segments = sample_ids[:, None] * n_codewords + indices
+
+    histogram = tf.unsorted_segment_sum(tf.reshape(weights, (-1,)), tf.reshape(segments, (-1,)), n_samples * n_codewords)
+    histogram = tf.reshape(histogram, (n_samples, n_codewords))
+    return histogram / tf.reduce_sum(histogram, axis=1, keepdims=True)
+
+
+def entropy(values, codebook, v=50, gamma=25, window=None):
 
     # For Gaussian, the best parameters are v=0 and gamma=5
     # for t-Student, the best parameters are v=50 and gamma=25
 
+    if window is not None:
+        # Windowed variant - returns weights for the nearest code words only (see 'soft_codebook_weights')
+        weights, indices = soft_codebook_weights(values, codebook, window, v, gamma)
+        histogram = soft_histogram(weights, indices, int(codebook.shape[1]))
+        histogram = tf.clip_by_value(histogram, 1e-9, tf.float32.max)
+        histogram = histogram / tf.reduce_sum(histogram)
+        entropy = - tf.reduce_sum(histogram * tf.log(histogram)) / 0.6931  # 0.6931 - log(2)
+
+        return entropy, histogram, (weights, indices)
+
     # t-Student degrees of freedom
     eps = 1e-72
     prec_dtype = tf.float64
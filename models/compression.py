@@ -2,7 +2,7 @@ import numpy as np
 import tensorflow as tf
 
 from models.tfmodel import TFModel
-from helpers import tf_helpers, paramspec
+from helpers import tf_helpers, paramspec, metrics
 
 
 class DCN(TFModel):
@@ -20,8 +20,11 @@ class DCN(TFModel):
                              (useful for models with batch normalization)
       scale_latent         - bool flag indicating scaling of the latent representation
       use_batchnorm        - bool flag indicating the use of batch norm in the model
+      soft_window          - evaluate soft quantization only for 2 * soft_window + 1 nearest code words (None - all;
+                             saves memory for large codebooks; requires a fixed codebook - not with train_codebook)
 
-      weights              - soft quantization weights (TF)
+      weights              - soft quantization weights (TF) - (n, n_codewords) or (n, n_window) if soft_window is set
+      weight_indices       - code words corresponding to the windowed weights (TF) or None
       histogram            - latent space histogram based on soft quantization (TF)
       entropy              - entropy estimation (TF)
 
@@ -37,7 +40,7 @@ class DCN(TFModel):
     latent_post attributes.
     """
 
-    def __init__(self, sess, graph, label=None, x=None, nip_input=None, patch_size=128, latent_bpf=4, train_codebook=False, entropy_weight=None, default_val_is_train=True, scale_latent=False, use_batchnorm=False, use_gdn=False, verbose=False, loss_metric='L2', **kwargs):
+    def __init__(self, sess, graph, label=None, x=None, nip_input=None, patch_size=128, latent_bpf=4, train_codebook=False, entropy_weight=None, default_val_is_train=True, scale_latent=False, use_batchnorm=False, use_gdn=False, verbose=False, loss_metric='L2', soft_window=None, **kwargs):
         """
         Creates a forensic analysis network.
 
@@ -55,6 +58,12 @@ class DCN(TFModel):
         if entropy_weight is not None and entropy_weight < 0:
             raise ValueError('Invalid value for entropy_weight! Valid range: >=0')
 
+        if soft_window is not None and soft_window < 1:
+            raise ValueError('Invalid value for soft_window! Valid range: >=1')
+
+        if soft_window is not None and train_codebook:
+            raise ValueError('soft_window requires a fixed (uniform) codebook - disable train_codebook!')
+
         self.verbose = verbose
         self.patch_size = patch_size
         self.nip_input = nip_input
@@ -66,6 +75,7 @@ class DCN(TFModel):
         self.use_batchnorm = use_batchnorm
         self.use_gdn = use_gdn
         self.loss_metric = loss_metric
+        self.soft_window = int(soft_window) if soft_window is not None else None
 
         with self.graph.as_default():
             # Setup inputs:
@@ -117,7 +127,11 @@ class DCN(TFModel):
 
                 # Estimate entropy of the latent representation
                 with tf.name_scope('entropy'):
-                    self.entropy, self.histogram, self.weights = tf_helpers.entropy(self.latent_pre, self._codebook)
+                    self.entropy, self.histogram, self.weights = tf_helpers.entropy(self.latent_pre, self._codebook, window=self.soft_window)
+                    self.weight_indices = None
+
+                    if self.soft_window is not None:
+                        self.weights, self.weight_indices = self.weights
 
                 # Loss and SSIM
                 self.ssim = tf.reduce_mean(tf.image.ssim(self.x, tf.clip_by_value(self.y, 0, 1), max_val=1))
@@ -190,7 +204,7 @@ class DCN(TFModel):
         # Quantize the latent representation and remember tensors before and after the process
         self.latent_pre = latent
         latent = tf_helpers.quantization(latent, '{}/quantization'.format(self.scoped_name), 'latent_quantized',
-                                         self._h.rounding, codebook_tensor=self._codebook)
+                                         self._h.rounding, codebook_tensor=self._codebook, window=self.soft_window)
         self.log('quantization with {} rounding'.format(self._h.rounding))
         self.latent_post = latent
         self.log('latent size: {} + quant:{}'.format(latent.shape, self._h.rounding))
@@ -303,6 +317,78 @@ class DCN(TFModel):
             y = self.sess.run(self.y, feed_dict)
             return y.clip(0, 1)
 
+    @property
+    def evaluation(self):
+        """
+        Per-sample evaluation ops (constructed on first use): decompressed images, loss (as in training - L2 + weighted
+        soft entropy), entropy of the quantized latent representation (as in 'utils.entropy'), PSNR and SSIM.
+        """
+        if not hasattr(self, '_evaluation') or self._evaluation is None:
+            with self.graph.as_default():
+                with tf.name_scope('{}/evaluation'.format(self.scoped_name)):
+                    n_samples = tf.shape(self.latent_pre)[0]
+                    n_codewords = 2 ** self.latent_bpf
+
+                    loss = 0.5 * tf.reduce_sum(tf.pow(self.x - self.y, 2.0), axis=[1, 2, 3])
+
+                    if self.entropy_weight is not None:
+                        if self.weight_indices is not None:
+                            histogram = tf_helpers.soft_histogram(self.weights, self.weight_indices, n_codewords, n_samples)
+                        else:
+                            histogram = tf.reduce_mean(tf.reshape(self.weights, (n_samples, -1, n_codewords)), axis=1)
+                        histogram = tf.clip_by_value(histogram, 1e-9, tf.float32.max)
+                        histogram = histogram / tf.reduce_sum(histogram, axis=1, keepdims=True)
+                        soft_entropy = - tf.reduce_sum(histogram * tf.log(histogram), axis=1) / 0.6931
+                        loss = loss + self.entropy_weight * tf.cast(soft_entropy, dtype=tf.float32)
+
+                    # Histogram of the quantized latent values (nearest code word, empty bins count as 1)
+                    latent = tf.reshape(self.latent_post, (n_samples, -1))
+                    if self.train_codebook:
+                        # Trained code books need not stay uniform - search all code words
+                        distances = tf.abs(tf.expand_dims(latent, 2) - tf.reshape(self._codebook, (1, 1, -1)))
+                        indices = tf.cast(tf.argmin(distances, axis=2), tf.int32)
+                    else:
+                        codebook = tf.reshape(self._codebook, (-1,))
+                        step = (codebook[-1] - codebook[0]) / (n_codewords - 1)
+                        indices = tf.clip_by_value(tf.cast(tf.round((latent - codebook[0]) / step), tf.int32), 0, n_codewords - 1)
+                    segments = tf.expand_dims(tf.range(n_samples), 1) * n_codewords + indices
+                    counts = tf.unsorted_segment_sum(tf.ones_like(latent), segments, n_samples * n_codewords)
+                    counts = tf.maximum(tf.reshape(counts, (n_samples, n_codewords)), 1)
+                    probs = counts / tf.reduce_sum(counts, axis=1, keepdims=True)
+                    entropy = - tf.reduce_sum(probs * tf.log(probs), axis=1) / np.log(2)
+
+                    self._evaluation = {
+                        'y': self.y,
+                        'loss': loss,
+                        'entropy': entropy,
+                        'psnr': metrics.psnr_tf(self.x, self.y),
+                        'ssim': metrics.ssim_tf(self.x, self.y)
+                    }
+        return self._evaluation
+
+    def evaluate(self, batch_x, is_training=None, direct=False, batch_size=None):
+        """
+        Process the images through the whole model and compute per-sample quality measures in a single pass.
+
+        :param batch_x: Input tensor (N, H, W, 3:rgb) or (N, H, W, 4:rggb) for RAW data chained through a NIP
+        :param is_training: can be used to override the default 'is_training' flag (may be useful for models with BN)
+        :param direct: controls whether the input is a RAW image (chained through a NIP) or direct RGB input
+        :param batch_size: process in chunks of this size (None - the whole batch at once)
+        :return: dict of numpy arrays with keys: y, loss, entropy, psnr, ssim
+        """
+        evaluation = self.evaluation
+        feed_dict = {}
+
+        if hasattr(self, 'dropout'):
+            feed_dict[self.dropout] = 1.0
+
+        if hasattr(self, 'is_training'):
+            feed_dict[self.is_training] = is_training if is_training is not None else self.default_val_is_train
+
+        inputs = {self.x if (direct or not self.use_nip_input) else self.nip_input: batch_x}
+
+        return self._run_batched(evaluation, inputs, feed_dict, batch_size)
+
     def training_step(self, batch_x, learning_rate, dropout_keep_prob=1.0):
         """
         Make a single training step and return current loss. Only the FAN model is updated.
@@ -318,7 +404,7 @@ class DCN(TFModel):
             if hasattr(self, 'is_training'):
                 feed_dict[self.is_training] = True                
             
-            _, loss, ssim, entropy = self.sess.run([self.opt, self.loss, self.ssim, self.entropy], feed_dict)
+            _, loss, ssim, entropy = self._run([self.opt, self.loss, self.ssim, self.entropy], feed_dict)
             return {
                 'loss': np.sqrt(2 * loss),  # The L2 loss in TF is computed differently (half of non-square rooted norm)
                 'ssim': ssim,
@@ -370,7 +456,8 @@ class DCN(TFModel):
             'default_val_is_train': self.default_val_is_train,
             'scale_latent': self.scale_latent,
             'use_batchnorm': self.use_batchnorm,
-            'use_gdn': self.use_gdn
+            'use_gdn': self.use_gdn,
+            'soft_window': self.soft_window
         }
 
     def get_codebook(self, bpf=None, lloyd=False):
@@ -52,7 +52,7 @@ class FAN(TFModel):
             # Setup a GT placeholder
             y = tf.placeholder(tf.int32, shape=(None,), name='y_fan')
             
-            with tf.name_scope('fan'):
+            with tf.name_scope(self.scoped_name):
                 
                 print('Building CNN for {} output classes'.format(n_classes))
                 # Basic parameters
@@ -68,7 +68,7 @@ class FAN(TFModel):
                     tf_ind = tf.constant(utils.center_mask_2dfilter(5, 3), dtype=tf.float32)
 
                     # Allocate a TF variable for the filter coefficients
-                    prefilter_kernel = tf.get_variable('fan/residual/conv_res/weights', shape=(5, 5, 3, 3), initializer=tf.constant_initializer(rf))
+                    prefilter_kernel = tf.get_variable('{}/residual/conv_res/weights'.format(self.scoped_name), shape=(5, 5, 3, 3), initializer=tf.constant_initializer(rf))
 
                     # Normalize the residual filter
                     nf = prefilter_kernel * (1 - tf_ind)
@@ -83,18 +83,18 @@ class FAN(TFModel):
 
             # Standard convolutional layers
             for conv_id in range(n_convolutions):
-                net = slim.conv2d(net, n_filters, [kernel, kernel], rate=1, activation_fn=activation, scope='fan/conv{}'.format(conv_id+1), reuse=False)
+                net = slim.conv2d(net, n_filters, [kernel, kernel], rate=1, activation_fn=activation, scope='{}/conv{}'.format(self.scoped_name, conv_id+1), reuse=False)
                 print('{}x{} conv {} shape {} + {} + 2x2 pool'.format(kernel, kernel, conv_id+1, net.shape, activation.__name__))
-                net = slim.max_pool2d(net, [2, 2], scope='fan/maxpool{}'.format(conv_id+1))
+                net = slim.max_pool2d(net, [2, 2], scope='{}/maxpool{}'.format(self.scoped_name, conv_id+1))
                 n_filters *= n_fscale
 
             # Final 1 x 1 convolution
-            net = slim.conv2d(net, n_filters // n_fscale, [1, 1], rate=1, activation_fn=activation, scope='fan/conv{}'.format(conv_id+2), reuse=False)
+            net = slim.conv2d(net, n_filters // n_fscale, [1, 1], rate=1, activation_fn=activation, scope='{}/conv{}'.format(self.scoped_name, conv_id+2), reuse=False)
             print('{}x{} conv {} shape {} + {}'.format(1, 1, conv_id+2, net.shape, activation.__name__))    
 
             # GAP / Feature formation
             print('Final conv shape', net.shape)
-            with tf.name_scope('fan/'):
+            with tf.name_scope('{}/'.format(self.scoped_name)):
                 if use_gap:
                     net = tf.reduce_mean(net, axis=(1, 2), name='gap')
                 else:
@@ -104,22 +104,22 @@ class FAN(TFModel):
                 print('Feature shape', net.shape)
 
             # Fully-connected classifier
-            net = slim.fully_connected(net, 512, activation_fn=activation, scope='fan/ff1', reuse=False)
+            net = slim.fully_connected(net, 512, activation_fn=activation, scope='{}/ff1'.format(self.scoped_name), reuse=False)
             print('fc shape: {} + {}'.format(net.shape, activation.__name__))
             if dropout > 0:
-                net = slim.dropout(net, dropout, scope='fan/dropout_ff1')
+                net = slim.dropout(net, dropout, scope='{}/dropout_ff1'.format(self.scoped_name))
                 print('{:.1f} dropout'.format(dropout))
-            net = slim.fully_connected(net, 128, activation_fn=activation, scope='fan/ff2', reuse=False)
+            net = slim.fully_connected(net, 128, activation_fn=activation, scope='{}/ff2'.format(self.scoped_name), reuse=False)
             print('fc shape: {} + {}'.format(net.shape, activation.__name__))
             if dropout > 0:
-                net = slim.dropout(net, dropout, scope='fan/dropout_ff2')
+                net = slim.dropout(net, dropout, scope='{}/dropout_ff2'.format(self.scoped_name))
                 print('{:.1f} dropout'.format(dropout))
 
             # Output layer
-            y_ = slim.fully_connected(net, n_classes, activation_fn=tf.nn.softmax, scope='fan/predictions', reuse=False)
+            y_ = slim.fully_connected(net, n_classes, activation_fn=tf.nn.softmax, scope='{}/predictions'.format(self.scoped_name), reuse=False)
             print('out shape: {} + {}'.format(y_.shape, tf.nn.softmax.__name__))
 
-            with tf.name_scope('fan_optimization'):
+            with tf.name_scope('{}_optimization'.format(self.scoped_name)):
                 loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(logits=y_, labels=y))
                 lr = tf.placeholder(tf.float32, name='fan_learning_rate')
                 adam = tf.train.AdamOptimizer(learning_rate=lr, name='adam')
@@ -186,16 +186,26 @@ class FAN(TFModel):
             })
             return np.argmax(y, axis=1), loss_value    
     
+    def training_fetches(self, batch_x, batch_y, learning_rate, all_models=False):
+        """
+        Returns fetches ([optimization op, loss]) and the feed dict of a training step - can be combined with other
+        fetches in a single sess.run (e.g., training replicas sharing a session).
+
+        :param all_models: update all relevant models (otherwise only the FAN)
+        """
+        feed_dict = {
+            self.x if not self.use_nip_input else self.nip_input: batch_x,
+            self.y: batch_y,
+            self.lr: learning_rate
+        }
+        return [self.opt if all_models else self.opt_own, self.loss], feed_dict
+
     def training_step(self, batch_x, batch_y, learning_rate):
         """
         Make a single training step and return current loss. Only the FAN model is updated.
         """
         with self.graph.as_default():
-            _, loss = self.sess.run([self.opt_own, self.loss], feed_dict={
-                    self.x if not self.use_nip_input else self.nip_input: batch_x,
-                    self.y: batch_y,
-                    self.lr: learning_rate
-                    })
+            _, loss = self._run(*self.training_fetches(batch_x, batch_y, learning_rate))
             return loss
     
     def training_step_all_models(self, batch_x, batch_y, learning_rate):
@@ -203,11 +213,7 @@ class FAN(TFModel):
         Make a single training step and return current loss. All relevant models are updated.
         """
         with self.graph.as_default():
-            _, loss = self.sess.run([self.opt, self.loss], feed_dict={
-                    self.x if not self.use_nip_input else self.nip_input: batch_x,
-                    self.y: batch_y,
-                    self.lr: learning_rate
-                    })
+            _, loss = self._run(*self.training_fetches(batch_x, batch_y, learning_rate, all_models=True))
             return loss
 
     def summary(self):
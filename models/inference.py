@@ -0,0 +1,301 @@
+"""
+Serving graphs for trained models (see TFModel.inference_model). The model is frozen (variables are converted to
+constants) and pruned to the ops needed for the requested outputs. Training switches (e.g., is_training flags of batch
+normalization, dropout rates) are bound to constants, so the runtime can fold them away.
+
+Supported precisions:
+
+- float32 - frozen graph with the original weights,
+- int8    - int8 storage of convolution / dense weights (symmetric, per output channel), which makes the serialized
+            graph (see InferenceModel.save) ~4x smaller. The clipping range is calibrated on validation data:
+            candidate percentiles of weight magnitudes are evaluated and the one with the smallest deviation from the
+            float32 outputs is used. If the quantized model does not reach the required accuracy, the float32 graph is
+            used instead.
+
+Execution always happens in float32 - the int8 weights are dequantized in the graph and the runtime folds them back to
+float32 constants, so int8 models are not faster than float32 ones. Stock TF 1.x CPU builds do not provide bfloat16 /
+int8 convolution kernels, so reduced precision execution is not supported.
+
+Sample usage:
+
+    serving = nip.inference_model('int8', calibration={'x': batch_x})
+    print(serving.report)
+    batch_y = serving.process(batch_x)
+    serving.save('./data/nip/serving.pb')
+
+"""
+import os
+import numpy as np
+import tensorflow as tf
+from collections import OrderedDict
+
+PRECISIONS = ('float32', 'int8')
+
+# Candidate percentiles of weight magnitudes used as the clipping range during calibration
+CLIP_PERCENTILES = (100, 99.99, 99.9)
+
+# Minimal PSNR [dB] of quantized outputs w.r.t. float32 outputs
+MIN_PSNR = 40
+
+# Ops with quantized weights (2nd input) and the output channel axis of their weights (MatMul uses axis 0 if the
+# weights are transposed, see 'quantize_weights')
+_WEIGHT_OPS = {
+    'Conv2D': -1,
+    'MatMul': -1,
+    'Conv2DBackpropInput': -2,
+    'DepthwiseConv2dNative': None
+}
+
+
+def freeze(model, outputs, protected=()):
+    """
+    Convert model variables to constants and extract the sub-graph needed for the given outputs.
+
+    :param model: TFModel instance
+    :param outputs: list of output tensors
+    :param protected: list of tensors which should not be removed (e.g., inputs)
+    :return: GraphDef
+    """
+    output_names = [t.op.name for t in outputs]
+
+    with model.graph.as_default():
+        graph_def = tf.graph_util.convert_variables_to_constants(model.sess, model.graph.as_graph_def(), output_names)
+
+    return tf.graph_util.remove_training_nodes(graph_def, protected_nodes=output_names + [t.op.name for t in protected])
+
+
+def quantize_array(weights, axis=-1, percentile=100):
+    """
+    Symmetric int8 quantization of an array.
+
+    :param weights: numpy array
+    :param axis: axis with output channels (separate scales) or None for a single scale
+    :param percentile: percentile of weight magnitudes used as the clipping range
+    :return: tuple (int8 array, float32 scales broadcastable to the weights)
+    """
+    weights = weights.astype(np.float32)
+
+    if axis is None:
+        axes = None
+    else:
+        axis = axis % weights.ndim
+        axes = tuple(i for i in range(weights.ndim) if i != axis)
+
+    bound = np.percentile(np.abs(weights), percentile, axis=axes, keepdims=True)
+    scale = (np.maximum(bound, 1e-12) / 127).astype(np.float32)
+    values = np.clip(np.round(weights / scale), -127, 127).astype(np.int8)
+
+    return values, scale
+
+
+def _node(op, name, inputs=(), **attrs):
+    node = tf.NodeDef()
+    node.op = op
+    node.name = name
+    node.input.extend(inputs)
+    for key, value in attrs.items():
+        node.attr[key].CopyFrom(value)
+    return node
+
+
+def _const(name, value):
+    return _node('Const', name, dtype=tf.AttrValue(type=tf.as_dtype(value.dtype).as_datatype_enum),
+                 value=tf.AttrValue(tensor=tf.make_tensor_proto(value)))
+
+
+def quantize_weights(graph_def, percentile=100):
+    """
+    Replace float32 weights of convolution / dense layers with int8 constants. The weights are dequantized in the
+    graph, so only the storage is reduced - the layers still compute in float32.
+
+    :param graph_def: frozen GraphDef (see 'freeze')
+    :param percentile: percentile of weight magnitudes used as the clipping range
+    :return: tuple (GraphDef, dict with stats - number of layers, size of weights in float32 and int8)
+    """
+    nodes = {node.name: node for node in graph_def.node}
+    weights = {}
+
+    # Find constants used as weights (possibly behind Identity ops)
+    for node in graph_def.node:
+        if node.op in _WEIGHT_OPS and len(node.input) > 1:
+            name = node.input[1].split(':')[0]
+            while name in nodes and nodes[name].op == 'Identity':
+                name = nodes[name].input[0].split(':')[0]
+            if name in nodes and nodes[name].op == 'Const' and nodes[name].attr['dtype'].type == tf.float32.as_datatype_enum:
+                if node.op == 'MatMul' and node.attr['transpose_b'].b:
+                    weights[name] = 0
+                else:
+                    weights[name] = _WEIGHT_OPS[node.op]
+
+    stats = {'layers': len(weights), 'bytes_float32': 0, 'bytes_int8': 0}
+    output = tf.GraphDef()
+    output.versions.CopyFrom(graph_def.versions)
+    float_type = tf.AttrValue(type=tf.float32.as_datatype_enum)
+
+    for node in graph_def.node:
+        if node.name not in weights:
+            output.node.extend([node])
+            continue
+
+        values, scale = quantize_array(tf.make_ndarray(node.attr['value'].tensor), weights[node.name], percentile)
+        stats['bytes_float32'] += 4 * values.size
+        stats['bytes_int8'] += values.size + 4 * scale.size
+
+        # The dequantized weights keep the name of the original constant
+        output.node.extend([
+            _const('{}/int8'.format(node.name), values),
+            _const('{}/scale'.format(node.name), scale),
+            _node('Cast', '{}/dequantize'.format(node.name), ['{}/int8'.format(node.name)],
+                  SrcT=tf.AttrValue(type=tf.int8.as_datatype_enum), DstT=float_type),
+            _node('Mul', node.name, ['{}/dequantize'.format(node.name), '{}/scale'.format(node.name)], T=float_type)
+        ])
+
+    return output, stats
+
+
+def compare(outputs, reference):
+    """ Returns a dict with PSNR (w.r.t. the peak magnitude of the reference) and the max. absolute error. """
+    psnrs, errors = [], []
+
+    for key, ref in reference.items():
+        mse = np.mean(np.square(outputs[key].astype(np.float64) - ref))
+        peak = max(np.max(np.abs(ref)), 1e-12)
+        psnrs.append(10 * np.log10(peak ** 2 / mse) if mse > 0 else np.inf)
+        errors.append(float(np.max(np.abs(outputs[key] - ref))))
+
+    return {'psnr': float(np.min(psnrs)), 'max_error': max(errors)}
+
+
+class InferenceModel(object):
+    """
+    Frozen serving graph of a TFModel with named inputs and outputs (running in a separate graph & session).
+    """
+
+    def __init__(self, model, inputs, outputs, constants=None, precision='float32', calibration=None,
+                 min_psnr=MIN_PSNR, percentiles=CLIP_PERCENTILES):
+        """
+        :param model: TFModel instance (with loaded weights)
+        :param inputs: dict {name: tensor} - tensors fed in the serving graph (placeholders or intermediate tensors)
+        :param outputs: dict {name: tensor} - fetched tensors
+        :param constants: dict {tensor: value} - tensors bound to constant values (e.g., is_training flags)
+        :param precision: 'float32' or 'int8' (int8 weight storage, float32 execution)
+        :param calibration: dict {input name: numpy array} with validation data for int8 calibration & accuracy checks
+        :param min_psnr: minimal PSNR of int8 outputs w.r.t. float32 outputs (otherwise float32 is used)
+        :param percentiles: candidate clipping percentiles for int8 calibration
+        """
+        if precision not in PRECISIONS:
+            raise ValueError('Unsupported precision: {} (available: {})'.format(precision, PRECISIONS))
+
+        self.model = model
+        self.inputs = OrderedDict(inputs)
+        self.outputs = OrderedDict(outputs)
+        self.constants = constants or {}
+        self.min_psnr = min_psnr
+        self.graph_def = freeze(model, list(self.outputs.values()), list(self.inputs.values()))
+        self.precision = 'float32'
+        self.report = {'precision': 'float32'}
+        self.sess = None
+
+        if precision == 'int8':
+            if calibration is not None:
+                self.calibrate(calibration, percentiles)
+            else:
+                print('WARNING No calibration data - using int8 weights with the full range (accuracy not checked)')
+                self._build(*quantize_weights(self.graph_def, 100))
+                self.precision = 'int8'
+                self.report['precision'] = 'int8'
+        else:
+            self._build(self.graph_def)
+            if calibration is not None:
+                self.report.update(self.check_accuracy(calibration))
+
+    def _build(self, graph_def, stats=None):
+        if self.sess is not None:
+            self.sess.close()
+
+        node_names = {node.name for node in graph_def.node}
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.x = OrderedDict((key, tf.placeholder(t.dtype, shape=t.shape, name=key)) for key, t in self.inputs.items())
+            input_map = {t.name: self.x[key] for key, t in self.inputs.items()}
+            for t, value in self.constants.items():
+                if t.op.name in node_names:
+                    input_map[t.name] = tf.constant(value, dtype=t.dtype)
+            y = tf.import_graph_def(graph_def, input_map=input_map, return_elements=[t.name for t in self.outputs.values()], name='serving')
+            self.y = OrderedDict(zip(self.outputs.keys(), y))
+
+        self.sess = tf.Session(graph=self.graph)
+        self.serving_def = graph_def
+
+        if stats is not None:
+            self.report.update(stats)
+
+    def save(self, filename):
+        """
+        Write the serving graph (frozen GraphDef with int8 or float32 weights) to a binary protobuf file.
+        :param filename: output filename (e.g., serving.pb)
+        :return: size of the file in bytes
+        """
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        with open(filename, 'wb') as f:
+            f.write(self.serving_def.SerializeToString())
+
+        return os.path.getsize(filename)
+
+    def run(self, feeds):
+        """
+        Run the serving graph.
+        :param feeds: dict {input name: numpy array}
+        :return: dict {output name: numpy array}
+        """
+        return self.sess.run(dict(self.y), {self.x[key]: value for key, value in feeds.items()})
+
+    def process(self, batch_x):
+        """ Run a model with a single input and output (a single image is expanded to a batch). """
+        if batch_x.ndim == 3:
+            batch_x = np.expand_dims(batch_x, 0)
+        return self.run({next(iter(self.x.keys())): batch_x})[next(iter(self.y.keys()))]
+
+    def reference(self, feeds):
+        """ Run the original (float32) model on the same inputs. """
+        feed_dict = {self.inputs[key]: value for key, value in feeds.items()}
+        feed_dict.update(self.constants)
+        return self.model.sess.run(dict(self.outputs), feed_dict)
+
+    def check_accuracy(self, feeds):
+        """ Compare outputs of the serving graph with the original model (see 'compare'). """
+        return compare(self.run(feeds), self.reference(feeds))
+
+    def calibrate(self, feeds, percentiles=CLIP_PERCENTILES):
+        """
+        Choose the clipping range of int8 weights which minimizes the deviation from float32 outputs on the given
+        data. Falls back to float32 if the required accuracy is not reached.
+
+        :param feeds: dict {input name: numpy array} with validation data
+        :param percentiles: candidate clipping percentiles
+        """
+        reference = self.reference(feeds)
+        results = []
+
+        for percentile in percentiles:
+            graph_def, stats = quantize_weights(self.graph_def, percentile)
+            self._build(graph_def)
+            results.append((compare(self.run(feeds), reference), percentile, graph_def, stats))
+
+        accuracy, percentile, graph_def, stats = max(results, key=lambda r: r[0]['psnr'])
+
+        if accuracy['psnr'] < self.min_psnr:
+            print('WARNING int8 model too inaccurate (PSNR {:.1f} < {:.1f} dB) - falling back to float32'.format(accuracy['psnr'], self.min_psnr))
+            self._build(self.graph_def)
+            self.precision = 'float32'
+            self.report = dict(precision='float32', int8_psnr=accuracy['psnr'])
+        else:
+            self._build(graph_def, stats)
+            self.precision = 'int8'
+            self.report.update(accuracy, precision='int8', percentile=percentile)
+
+        return self.report
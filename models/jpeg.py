@@ -1,7 +1,35 @@
+import numpy as np
 import tensorflow as tf
 from helpers.utils import jpeg_qtable
 from helpers import tf_helpers
 
+# DCT transformation matrix
+dct_F = np.array([[0.3536, 0.3536, 0.3536, 0.3536, 0.3536, 0.3536, 0.3536, 0.3536],
+                  [0.4904, 0.4157, 0.2778, 0.0975, -0.0975, -0.2778, -0.4157, -0.4904],
+                  [0.4619, 0.1913, -0.1913, -0.4619, -0.4619, -0.1913, 0.1913, 0.4619],
+                  [0.4157, -0.0975, -0.4904, -0.2778, 0.2778, 0.4904, 0.0975, -0.4157],
+                  [0.3536, -0.3536, -0.3536, 0.3536, 0.3536, -0.3536, -0.3536, 0.3536],
+                  [0.2778, -0.4904, 0.0975, 0.4157, -0.4157, -0.0975, 0.4904, -0.2778],
+                  [0.1913, -0.4619, 0.4619, -0.1913, -0.1913, 0.4619, -0.4619, 0.1913],
+                  [0.0975, -0.2778, 0.4157, -0.4904, 0.4904, -0.4157, 0.2778, -0.0975]], dtype=np.float32)
+
+
+def jpeg_qtables(quality):
+    """
+    Generate (in the graph) DCT quantization tables for a vector of quality levels - see 'helpers.utils.jpeg_qtable'.
+    :param quality: TF tensor with quality levels (n,)
+    :return: TF tensor with quantization tables for the Y, Cb, Cr channels (n, 3, 64)
+    """
+    with tf.name_scope('qtables'):
+        quality = tf.clip_by_value(tf.cast(quality, tf.float32), 1, 100)
+        scale = tf.where(quality < 50, 5000 / quality, 200 - 2 * quality)
+
+        # Standard tables (for quality 50 the scaling factor is 100)
+        t = np.stack([jpeg_qtable(50, c).reshape((-1,)) for c in (0, 1, 1)])
+        t = tf.floor((tf.constant(t) * tf.reshape(scale, [-1, 1, 1]) + 50) / 100)
+
+        return tf.clip_by_value(t, 1, 255)
+
 
 class DJPG:
     """
@@ -17,6 +45,7 @@ class DJPG:
 
             jpg = DJPG()
             batch_y = jpg.process(batch_x, quality=50)
+            batch_y = jpg.process(batch_x, quality=[10, 50, 90])  # one quality level per image
             
         Sample usage (plugged in after a NIP model):
             
@@ -29,7 +58,8 @@ class DJPG:
         :param graph: TF graph or None (creates a new one)
         :param x: input to the DJPG module (TF tensor) or None (creates a placeholder)
         :param nip_input: input to the NIP (if part of a larger model) or None
-        :param quality: JPEG quality level or None (can be specified later)
+        :param quality: JPEG quality level, a TF tensor with per-sample quality levels (n,), or None (specified later,
+                        possibly separately for each image)
         :param rounding_approximation: None (uses normal rounding), 'sin', 'soft', or 'harmonic'
         :param rounding_approximation_steps: number of approximation terms (for 'harmonic' approx. only)
         """
@@ -41,7 +71,7 @@ class DJPG:
         # Remember settings
         self.rounding_approximation = rounding_approximation
         self.rounding_approximation_steps = rounding_approximation_steps
-        self.init_quality = quality
+        self.init_quality = quality if not isinstance(quality, tf.Tensor) else 'per-sample'
         block_size = 8
 
         # Configure TF objects
@@ -66,74 +96,48 @@ class DJPG:
                     ycbcr = tf.nn.conv2d(xc, tf.reshape(tf.transpose(color_F), [1, 1, 4, 3]), [1, 1, 1, 1], 'SAME', name='jpeg_ycbcr')
     
                 with tf.name_scope('blocking'):
-                    # Re-organize to get non-overlapping blocks in the following form
-                    # (n_examples * 3, block_size, block_size, n_blocks)
-                    p = tf.transpose(ycbcr - 127, [0, 3, 1, 2])
-                    p = tf.reshape(p, [-1, tf.shape(p)[2], tf.shape(p)[3]])
-                    p = tf.expand_dims(p, axis=3)
-                    p = tf.space_to_depth(p, block_size)
-                    p = tf.transpose(p, [0, 3, 1, 2])
-                    p = tf.reshape(p, [-1, block_size, block_size, tf.shape(p)[2] * tf.shape(p)[3]])
-
-                    # Reorganize to move n_blocks to the first dimension
-                    r = tf.transpose(p, [0, 3, 1, 2])
-                    r = tf.reshape(r, [-1, r.shape[2], r.shape[3]])
-    
-                # Forward DCT transform
+                    # Re-organize to get non-overlapping blocks with flattened pixels in the last dimension:
+                    # (n_examples, blocks_h, blocks_w, 3, block_size * block_size)
+                    n_blocks = tf.shape(x)[1] // block_size, tf.shape(x)[2] // block_size
+                    p = tf.space_to_depth(ycbcr - 127, block_size)
+                    p = tf.reshape(p, [-1, n_blocks[0], n_blocks[1], block_size * block_size, 3])
+                    p = tf.transpose(p, [0, 1, 2, 4, 3])
+
+                # Forward DCT transform - a single matrix multiplication with the 2-D DCT basis (64 x 64)
                 with tf.name_scope('dct'):
-                    # DCT transformation matrix
-                    dct_F = tf.constant([[0.3536, 0.3536, 0.3536, 0.3536, 0.3536, 0.3536, 0.3536, 0.3536],
-                                         [0.4904, 0.4157, 0.2778, 0.0975, -0.0975, -0.2778, -0.4157, -0.4904],
-                                         [0.4619, 0.1913, -0.1913, -0.4619, -0.4619, -0.1913, 0.1913, 0.4619],
-                                         [0.4157, -0.0975, -0.4904, -0.2778, 0.2778, 0.4904, 0.0975, -0.4157],
-                                         [0.3536, -0.3536, -0.3536, 0.3536, 0.3536, -0.3536, -0.3536, 0.3536],
-                                         [0.2778, -0.4904, 0.0975, 0.4157, -0.4157, -0.0975, 0.4904, -0.2778],
-                                         [0.1913, -0.4619, 0.4619, -0.1913, -0.1913, 0.4619, -0.4619, 0.1913],
-                                         [0.0975, -0.2778, 0.4157, -0.4904, 0.4904, -0.4157, 0.2778, -0.0975]])
-                    dct_I = tf.transpose(dct_F)                    
-                
-                    Xi = tf.matmul(tf.tile(tf.expand_dims(dct_F, axis=0), [tf.shape(r)[0], 1, 1]), r)
-                    X = tf.matmul(Xi, tf.tile(tf.expand_dims(dct_I, axis=0), [tf.shape(r)[0], 1, 1]), name='jpeg_dct')
-    
+                    dct_K = tf.constant(np.kron(dct_F, dct_F), dtype=tf.float32)
+                    X = tf.matmul(tf.reshape(p, [-1, block_size * block_size]), dct_K, transpose_b=True)
+                    X = tf.reshape(X, tf.shape(p), name='jpeg_dct')
+
                 # Approximate quantization
                 with tf.name_scope('quantization'):
-                    # JPEG Quantization tables
-                    if quality is None:
-                        Q_mtx_lum = tf.placeholder(tf.float32, (8, 8))
-                        Q_mtx_chr = tf.placeholder(tf.float32, (8, 8))
+                    # JPEG Quantization tables for successive channels (Y, Cb, Cr) - broadcast over images and blocks
+                    if quality is None or isinstance(quality, tf.Tensor):
+                        # Per-sample quality levels - tables generated in the graph: (n_examples, 1, 1, 3, 64)
+                        if quality is None:
+                            quality = tf.placeholder(tf.float32, (None,), name='jpeg_quality')
+                        Q = tf.reshape(jpeg_qtables(quality), [-1, 1, 1, 3, block_size * block_size])
                     else:
-                        Q_mtx_lum = tf.constant(jpeg_qtable(quality, 0))
-                        Q_mtx_chr = tf.constant(jpeg_qtable(quality, 1))
-    
-                    # Tile quantization values for successive channels: 
-                    # image_0 [R .. R G .. G B .. B] ... image_N [R .. R G .. G B .. B]
-                    Ql = tf.tile(tf.expand_dims(Q_mtx_lum, axis=0), [1 * (tf.shape(p)[-1]), 1, 1])
-                    Qc = tf.tile(tf.expand_dims(Q_mtx_chr, axis=0), [2 * (tf.shape(p)[-1]), 1, 1])
-                    Q = tf.concat((Ql, Qc), axis=0)
-                    Q = tf.tile(Q, [(tf.shape(x)[0]), 1, 1])
+                        Ql = tf.constant(jpeg_qtable(quality, 0).reshape((1, -1)))
+                        Qc = tf.constant(jpeg_qtable(quality, 1).reshape((1, -1)))
+                        Q = tf.concat((Ql, Qc, Qc), axis=0)
+
                     X = X / Q
                     X = tf_helpers.quantization(X, 'quantization', 'dct_coeff_quantized', rounding_approximation, rounding_approximation_steps)
                     X = X * Q
-    
+
                 with tf.name_scope('idct'):
                     # Inverse DCT transform
-                    xi = tf.matmul(tf.tile(tf.expand_dims(dct_I, axis=0), [tf.shape(r)[0], 1, 1]), X)
-                    xi = tf.matmul(xi, tf.tile(tf.expand_dims(dct_F, axis=0), [tf.shape(r)[0], 1, 1]))
-    
-                with tf.name_scope('rev-blocking'):
-                    # Reorganize data back to
-                    xi = tf.reshape(xi, [3 * tf.shape(x)[0], -1, xi.shape[1], xi.shape[2]])
-                    xi = tf.transpose(xi, [0, 2, 3, 1])
+                    xi = tf.matmul(tf.reshape(X, [-1, block_size * block_size]), dct_K)
+                    xi = tf.reshape(xi, tf.shape(p))
 
+                with tf.name_scope('rev-blocking'):
                     # Backward re-organization from blocks
-                    # (n_examples * 3, block, block, n_blocks) -> (n_examples, w, h, 3)
-                    q = tf.reshape(xi, [-1, tf.shape(xi)[1] * tf.shape(xi)[2], tf.shape(x)[1] // block_size,
-                                        tf.shape(x)[2] // block_size])
-                    q = tf.transpose(q, [0, 2, 3, 1])
+                    # (n_examples, blocks_h, blocks_w, 3, block_size * block_size) -> (n_examples, w, h, 3)
+                    q = tf.transpose(xi, [0, 1, 2, 4, 3])
+                    q = tf.reshape(q, [-1, n_blocks[0], n_blocks[1], 3 * block_size * block_size])
                     q = tf.depth_to_space(q, block_size)
-                    q = tf.reshape(q, [-1, 3, tf.shape(q)[1], tf.shape(q)[2]])
-                    q = tf.transpose(q, [0, 2, 3, 1])
-    
+
                 # Color conversion (YCbCr-> RGB)
                 with tf.name_scope('ycbcr_to_rgb'):
                     qc = tf.pad(q + 127, [[0, 0], [0, 0], [0, 0], [1, 0]], 'CONSTANT', constant_values=1)
@@ -144,22 +148,26 @@ class DJPG:
         self.x = x
         self.y = y
         self.nip_input = nip_input
-        self.Q_mtx_lum = Q_mtx_lum
-        self.Q_mtx_chr = Q_mtx_chr
+        self.quality = quality if isinstance(quality, tf.Tensor) else None
 
     def process(self, batch_x, quality=None):
+        """
+        Compress a batch of images.
+        :param batch_x: numpy array (n, h, w, 3)
+        :param quality: quality level or a sequence of quality levels (one per image); needed if not fixed in the model
+        """
         with self.graph.as_default():
-            if quality is None:
-                y = self.sess.run(self.y, feed_dict={
-                    self.x if not self.use_nip_input else self.nip_input: batch_x,
-                })
-            else:
-                y = self.sess.run(self.y, feed_dict={
-                    self.x if not self.use_nip_input else self.nip_input: batch_x,
-                    self.Q_mtx_lum: jpeg_qtable(quality, 0),
-                    self.Q_mtx_chr: jpeg_qtable(quality, 1)
-                })
-            return y
+            feed_dict = {self.x if not self.use_nip_input else self.nip_input: batch_x}
+
+            if quality is not None:
+                if self.quality is None or self.quality.op.type != 'Placeholder':
+                    raise ValueError('The quality level is fixed in this model ({})!'.format(self.init_quality))
+                feed_dict[self.quality] = np.broadcast_to(np.asarray(quality, dtype=np.float32), (len(batch_x),))
+
+            elif self.quality is not None and self.quality.op.type == 'Placeholder':
+                raise ValueError('The quality level needs to be specified!')
+
+            return self.sess.run(self.y, feed_dict=feed_dict)
 
     def __repr__(self):
         if self.rounding_approximation == 'harmonic':
@@ -7,6 +7,7 @@ import tensorflow.contrib.slim as slim
 from models.tfmodel import TFModel
 from helpers.utils import upsampling_kernel, bilin_kernel, gamma_kernels
 from helpers.tf_helpers import lrelu, upsample_and_concat
+from helpers import metrics
 
 
 class NIPModel(TFModel):
@@ -101,7 +102,7 @@ class NIPModel(TFModel):
             if hasattr(self, 'is_training'):
                 feed_dict[self.is_training] = True
                 
-            _, loss = self.sess.run([self.opt, self.loss], feed_dict=feed_dict)
+            _, loss = self._run([self.opt, self.loss], feed_dict=feed_dict)
             return loss
         
     def process(self, batch_x, is_training=False):
@@ -118,7 +119,54 @@ class NIPModel(TFModel):
 
             y = self.sess.run(self.y, feed_dict=feed_dict)
             return y
-    
+
+    @property
+    def evaluation(self):
+        """
+        Per-sample evaluation ops (constructed on first use): developed images, loss (w.r.t. the model's loss metric,
+        computed on clipped output), PSNR and SSIM.
+        """
+        if not hasattr(self, '_evaluation') or self._evaluation is None:
+            with self.graph.as_default():
+                with tf.name_scope('{}/evaluation'.format(self.scoped_name)):
+                    self._ssim_data_range = tf.placeholder_with_default(1.0, shape=(), name='ssim_data_range')
+
+                    if self.loss_metric == 'L2':
+                        loss = tf.reduce_mean(tf.pow(255.0*self.y - 255.0*self.y_gt, 2.0), axis=[1, 2, 3])
+                    elif self.loss_metric == 'L1':
+                        loss = tf.reduce_mean(tf.abs(255.0*self.y - 255.0*self.y_gt), axis=[1, 2, 3])
+                    else:
+                        loss = 255 * (1 - tf.image.ssim_multiscale(self.y, self.y_gt, 1.0))
+
+                    self._evaluation = {
+                        'y': self.y,
+                        'loss': loss,
+                        'psnr': metrics.psnr_tf(self.y_gt, self.y),
+                        'ssim': metrics.ssim_tf(self.y_gt, self.y, self._ssim_data_range)
+                    }
+        return self._evaluation
+
+    def evaluate(self, batch_x, batch_y, batch_size=None, ssim_data_range=1.0):
+        """
+        Develop RAW input and compute per-sample quality measures w.r.t. the target RGB images in a single pass.
+
+        :param batch_x: RAW input (N, H, W, 4)
+        :param batch_y: target RGB images (N, 2H, 2W, 3)
+        :param batch_size: process in chunks of this size (None - the whole batch at once)
+        :param ssim_data_range: dynamic range assumed for SSIM computation
+        :return: dict of numpy arrays with keys: y, loss, psnr, ssim
+        """
+        evaluation = self.evaluation
+        feed_dict = {self._ssim_data_range: ssim_data_range}
+        if hasattr(self, 'is_training'):
+            feed_dict[self.is_training] = False
+
+        inputs = {self.x: batch_x}
+        if self.y_gt is not self.x:
+            inputs[self.y_gt] = batch_y
+
+        return self._run_batched(evaluation, inputs, feed_dict, batch_size)
+
     def reset_performance_stats(self):
         self.performance = {
             'loss': {'training': [], 'validation': []},
@@ -1,6 +1,5 @@
 import os
 import tensorflow as tf
-import tensorflow.contrib.slim as slim
 import numpy as np
 from collections import OrderedDict
 
@@ -19,6 +18,9 @@ class TFModel(object):
     - class_name              - convenience method to access class name
     - scoped_name             - class name (lower case) [+ postfix label] (e.g., unet / unet_a / fan)
                                 used as a prefix for TF variables & as a directory name for storing models
+    - checkpoint_name         - class name (lower case) without the label - used as a variable prefix in checkpoints,
+                                so models trained with a label (e.g., replicas in a shared graph) can be restored
+                                without it (and vice versa)
     """
 
     def __init__(self, sess, graph, label, **kwargs):        
@@ -28,6 +30,7 @@ class TFModel(object):
         self.is_initialized = False
         self._saver = None
         self._summary_writer = None
+        self.profiler = None
         self.reset_performance_stats()        
 
     def reset_performance_stats(self):
@@ -78,10 +81,20 @@ class TFModel(object):
     def saver(self):
         if not hasattr(self, '_saver') or self._saver is None:
             with self.graph.as_default():
-                self._saver = tf.train.Saver(self.parameters, max_to_keep=5)
+                self._saver = tf.train.Saver(self.checkpoint_variables, max_to_keep=5)
         return self._saver
 
-    def save_model(self, dirname, epoch=0):
+    def save_model(self, dirname, epoch=0, writer=None):
+        """
+        Save model parameters to a checkpoint.
+
+        :param dirname: output directory
+        :param epoch: global step appended to the checkpoint name
+        :param writer: helpers.checkpoints.AsyncCheckpointWriter - if given, the parameters are written in the background
+        """
+        if writer is not None:
+            writer.save_models([self], [dirname], epoch)
+            return
 
         if not os.path.exists(dirname):
             os.makedirs(dirname)
@@ -91,27 +104,119 @@ class TFModel(object):
 
     def load_model(self, dirname):
 
-        self.init()
-
         # Try to load the model from the given directory
         latest_checkpoint = tf.train.latest_checkpoint(dirname)
 
-        # If no model available, append current model's scoped name
-        if latest_checkpoint is None:
-            dirname = os.path.join(dirname, self.scoped_name)
-            latest_checkpoint = tf.train.latest_checkpoint(dirname)
+        # If no model available, append current model's scoped name (or the name without the label)
+        for name in [self.scoped_name, self.checkpoint_name]:
+            if latest_checkpoint is None:
+                latest_checkpoint = tf.train.latest_checkpoint(os.path.join(dirname, name))
 
         if latest_checkpoint is None:
             raise RuntimeError('Model checkpoint not found at {}'.format(dirname))
 
-        with self.graph.as_default():
-            # Use the slim package to load the checkpoint - this gives a chance to ignore missing variables
-            init_assign_op, init_feed_dict = slim.assign_from_checkpoint(latest_checkpoint, self.parameters, ignore_missing_vars=True)
-            self.sess.run(init_assign_op, feed_dict=init_feed_dict)
+        self.restore_checkpoint(latest_checkpoint)
+
+    @property
+    def restore_ops(self):
+        """ Assign ops (fed from placeholders) for all checkpoint variables - created once, reused by every restore """
+        if not hasattr(self, '_restore_ops') or self._restore_ops is None:
+            with self.graph.as_default():
+                self._restore_ops = OrderedDict()
+                with tf.name_scope('{}_restore'.format(self.scoped_name)):
+                    for name, var in self.checkpoint_variables.items():
+                        value = tf.placeholder(var.dtype.base_dtype, shape=var.shape)
+                        self._restore_ops[name] = (var, value, tf.assign(var, value))
+        return self._restore_ops
+
+    def restore_checkpoint(self, checkpoint):
+        """
+        Restore model variables from a checkpoint. Tensors are read in bulk with a checkpoint reader and assigned with a
+        single sess.run. Variables missing in the checkpoint (and other model variables, e.g., optimizer slots) are
+        initialized. The graph does not grow when models are restored repeatedly.
+
+        :param checkpoint: checkpoint path (prefix)
+        """
+        reader = tf.train.NewCheckpointReader(checkpoint)
+        shapes = reader.get_variable_to_shape_map()
+
+        assign_ops, feed_dict, restored = [], {}, set()
+
+        for name, (var, value, assign_op) in self.restore_ops.items():
+            if name not in shapes:
+                continue
+
+            if tuple(shapes[name]) != tuple(var.shape.as_list()):
+                raise ValueError('Shape mismatch for {}: checkpoint {} vs model {}'.format(name, shapes[name], var.shape.as_list()))
+
+            assign_ops.append(assign_op)
+            feed_dict[value] = reader.get_tensor(name)
+            restored.add(var)
+
+        # Initialize only the variables which are not restored
+        initializers = [var.initializer for var in self.variables if var not in restored]
+
+        self.sess.run(assign_ops + initializers, feed_dict=feed_dict)
 
         self.is_initialized = True
+        self._summary_writer = None
         self.reset_performance_stats()
 
+    def inference_model(self, precision='float32', inputs=None, outputs=None, calibration=None, **kwargs):
+        """
+        Build a frozen serving graph of the model (see models.inference). Training switches (is_training, dropout) are
+        bound to their inference values.
+
+        :param precision: 'float32' or 'int8' (post-training quantization of weights)
+        :param inputs: dict {name: tensor} with inputs (default: {'x': self.x})
+        :param outputs: dict {name: tensor} with outputs (default: {'y': self.y})
+        :param calibration: dict {input name: numpy array} with validation data (int8 calibration and accuracy check)
+        :param kwargs: additional arguments for InferenceModel (min_psnr, percentiles)
+        :return: InferenceModel instance
+        """
+        from models import inference
+
+        constants = {}
+        if hasattr(self, 'is_training'):
+            constants[self.is_training] = getattr(self, 'default_val_is_train', False)
+        if hasattr(self, 'dropout'):
+            constants[self.dropout] = 1.0
+
+        return inference.InferenceModel(self, inputs or {'x': self.x}, outputs or {'y': self.y}, constants, precision, calibration, **kwargs)
+
+    def _run(self, fetches, feed_dict=None):
+        """ sess.run measured by the model's profiler (if set, see helpers.profiling) """
+        if getattr(self, 'profiler', None) is None:
+            return self.sess.run(fetches, feed_dict=feed_dict)
+        return self.profiler.run(self.sess, fetches, feed_dict)
+
+    def _run_batched(self, fetches, inputs, feed_dict=None, batch_size=None):
+        """
+        Run a dictionary of per-sample tensors on consecutive chunks of the inputs and concatenate the results.
+
+        :param fetches: dict of tensors with the batch as the first dimension
+        :param inputs: dict {tensor: numpy array} with inputs to be split into chunks
+        :param feed_dict: additional feeds shared by all chunks
+        :param batch_size: chunk size (None - everything in a single run)
+        :return: dict of numpy arrays
+        """
+        n_samples = len(next(iter(inputs.values())))
+
+        if n_samples == 0:
+            raise ValueError('Empty input batch!')
+
+        batch_size = batch_size or n_samples
+        results = {key: [] for key in fetches.keys()}
+
+        with self.graph.as_default():
+            for start in range(0, n_samples, batch_size):
+                chunk_feed_dict = dict(feed_dict or {})
+                chunk_feed_dict.update({tensor: values[start:start + batch_size] for tensor, values in inputs.items()})
+                for key, value in self.sess.run(fetches, feed_dict=chunk_feed_dict).items():
+                    results[key].append(value)
+
+        return {key: np.concatenate(values) for key, values in results.items()}
+
     @property
     def class_name(self):
         return type(self).__name__
@@ -126,3 +231,13 @@ class TFModel(object):
     @property
     def scoped_name(self):
         return '{}{}'.format(type(self).__name__.lower(), self._label)
+
+    @property
+    def checkpoint_name(self):
+        return type(self).__name__.lower()
+
+    @property
+    def checkpoint_variables(self):
+        """ Model parameters keyed by their names in checkpoints (the label is removed from the variable prefix) """
+        prefix_length = len(self.scoped_name)
+        return OrderedDict([(self.checkpoint_name + tv.op.name[prefix_length:], tv) for tv in self.parameters])
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Runs experiment grids (manipulation training, DCN training or arbitrary commands) as parallel jobs on the local machine.
+See helpers.scheduler for details.
+
+Examples:
+
+    ./schedule_experiments.py --cpus 16 --job-cpus 4 manipulation --nip DNet --cam D90 --end 5 --train nip \
+        --ln 0.1 --ln 0.01 --dir ./data/raw/m/jpeg-nip+/50 -- --jpeg 50 --epochs 2501 --patch 128
+    ./schedule_experiments.py --job-cpus 8 dcn --param_list ./data/config/twitter.csv --group 0 -- --epochs 1500
+    ./schedule_experiments.py --job-cpus 2 commands test_fan_batch.sh
+"""
+import os
+import re
+import sys
+import shlex
+import argparse
+
+from helpers import scheduler
+
+# Variable assignments in batch scripts (shared by all subsequent commands, see 'command_jobs')
+_SHELL_ASSIGNMENT = re.compile('^(export\\s+)?[A-Za-z_][A-Za-z0-9_]*=')
+
+
+def manipulation_jobs(args, extra_args, **kwargs):
+    """ One job per camera x repetition x NIP regularization x DCN regularization (see train_manipulation.py). """
+    trainables = args.trainables or []
+    lambdas_nip = args.lambdas_nip or [None]
+    lambdas_dcn = args.lambdas_dcn or [None]
+
+    if None in lambdas_nip and 'nip' in trainables or None in lambdas_dcn and 'dcn' in trainables:
+        print('WARNING Regularization strengths not specified - outputs of the default grid cannot be checked in advance')
+
+    jobs = []
+    for camera in args.cameras:
+        for rep in range(args.start, args.end):
+            for ln in lambdas_nip:
+                for lc in lambdas_dcn:
+
+                    command = [sys.executable, 'train_manipulation.py', '--nip', args.nip_model, '--cam', camera,
+                               '--dir', args.root_dir, '--start', str(rep), '--end', str(rep + 1)]
+                    for tr in trainables:
+                        command.extend(['--train', tr])
+
+                    # Output directory - as in training.manipulation.train_manipulation_nip
+                    output = [args.root_dir, camera, args.nip_model]
+                    if 'nip' in trainables:
+                        output.append('ln-{:0.4f}'.format(float(ln)) if ln is not None else None)
+                        if ln is not None:
+                            command.extend(['--ln', ln])
+                    else:
+                        output.append('fixed-nip')
+                    if 'dcn' in trainables:
+                        output.append('lc-{:0.4f}'.format(float(lc)) if lc is not None else None)
+                        if lc is not None:
+                            command.extend(['--lc', lc])
+                    output.append('{:03d}'.format(rep))
+
+                    name = '-'.join(x for x in ['m', camera, args.nip_model, ln and 'ln{}'.format(ln), lc and 'lc{}'.format(lc), '{:03d}'.format(rep)] if x)
+                    outputs = [os.path.join(*output, 'training.json')] if None not in output else None
+                    jobs.append(scheduler.Job(name, command + extra_args, outputs, **kwargs))
+
+    return jobs
+
+
+def dcn_jobs(args, extra_args, **kwargs):
+    """
+    One job per active row of the DCN parameter table (see train_dcn.py). The output directory depends on the model
+    (latent shape), so each model is constructed (in a separate graph, without initialization) to locate its progress
+    file - as in train_dcn.py.
+    """
+    import pandas as pd
+    import tensorflow as tf
+    from helpers import utils
+    from models import compression
+
+    # Options of train_dcn.py which determine the output directory
+    job_parser = argparse.ArgumentParser(add_help=False)
+    job_parser.add_argument('--out', dest='out_dir', action='store', default='./data/models/dcn/playground')
+    job_parser.add_argument('--patch', dest='patch_size', action='store', default=128, type=int)
+    job_args, _ = job_parser.parse_known_args(extra_args)
+
+    parameters = pd.read_csv(args.param_list)
+
+    if args.run_group is not None:
+        parameters = parameters[parameters['run_group'] == args.run_group]
+
+    jobs = []
+    for index, row in parameters[parameters['active'] == True].iterrows():
+        command = [sys.executable, 'train_dcn.py', '--dcn', args.dcn, '--param_list', args.param_list, '--index', str(index)]
+        name = 'dcn-{}-{:03d}-{}'.format(os.path.splitext(os.path.basename(args.param_list))[0], index, row['label'])
+
+        dcn_params = row.drop(labels=['scenario', 'label', 'active', 'run_group'], errors='ignore').to_dict()
+        dcn_params = {k: v for k, v in dcn_params.items() if not utils.is_nan(v)}
+        dcn = getattr(compression, args.dcn)(None, tf.Graph(), None, patch_size=job_args.patch_size, **dcn_params)
+        outputs = [os.path.join(job_args.out_dir, dcn.model_code, dcn.scoped_name, 'progress.json')]
+        dcn.sess.close()
+
+        jobs.append(scheduler.Job(name, command + extra_args, outputs, **kwargs))
+
+    return jobs
+
+
+def _split_command(line):
+    """ Split a shell command line at the first unquoted pipeline / redirection / list operator. """
+    quote, i = None, 0
+    while i < len(line):
+        c = line[i]
+        if c == '\\' and quote != "'":
+            i += 1
+        elif quote is not None:
+            quote = None if c == quote else quote
+        elif c in '\'"':
+            quote = c
+        elif c in '|<>;&':
+            return line[:i].rstrip(), line[i:]
+        i += 1
+    return line, ''
+
+
+def command_jobs(args, extra_args, **kwargs):
+    """
+    One job per command line of a batch script. Empty lines and comments are ignored; variable assignments (e.g.,
+    'manip="--manip ..."') are not jobs - they are prepended to all subsequent commands. Extra arguments are inserted
+    before pipelines and redirections (e.g., '| tee log'), so they reach the command itself.
+    """
+    jobs = []
+    preamble = []
+    extra = ' '.join(shlex.quote(arg) for arg in extra_args)
+
+    with open(args.filename) as f:
+        for line in f.readlines():
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+
+            if _SHELL_ASSIGNMENT.match(line):
+                preamble.append(line)
+                continue
+
+            command, rest = _split_command(line)
+            command = ' '.join(x for x in [command, extra, rest] if len(x) > 0)
+            jobs.append(scheduler.Job('cmd-{:03d}'.format(len(jobs)), '\n'.join(preamble + [command]), None, **kwargs))
+
+    return jobs
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run experiment grids in parallel on the local machine. '
+                                                 'Arguments after -- are passed to each job.')
+
+    group = parser.add_argument_group('scheduler')
+    group.add_argument('--cpus', dest='cpus', action='store', default=None, type=int,
+                       help='number of CPU cores available for jobs (default: all)')
+    group.add_argument('--memory', dest='memory', action='store', default=None, type=float,
+                       help='memory available for jobs in MB (default: total memory)')
+    group.add_argument('--job-cpus', dest='job_cpus', action='store', default=1, type=int,
+                       help='number of CPU cores per job (default 1)')
+    group.add_argument('--job-memory', dest='job_memory', action='store', default=0, type=float,
+                       help='memory needed per job in MB (default 0)')
+    group.add_argument('--retries', dest='retries', action='store', default=1, type=int,
+                       help='number of restarts of failed jobs (default 1)')
+    group.add_argument('--logs', dest='log_dir', action='store', default='./data/logs/scheduler',
+                       help='directory for job logs')
+    group.add_argument('--state', dest='state_file', action='store', default=None,
+                       help='JSON file with the state of jobs (default: scheduler.json in the log directory)')
+    group.add_argument('--dry', dest='dry', action='store_true', default=False,
+                       help='only list the jobs')
+
+    subparsers = parser.add_subparsers(dest='grid')
+
+    sub = subparsers.add_parser('manipulation', help='NIP & FAN optimization (train_manipulation.py)')
+    sub.add_argument('--nip', dest='nip_model', action='store', required=True,
+                     help='the NIP model (INet, UNet, DNet)')
+    sub.add_argument('--cam', dest='cameras', action='append', required=True,
+                     help='add cameras for evaluation (repeat if needed)')
+    sub.add_argument('--dir', dest='root_dir', action='store', default='./data/m/playground/',
+                     help='the root directory for storing results')
+    sub.add_argument('--train', dest='trainables', action='append',
+                     help='add trainable elements (nip, dcn)')
+    sub.add_argument('--ln', dest='lambdas_nip', action='append',
+                     help='regularization strength for the NIP (repeat for multiple values)')
+    sub.add_argument('--lc', dest='lambdas_dcn', action='append',
+                     help='regularization strength for the DCN (repeat for multiple values)')
+    sub.add_argument('--start', dest='start', action='store', default=0, type=int,
+                     help='first iteration (default 0)')
+    sub.add_argument('--end', dest='end', action='store', default=10, type=int,
+                     help='last iteration (exclusive, default 10)')
+
+    sub = subparsers.add_parser('dcn', help='DCN training (train_dcn.py)')
+    sub.add_argument('--param_list', dest='param_list', action='store', required=True,
+                     help='CSV file with DCN configurations')
+    sub.add_argument('--group', dest='run_group', action='store', type=int, default=None,
+                     help='run group (sub-selects scenarios for running)')
+    sub.add_argument('--dcn', dest='dcn', action='store', default='TwitterDCN',
+                     help='specific DCN class name')
+
+    sub = subparsers.add_parser('commands', help='arbitrary commands (one per line)')
+    sub.add_argument('filename', help='text file with commands')
+
+    # Split arguments for the scheduler and for the jobs
+    argv = sys.argv[1:]
+    extra_args = argv[argv.index('--') + 1:] if '--' in argv else []
+    argv = argv[:argv.index('--')] if '--' in argv else argv
+
+    args = parser.parse_args(argv)
+
+    if args.grid is None:
+        parser.print_usage()
+        sys.exit(1)
+
+    generators = {'manipulation': manipulation_jobs, 'dcn': dcn_jobs, 'commands': command_jobs}
+    jobs = generators[args.grid](args, extra_args, cpus=args.job_cpus, memory=args.job_memory)
+
+    local_scheduler = scheduler.LocalScheduler(args.log_dir, cpus=args.cpus, memory=args.memory, retries=args.retries,
+                                               state_file=args.state_file)
+    summary = local_scheduler.run(jobs, dry=args.dry)
+
+    print('# Finished: {} done, {} skipped, {} failed'.format(*[len(summary[k]) for k in ['done', 'skipped', 'failed']]))
+    sys.exit(1 if len(summary['failed']) > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,25 +8,24 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
 import numpy as np
 import matplotlib.pyplot as plt
-from skimage.measure import compare_ssim
 
-from helpers import plotting, dataset, coreutils, loading, utils
+from helpers import plotting, dataset, coreutils, loading, utils, metrics
 from compression import jpeg_helpers, codec, ratedistortion
 
 supported_plots = ['batch', 'jpeg-match-ssim', 'jpeg-match-bpp', 'jpg-trade-off', 'jp2-trade-off', 'dcn-trade-off', 'bpg-trade-off']
 
 
-def match_jpeg(model, batch_x, axes=None, match='ssim'):
+def match_jpeg(model, batch_x, axes=None, match='ssim', cache_dir=None):
 
     # Compress using DCN and get number of bytes
     batch_y, bytes_dcn = codec.simulate_compression(batch_x, model)
 
-    ssim_dcn = compare_ssim(batch_x.squeeze(), batch_y.squeeze(), multichannel=True, data_range=1)
+    ssim_dcn = metrics.ssim(batch_x.squeeze(), batch_y.squeeze(), data_range=1)
     bpp_dcn = 8 * bytes_dcn / np.prod(batch_x.shape[1:-1])
     target = ssim_dcn if match == 'ssim' else bpp_dcn
 
     try:
-        jpeg_quality = jpeg_helpers.match_quality(batch_x.squeeze(), target, match=match)
+        jpeg_quality = jpeg_helpers.match_quality(batch_x.squeeze(), target, match=match, cache_dir=cache_dir)
     except:
         if match == 'ssim':
             jpeg_quality = 95 if ssim_dcn > 0.8 else 10
@@ -34,9 +33,10 @@ def match_jpeg(model, batch_x, axes=None, match='ssim'):
             jpeg_quality = 95 if bpp_dcn > 3 else 10
         print('WARNING Could not find a matching JPEG quality factor - guessing {}'.format(jpeg_quality))
 
-    # Compress using JPEG
-    batch_j, bytes_jpeg = jpeg_helpers.compress_batch(batch_x[0], jpeg_quality, effective=True)
-    ssim_jpeg = compare_ssim(batch_x.squeeze(), batch_j.squeeze(), multichannel=True, data_range=1)
+    # Compress using JPEG (re-use the cached trade-off curve, if available)
+    jpeg_stats = jpeg_helpers.quality_curve(batch_x[0], [jpeg_quality], cache_dir=cache_dir)[jpeg_quality]
+    batch_j, bytes_jpeg = jpeg_helpers.decompress(jpeg_stats['data']), jpeg_stats['effective_bytes']
+    ssim_jpeg = metrics.ssim(batch_x.squeeze(), batch_j.squeeze(), data_range=1)
     bpp_jpg = 8 * bytes_jpeg / np.prod(batch_x.shape[1:-1])
 
     # Get stats
@@ -129,7 +129,7 @@ def show_example(model, batch_x):
     thumbs_pairs_few = np.concatenate((batch_x[indices], batch_y[indices]), axis=0)
     thumbs_few = (255 * plotting.thumbnails(thumbs_pairs_few, n_cols=len(batch_x))).astype(np.uint8)
 
-    ssim_values = [compare_ssim(batch_x[i], batch_y[i], multichannel=True) for i in range(len(batch_x))]
+    ssim_values = metrics.ssim(batch_x, batch_y, data_range=2)
 
     plotting.quickshow(thumbs_few, 'Sample reconstructions, ssim={:.3f}'.format(np.mean(ssim_values)), axes=axes[1])
 
@@ -175,7 +175,7 @@ def main():
 
         model = codec.restore_model(args.dcn, batch_x.shape[1])
 
-        fig = match_jpeg(model, batch_x, match='ssim')
+        fig = match_jpeg(model, batch_x, match='ssim', cache_dir=ratedistortion.jpeg_curve_dir(args.data))
         plt.show()
         plt.close()
 
@@ -187,7 +187,7 @@ def main():
 
         model = codec.restore_model(args.dcn, batch_x.shape[1])
 
-        fig = match_jpeg(model, batch_x, match='bpp')
+        fig = match_jpeg(model, batch_x, match='bpp', cache_dir=ratedistortion.jpeg_curve_dir(args.data))
         plt.show()
         plt.close()
 
@@ -4,8 +4,8 @@ import os
 import numpy as np
 import imageio as io
 import argparse
-from helpers import plotting
-from skimage.measure import compare_psnr
+from helpers import plotting, utils, metrics
+from compression import jpeg_helpers
 from matplotlib import pylab as plt
 from models.jpeg import DJPG
 
@@ -43,7 +43,7 @@ def test_output(image, jpeg_quality=50, rounding_approximation=None):
     plt.show()
 
 
-def test_quality(image, rounding_approximation=None, n_quality_levels=91):
+def test_quality(image, rounding_approximation=None, n_quality_levels=91, batch_size=16):
 
     jpg = DJPG(rounding_approximation=rounding_approximation)
     print(jpg)
@@ -55,13 +55,17 @@ def test_quality(image, rounding_approximation=None, n_quality_levels=91):
     quality_levels = np.unique(np.round(np.linspace(10, 100, n_quality_levels)).astype(np.int32)).tolist()
     print('Using quality levels: {}'.format(quality_levels))
 
-    for jpeg_quality in quality_levels:
-        batch_y = jpg.process(batch_x / 255, jpeg_quality)
+    # Process multiple quality levels in a single batch
+    for b in range(0, len(quality_levels), batch_size):
+        batch_q = quality_levels[b:b + batch_size]
+        batch_y = jpg.process(np.repeat(batch_x / 255, len(batch_q), axis=0), batch_q)
         batch_y = np.round(255 * batch_y) / 255
+        psnrs_y.extend(metrics.psnr(np.broadcast_to(batch_x, batch_y.shape), 255 * batch_y, 255))
+
+    for jpeg_quality in quality_levels:
         io.imwrite('/tmp/patch.jpg', (batch_x.squeeze()).astype(np.uint8), quality=jpeg_quality, subsampling='4:4:4')
         batch_j = io.imread('/tmp/patch.jpg')
-        psnrs_y.append(compare_psnr(batch_x.squeeze(), 255 * batch_y.squeeze(), 255))
-        psnrs_j.append(compare_psnr(batch_x.squeeze(), batch_j.squeeze(), 255))
+        psnrs_j.append(metrics.psnr(batch_x.squeeze(), batch_j.squeeze(), 255))
 
     # Plot
     plt.figure(figsize=(6,6))
@@ -83,9 +87,39 @@ def test_quality(image, rounding_approximation=None, n_quality_levels=91):
     plt.show()
 
 
+def test_accuracy(image, rounding_approximation=None, n_quality_levels=91, patch_size=64):
+
+    jpg = DJPG(rounding_approximation=rounding_approximation)
+    print(jpg)
+
+    # Use all non-overlapping patches of the image as a batch
+    batch_x = utils.slidingwindow(image, patch_size) / 255
+
+    quality_levels = np.unique(np.round(np.linspace(10, 100, n_quality_levels)).astype(np.int32)).tolist()
+    print('Using {} patches and quality levels: {}'.format(len(batch_x), quality_levels))
+
+    psnrs_y, psnrs_s = [], []
+
+    for jpeg_quality in quality_levels:
+        batch_y = jpg.process(batch_x, jpeg_quality)
+        batch_s = jpeg_helpers.simulate_jpeg(batch_x, jpeg_quality)
+        psnrs_y.append(np.mean(metrics.psnr(batch_x, batch_y, data_range=1)))
+        psnrs_s.append(np.mean(metrics.psnr(batch_x, batch_s, data_range=1)))
+        print('Q{:3d} : dJPEG {:.2f} dB vs. reference {:.2f} dB'.format(jpeg_quality, psnrs_y[-1], psnrs_s[-1]))
+
+    # Plot
+    plt.figure(figsize=(6, 6))
+    plt.plot(psnrs_y, psnrs_s, 'bo', alpha=0.25)
+    plt.plot([20, 60], [20, 60], 'k:')
+    plt.xlabel('PSNR for dJPEG')
+    plt.ylabel('PSNR for the NumPy reference')
+    plt.title('dJPEG vs reference DCT-domain simulator (avg. over {} patches)'.format(len(batch_x)))
+    plt.show()
+
+
 def main():
     parser = argparse.ArgumentParser(description='Test the dJPEG model')
-    parser.add_argument('mode', help='Test mode: output / quality')
+    parser.add_argument('mode', help='Test mode: output / quality / accuracy')
     parser.add_argument('--image', dest='image', action='store',
                         help='test image path')
     parser.add_argument('--patch', dest='patch_size', action='store', type=int, default=256,
@@ -117,6 +151,9 @@ def main():
     elif args.mode == 'quality':
         test_quality(image, n_quality_levels=int(args.quality), rounding_approximation=args.round)
 
+    elif args.mode == 'accuracy':
+        test_accuracy(image, n_quality_levels=int(args.quality), rounding_approximation=args.round)
+
 
 if __name__ == "__main__":
     main()
@@ -39,7 +39,7 @@ def develop_image(camera, pipeline, ps=128, image_id=None, root_dir='./data'):
     import matplotlib.pylab as plt
     import tensorflow as tf
     from models import pipelines
-    from skimage.measure import compare_psnr
+    from helpers import metrics
 
     root_dirname = os.path.join(root_dir, 'models', 'nip')
     data_dirname = os.path.join(root_dir, 'raw', 'training_data', camera)
@@ -75,7 +75,7 @@ def develop_image(camera, pipeline, ps=128, image_id=None, root_dir='./data'):
     sample_y = sample_y[0:1]
     target_y = io.imread(os.path.join(data_dirname, files[image_id].replace('.npy', '.png')))
     target_y = target_y[2*yy:2*(yy+ps), 2*xx:2*(xx+ps), :].astype(np.float32) / (2**8 - 1)
-    psnr_value = compare_psnr(target_y, sample_y.squeeze(), data_range=1.0)
+    psnr_value = metrics.psnr(target_y, sample_y.squeeze(), data_range=1.0)
     log.info('PSNR={:.1f} dB'.format(psnr_value))
 
     # Plot the images
@@ -50,10 +50,14 @@ def main():
                         help='disable data augmentation (flipping + gamma correction)')
     parser.add_argument('--resume', dest='resume', action='store_true', default=False,
                         help='Resume training from last checkpoint, if possible')
+    parser.add_argument('--trace', dest='trace_every', action='store', default=None, type=int,
+                        help='capture a full step trace every N training steps (profiling)')
     parser.add_argument('--dry', dest='dry', action='store_true', default=False,
                         help='Dry run (no training - only does model setup)')
     parser.add_argument('--group', dest='run_group', action='store', type=int, default=None,
                         help='Specify run group (sub-selects scenarios for running)')
+    parser.add_argument('--index', dest='index', action='store', type=int, default=None,
+                        help='Train only the scenario with a given index (row of the parameter table)')
     parser.add_argument('--fill', dest='fill', action='store', default=None,
                         help='Path of the extended scenarios table with appended result columns')
 
@@ -121,6 +125,9 @@ def main():
     if args.run_group is not None:
         parameters = parameters[parameters['run_group'] == args.run_group]
 
+    if args.index is not None:
+        parameters = parameters.loc[[args.index]]
+
     parameters = parameters[parameters['active']].drop(columns=['active', 'run_group'])
     print('# DCN parameter list [{} active configs]:\n'.format(len(parameters)))
     print(parameters)
@@ -173,7 +180,7 @@ def main():
             model_log[model_code] = [index]
 
         if not args.dry:
-            train_dcn({'dcn': dcn}, training_spec, data, args.out_dir)
+            train_dcn({'dcn': dcn}, training_spec, data, args.out_dir, resume=args.resume, trace_every=args.trace_every)
 
         # Fill the table with results, if requested
         if args.fill is not None:
@@ -17,9 +17,10 @@ from compression import codec
 def batch_training(nip_model, camera_names=None, root_directory=None, loss_metric='L2', trainables=None,
                    jpeg_quality=None, jpeg_mode='soft', manipulations=None, dcn_model=None, downsampling='pool',
                    end_repetition=10, start_repetition=0, n_epochs=1001, patch=128,
-                   use_pretrained=True, lambdas_nip=None, lambdas_dcn=None, nip_directory=None, split='120:30:4'):
+                   use_pretrained=True, lambdas_nip=None, lambdas_dcn=None, nip_directory=None, split='120:30:4', replicas=1, resume=False, trace_every=None):
     """
-    Repeat training for multiple NIP regularization strengths.
+    Repeat training for multiple NIP regularization strengths. With replicas > 1, consecutive experiments (repetitions x
+    regularization strengths) are trained side by side as independent replicas of the workflow in a single TF graph.
     """
 
     if nip_model is None:
@@ -35,7 +36,7 @@ def batch_training(nip_model, camera_names=None, root_directory=None, loss_metri
         os.makedirs(root_directory)
 
     # Lazy loading to minimize delays when checking cli parameters
-    from training.manipulation import construct_models, train_manipulation_nip
+    from training.manipulation import construct_replicas, train_manipulation_nip
 
     camera_names = camera_names or ['Nikon D90', 'Nikon D7000', 'Canon EOS 5D', 'Canon EOS 40D']
 
@@ -104,7 +105,7 @@ def batch_training(nip_model, camera_names=None, root_directory=None, loss_metri
     }
 
     # Construct the TF model
-    tf_ops, distribution = construct_models(nip_model, patch_size=training['patch_size'], trainable=trainables, distribution=distribution_spec, manipulations=manipulations, loss_metric=loss_metric)
+    tf_ops, distribution = construct_replicas(nip_model, replicas, patch_size=training['patch_size'], trainable=trainables, distribution=distribution_spec, manipulations=manipulations, loss_metric=loss_metric)
 
     for camera_name in camera_names:
         
@@ -136,13 +137,20 @@ def batch_training(nip_model, camera_names=None, root_directory=None, loss_metri
         # data = dataset.IPDataset(data_directory, n_images=training['n_images'], v_images=training['v_images'], load=load, val_rgb_patch_size=training['patch_size'], val_n_patches=training['val_n_patches'])
 
         # Repeat evaluation
+        experiments = []
         for rep in range(start_repetition, end_repetition):
             for lr in lambdas_nip:
                 for lc in lambdas_dcn:
-                    training['lambda_nip'] = lr
-                    training['lambda_dcn'] = lc
-                    training['run_number'] = rep
-                    train_manipulation_nip(tf_ops, training, distribution, data, {'root': root_directory, 'nip_snapshots': nip_directory})
+                    experiment = dict(training)
+                    experiment['lambda_nip'] = lr
+                    experiment['lambda_dcn'] = lc
+                    experiment['run_number'] = rep
+                    experiments.append(experiment)
+
+        # Train consecutive groups of experiments side by side (one experiment per replica)
+        for start in range(0, len(experiments), len(tf_ops)):
+            group = experiments[start:start + len(tf_ops)]
+            train_manipulation_nip(tf_ops[:len(group)], group, distribution, data, {'root': root_directory, 'nip_snapshots': nip_directory}, resume=resume, trace_every=trace_every)
 
                 
 def main():
@@ -188,6 +196,12 @@ def main():
                         help='last iteration (exclusive, default 10)')
     group.add_argument('--epochs', dest='epochs', action='store', default=1001, type=int,
                         help='number of epochs (default 1001)')
+    group.add_argument('--resume', dest='resume', action='store_true', default=False,
+                        help='resume interrupted runs from their last training state')
+    group.add_argument('--trace', dest='trace_every', action='store', default=None, type=int,
+                        help='capture a full step trace every N training steps (profiling)')
+    group.add_argument('--replicas', dest='replicas', action='store', default=1, type=int,
+                        help='number of experiments trained side by side in a single graph (default 1)')
 
     # Distribution channel
     group = parser.add_argument_group('distribution channel')
@@ -208,7 +222,8 @@ def main():
     batch_training(args.nip_model, args.cameras, args.root_dir, args.loss_metric, args.trainables,
                    args.jpeg_quality, args.jpeg_mode, args.manipulations, args.dcn_model, args.downsampling, patch=args.patch // 2,
                    use_pretrained=not args.from_scratch, start_repetition=args.start, end_repetition=args.end, n_epochs=args.epochs,
-                   nip_directory=args.nip_directory, split=args.split, lambdas_nip=args.lambdas_nip, lambdas_dcn=args.lambdas_dcn)
+                   nip_directory=args.nip_directory, split=args.split, lambdas_nip=args.lambdas_nip, lambdas_dcn=args.lambdas_dcn,
+                   replicas=args.replicas, resume=args.resume, trace_every=args.trace_every)
 
 
 if __name__ == "__main__":
@@ -32,6 +32,8 @@ def main():
     parser.add_argument('--params', dest='nip_params', default=None, help='Extra parameters for NIP constructor (JSON string)')
     parser.add_argument('--resume', dest='resume', action='store_true', default=False,
                         help='Resume training from last checkpoint, if possible')
+    parser.add_argument('--trace', dest='trace_every', action='store', default=None, type=int,
+                        help='capture a full step trace every N training steps (profiling)')
     parser.add_argument('--split', dest='split', action='store', default='120:30:1',
                         help='data split with #training:#validation:#validation_patches - e.g., 120:30:1')
 
@@ -107,7 +109,7 @@ def main():
         model = getattr(pipelines, pipe)(sess, tf.get_default_graph(), loss_metric='L2', **args.nip_params)
         model.sess.run(tf.global_variables_initializer())
 
-        train_nip_model(model, args.camera, args.epochs, validation_loss_threshold=1e-5, patch_size=args.patch_size, resume=args.resume, data=data, out_directory_root=args.out_dir)
+        train_nip_model(model, args.camera, args.epochs, validation_loss_threshold=1e-5, patch_size=args.patch_size, resume=args.resume, data=data, out_directory_root=args.out_dir, trace_every=args.trace_every)
 
         sess.close()
 
@@ -3,6 +3,7 @@
 
 # Basic imports
 import os
+import json
 import shutil
 import numpy as np
 import tqdm
@@ -17,11 +18,12 @@ from models import pipelines
 from models.forensics import FAN
 from models.jpeg import DJPG
 from models import compression
+from models.tfmodel import TFModel
 
 from compression import codec
 
 # Helper functions
-from helpers import coreutils, tf_helpers
+from helpers import coreutils, tf_helpers, rendering, checkpoints, profiling
 from training import validation
 
 
@@ -29,13 +31,15 @@ SUPPORTED_MANIPULATIONS = ['sharpen', 'gaussian', 'jpeg', 'resample', 'awgn', 'g
 
 
 @coreutils.logCall
-def construct_models(nip_model, patch_size=128, trainable=None, distribution=None, manipulations=None, loss_metric='L2'):
+def construct_models(nip_model, patch_size=128, trainable=None, distribution=None, manipulations=None, loss_metric='L2', label=None, sess=None):
     """
     Setup the TF model of the entire acquisition and distribution workflow.
     :param nip_model: name of the NIP class
     :param patch_size: patch size for manipulation training (raw patch - rgb patches will be 4 times as big)
     :param distribution: definition of the dissemination channel (set to None for the default down+jpeg(50))
     :param loss_metric: NIP loss metric: L2, L1 or SSIM
+    :param label: optional label for all models (separate variable scopes for multiple workflows in a single graph)
+    :param sess: existing TF session (models are added to the default graph) or None (resets the graph & creates a new session)
     """
     # Sanitize inputs
     if patch_size < 16 or patch_size > 512:
@@ -67,12 +71,13 @@ def construct_models(nip_model, patch_size=128, trainable=None, distribution=Non
     if loss_metric not in ['L2', 'L1', 'SSIM']:
         raise ValueError('Invalid loss metric ({})!'.format(loss_metric))
     
-    tf.reset_default_graph()
-    sess = tf.Session()
+    if sess is None:
+        tf.reset_default_graph()
+        sess = tf.Session()
 
     # The pipeline -----------------------------------------------------------------------------------------------------
 
-    model = getattr(pipelines, nip_model)(sess, tf.get_default_graph(), patch_size=patch_size, loss_metric=loss_metric)
+    model = getattr(pipelines, nip_model)(sess, tf.get_default_graph(), patch_size=patch_size, loss_metric=loss_metric, label=label)
     print('NIP network: {}'.format(model.summary()))
 
     # Several paths for post-processing --------------------------------------------------------------------------------
@@ -165,7 +170,7 @@ def construct_models(nip_model, patch_size=128, trainable=None, distribution=Non
             print('Channel compression: DCN from {dirname}'.format(**distribution['compression_params']))
             if 'dirname' in distribution['compression_params']:
                 model_directory = distribution['compression_params']['dirname']
-                dist_compression = codec.restore_model(model_directory, down_patch_size, sess=sess, graph=tf.get_default_graph(), x=imb_down, nip_input=model.x)
+                dist_compression = codec.restore_model(model_directory, down_patch_size, sess=sess, graph=tf.get_default_graph(), x=imb_down, nip_input=model.x, label=label)
             else:
                 # TODO Not tested yet
                 raise NotImplementedError('DCN models should be restored from a pre-training session!')
@@ -180,7 +185,7 @@ def construct_models(nip_model, patch_size=128, trainable=None, distribution=Non
             raise ValueError('Unsupported channel compression {}'.format(distribution['compression']))
 
     # Add manipulation detection
-    fan = FAN(sess, tf.get_default_graph(), n_classes=n_classes, x=imb_out, nip_input=model.x, n_convolutions=4)
+    fan = FAN(sess, tf.get_default_graph(), n_classes=n_classes, x=imb_out, label=label, nip_input=model.x, n_convolutions=4)
     print('Forensics network parameters: {:,}'.format(fan.count_parameters()))
 
     # Setup a combined loss and training op
@@ -212,6 +217,7 @@ def construct_models(nip_model, patch_size=128, trainable=None, distribution=Non
         'loss': loss,
         'opt': opt,
         'lr': lr,
+        'adam': adam,
         'lambda_nip': lambda_nip,
         'lambda_dcn': lambda_dcn,
         'operations': operations,
@@ -224,8 +230,38 @@ def construct_models(nip_model, patch_size=128, trainable=None, distribution=Non
     return tf_ops, dist
 
 
+def construct_replicas(nip_model, n_replicas, **kwargs):
+    """
+    Setup multiple independent replicas of the workflow (see 'construct_models') in a single TF graph and session.
+    Replicas use separate variable scopes (model labels r0, r1, ...) and can be trained side by side - see
+    'train_manipulation_nip'. A single replica is constructed without a label.
+
+    :param nip_model: name of the NIP class
+    :param n_replicas: number of replicas
+    :param kwargs: other parameters for 'construct_models'
+    :return: tuple (list of tf_ops dictionaries, distribution)
+    """
+    if n_replicas < 1:
+        raise ValueError('Invalid number of replicas ({})!'.format(n_replicas))
+
+    if n_replicas == 1:
+        tf_ops, distribution = construct_models(nip_model, **kwargs)
+        return [tf_ops], distribution
+
+    replicas = []
+    sess = None
+
+    for r in range(n_replicas):
+        print('\n# Constructing replica {}/{}'.format(r + 1, n_replicas))
+        tf_ops, distribution = construct_models(nip_model, label='r{}'.format(r), sess=sess, **kwargs)
+        sess = tf_ops['sess']
+        replicas.append(tf_ops)
+
+    return replicas, distribution
+
+
 # @coreutils.logCall
-def train_manipulation_nip(tf_ops, training, distribution, data, directories=None, overwrite=False):
+def train_manipulation_nip(tf_ops, training, distribution, data, directories=None, overwrite=False, resume=False, trace_every=None):
     """
     Jointly train the NIP and the FAN models. Training progress and TF checkpoints are saved periodically to the specified directories.
     
@@ -277,9 +313,26 @@ def train_manipulation_nip(tf_ops, training, distribution, data, directories=Non
         nip_snapshots    - root directory with pre-trained NIP models 
                            (default: './data/models/nip/')
     }
-    
+
+    If 'resume' is set, interrupted runs are continued from their last training state (model & optimizer variables,
+    epoch counter, loss buffers, performance history and RNG state - saved at every validation in 'resume/').
+
+    Multiple replicas of the workflow (see 'construct_replicas') can be trained side by side - provide lists of tf_ops
+    and training dictionaries (one per replica, e.g., with different regularization strengths or run numbers). All
+    replicas are updated in a single sess.run per batch (the remaining training settings are taken from the first
+    replica). In such case, a list of model directories is returned.
+
+    Time spent in training stages (sampling, sess.run, validation, plotting, checkpointing) and memory usage are
+    recorded for every epoch (see helpers.profiling) and reported in training.json and TensorBoard ('profiling/') - set
+    'trace_every' to capture full step traces of every N-th training step.
     """
-    
+
+    if isinstance(tf_ops, dict) and isinstance(training, dict):
+        return train_manipulation_nip([tf_ops], [training], distribution, data, directories, overwrite, resume, trace_every)[0]
+
+    if len(tf_ops) != len(training):
+        raise ValueError('The number of replicas ({}) does not match the number of training setups ({})!'.format(len(tf_ops), len(training)))
+
     # Apply default settings
     directories_def = {'root': './data/m/playground/', 'nip_snapshots': './data/models/nip/'}
     if directories is not None: 
@@ -287,11 +340,12 @@ def train_manipulation_nip(tf_ops, training, distribution, data, directories=Non
     directories = directories_def
     
     # Check if all necessary keys are present
-    if any([x not in tf_ops for x in ['sess', 'nip', 'fan', 'loss', 'opt', 'lr', 'lambda_nip', 'lambda_dcn']]):
-        raise RuntimeError('Missing keys in the tf_ops dictionary! {}'.format(tf_ops.keys()))
-        
-    if any([x not in training for x in ['camera_name', 'use_pretrained_nip', 'lambda_nip', 'lambda_dcn', 'run_number', 'n_epochs', 'learning_rate']]):
-        raise RuntimeError('Missing keys in the training dictionary! {}'.format(training.keys()))
+    for replica_ops, replica_training in zip(tf_ops, training):
+        if any([x not in replica_ops for x in ['sess', 'nip', 'fan', 'loss', 'opt', 'lr', 'lambda_nip', 'lambda_dcn']]):
+            raise RuntimeError('Missing keys in the tf_ops dictionary! {}'.format(replica_ops.keys()))
+
+        if any([x not in replica_training for x in ['camera_name', 'use_pretrained_nip', 'lambda_nip', 'lambda_dcn', 'run_number', 'n_epochs', 'learning_rate']]):
+            raise RuntimeError('Missing keys in the training dictionary! {}'.format(replica_training.keys()))
 
     if any([x not in distribution for x in ['downsampling', 'compression', 'forensics_classes', 'compression_params']]):
         raise RuntimeError('Missing keys in the distribution dictionary! {}'.format(distribution.keys()))
@@ -299,86 +353,45 @@ def train_manipulation_nip(tf_ops, training, distribution, data, directories=Non
     if data is None:
         raise ValueError('Training data seems not to be loaded!')
 
+    # Settings shared by all replicas
+    settings = training[0]
+    sess = tf_ops[0]['sess']
+
     try:
         if data._loaded_data == 'xy':
-            batch_x, batch_y = data.next_training_batch(0, 5, training['patch_size'] * 2)
-            if batch_x.shape != (5, training['patch_size'], training['patch_size'], 4) or batch_y.shape != (5, 2 * training['patch_size'], 2 * training['patch_size'], 3):
+            batch_x, batch_y = data.next_training_batch(0, 5, settings['patch_size'] * 2)
+            if batch_x.shape != (5, settings['patch_size'], settings['patch_size'], 4) or batch_y.shape != (5, 2 * settings['patch_size'], 2 * settings['patch_size'], 3):
                 raise ValueError('The training batch returned by the RAW+RGB dataset is of invalid size! {}'.format(batch_x.shape))
         elif data._loaded_data == 'y':
-            batch_x = data.next_training_batch(0, 5, training['patch_size'] * 2)
-            if batch_x.shape != (5, 2 * training['patch_size'], 2 * training['patch_size'], 3):
+            batch_x = data.next_training_batch(0, 5, settings['patch_size'] * 2)
+            if batch_x.shape != (5, 2 * settings['patch_size'], 2 * settings['patch_size'], 3):
                 raise ValueError('The training batch returned by the RGB dataset is of invalid size! {}'.format(batch_x.shape))
 
     except Exception as e:
         raise ValueError('Data set error: {}'.format(e))
 
-    print('\n## Training NIP/FAN for manipulation detection: cam={} / lr={:.4f} / run={:3d} / epochs={}, root={}'.format(training['camera_name'], training['lambda_nip'], training['run_number'], training['n_epochs'], directories['root']), flush=True)
-
-    # Construct output directory - some example paths:
-    #  root / camera_name / *Net / fixed-nip / 001 /
-    #  root / camera_name / *Net / lr-0.1000 / lc-0.1000 / 001 /
-    #  root / camera_name / *Net / fixed-nip / lc-0.1000 / 001 /
-    nip_save_dir = [directories['root'], training['camera_name'], tf_ops['nip'].class_name]
-    if 'nip' in training['trainable']:
-        nip_save_dir.append('ln-{:0.4f}'.format(training['lambda_nip']))
-    else:
-        nip_save_dir.append('fixed-nip')
-    if 'dcn' in training['trainable']:
-        nip_save_dir.append('lc-{:0.4f}'.format(training['lambda_dcn']))
-    nip_save_dir.append('{:03d}'.format(training['run_number']))
-    
-    nip_save_dir = os.path.join(*nip_save_dir)
-    print('(progress) ->', nip_save_dir)
-
-    model_directory = os.path.join(nip_save_dir, 'models')
-    print('(model) ---->', model_directory)
-
-    if os.path.exists(nip_save_dir) and not overwrite:
-        print('Directory exists, skipping...')
-        return model_directory
-
     # Setup flags for trainable components
     joint_opt = ['fan']
-    joint_opt.extend(sorted(training['trainable']))
+    joint_opt.extend(sorted(settings['trainable']))
     joint_opt = '+'.join(joint_opt)
-    joint_optimization = ['nip' in training['trainable'], 'dcn' in training['trainable']]
+    joint_optimization = ['nip' in settings['trainable'], 'dcn' in settings['trainable']]
 
-    if joint_optimization[0] and tf_ops['nip'].count_parameters() == 0:
+    if joint_optimization[0] and tf_ops[0]['nip'].count_parameters() == 0:
         raise ValueError('It looks like you`re trying to optimize a NIP with no trainable parameters!')
 
     # Basic setup
     problem_description = 'manipulation detection'
-    patch_size = training['patch_size']
-    batch_size = training['batch_size']
-    sampling_rate = training['sampling_rate']
+    patch_size = settings['patch_size']
+    batch_size = settings['batch_size']
+    sampling_rate = settings['sampling_rate']
 
     learning_rate_decay_schedule = 100
     learning_rate_decay_rate = 0.90
 
-    # Setup the arrays for storing the current batch - randomly sampled from full-resolution images
-    learning_rate = training['learning_rate']
-
-    # Initialize models
-    tf_ops['fan'].init()
-    tf_ops['nip'].init()
-    tf_ops['sess'].run(tf.global_variables_initializer())
-
-    if training['use_pretrained_nip'] and tf_ops['nip'].count_parameters() > 0:
-        tf_ops['nip'].load_model(os.path.join(directories['nip_snapshots'], training['camera_name'], tf_ops['nip'].scoped_name))
-    
-    if distribution['compression'] == 'dcn':
-        tf_ops['dcn'].load_model(distribution['compression_params']['dirname'])
-
     n_batches = data.count_training // batch_size
 
     model_list = ['nip', 'fan']
 
-    # Containers for storing loss progression
-    loss_epoch = {key: deque(maxlen=n_batches) for key in model_list}
-    loss_epoch['similarity-loss'] = deque(maxlen=n_batches)
-    loss_last_k_epochs = {key: deque(maxlen=10) for key in model_list}
-    loss_last_k_epochs['similarity-loss'] = deque(maxlen=n_batches)
-    
     # Create a function which generates labels for each batch
     def batch_labels(batch_size, n_classes):
         return np.concatenate([x * np.ones((batch_size,), dtype=np.int32) for x in range(n_classes)])
@@ -390,190 +403,356 @@ def train_manipulation_nip(tf_ops, training, distribution, data, directories=Non
     collect_memory_stats = {'tf': False, 'ram': True}
     memory = {'tf-ram': [], 'tf-vars': [], 'cpu-proc': [], 'cpu-resource': [] }
 
-    # Collect and print training summary
-    training_summary = OrderedDict()
-    training_summary['Problem'] = '{}'.format(problem_description)
-    training_summary['Classes'] = '{}'.format(distribution['forensics_classes'])
-    training_summary['Channel Downsampling'] = '{}'.format(distribution['downsampling'])
-    training_summary['Channel Compression'] = '{}'.format(tf_ops['dcn'].summary() if tf_ops['dcn'] is not None else None)
-    training_summary['Channel Compression Parameters'] = '{}'.format(distribution['compression_params'])
-    training_summary['Camera name'] = '{}'.format(training['camera_name'])
-    training_summary['Joint optimization'] = '{}'.format(joint_opt)
-    training_summary['NIP Regularization'] = '{}'.format(training['lambda_nip'])
-    training_summary['DCN Regularization'] = '{}'.format(training['lambda_dcn'])
-    training_summary['FAN model'] = '{}'.format(tf_ops['fan'].summary())
-    training_summary['NIP model'] = '{}'.format(tf_ops['nip'].summary())
-    training_summary['NIP loss'] = '{}'.format(tf_ops['nip'].loss_metric)
-    training_summary['Use pre-trained NIP'] = '{}'.format(training['use_pretrained_nip'])
-    training_summary['# Epochs'] = '{}'.format(training['n_epochs'])
-    training_summary['Patch size'] = '{}'.format(patch_size)
-    training_summary['Batch size'] = '{}'.format(batch_size)
-    training_summary['Learning rate'] = '{}'.format(training['learning_rate'])
-    training_summary['Learning rate decay schedule'] = '{}'.format(learning_rate_decay_schedule)
-    training_summary['Learning rate decay rate'] = '{}'.format(learning_rate_decay_rate)
-    training_summary['Dataset'] = '{}'.format(data.description)
-    training_summary['# train. images'] = '{}'.format(data.count_training)
-    training_summary['# valid. images'] = '{}'.format(data.count_validation)
-    training_summary['Batch shape'] = '{}'.format(batch_x.shape)
-    training_summary['NIP input patch'] = '{}'.format(tf_ops['nip'].x.shape)
-    training_summary['NIP output patch'] = '{}'.format(tf_ops['nip'].y.shape)
-    training_summary['FAN input patch'] = '{}'.format(tf_ops['fan'].x.shape)
-    if any(collect_memory_stats.values()):
-        training_summary['memory_consumption'] = memory
+    model_directories = []
+    runs = []
+
+    for replica_ops, replica_training in zip(tf_ops, training):
+
+        print('\n## Training NIP/FAN for manipulation detection: cam={} / lr={:.4f} / run={:3d} / epochs={}, root={}'.format(replica_training['camera_name'], replica_training['lambda_nip'], replica_training['run_number'], replica_training['n_epochs'], directories['root']), flush=True)
+
+        # Construct output directory - some example paths:
+        #  root / camera_name / *Net / fixed-nip / 001 /
+        #  root / camera_name / *Net / lr-0.1000 / lc-0.1000 / 001 /
+        #  root / camera_name / *Net / fixed-nip / lc-0.1000 / 001 /
+        nip_save_dir = [directories['root'], replica_training['camera_name'], replica_ops['nip'].class_name]
+        if 'nip' in settings['trainable']:
+            nip_save_dir.append('ln-{:0.4f}'.format(replica_training['lambda_nip']))
+        else:
+            nip_save_dir.append('fixed-nip')
+        if 'dcn' in settings['trainable']:
+            nip_save_dir.append('lc-{:0.4f}'.format(replica_training['lambda_dcn']))
+        nip_save_dir.append('{:03d}'.format(replica_training['run_number']))
+
+        nip_save_dir = os.path.join(*nip_save_dir)
+        print('(progress) ->', nip_save_dir)
+
+        model_directory = os.path.join(nip_save_dir, 'models')
+        print('(model) ---->', model_directory)
+        model_directories.append(model_directory)
+
+        # Training state for resuming interrupted runs
+        state = checkpoints.TrainingState(sess, checkpoints.optimization_variables(
+            [replica_ops['nip'], replica_ops['fan'], replica_ops['dcn']], [replica_ops.get('adam'), replica_ops['fan'].adam]
+        ), os.path.join(nip_save_dir, 'resume'))
+
+        resuming = resume and state.exists and not state.is_finished
+
+        if os.path.exists(nip_save_dir) and not overwrite and not resuming:
+            print('Directory exists, skipping...')
+            continue
+
+        # Containers for storing loss progression
+        loss_epoch = {key: deque(maxlen=n_batches) for key in model_list}
+        loss_epoch['similarity-loss'] = deque(maxlen=n_batches)
+        loss_last_k_epochs = {key: deque(maxlen=10) for key in model_list}
+        loss_last_k_epochs['similarity-loss'] = deque(maxlen=n_batches)
+
+        # Collect training summary
+        training_summary = OrderedDict()
+        training_summary['Problem'] = '{}'.format(problem_description)
+        training_summary['Classes'] = '{}'.format(distribution['forensics_classes'])
+        training_summary['Channel Downsampling'] = '{}'.format(distribution['downsampling'])
+        training_summary['Channel Compression'] = '{}'.format(replica_ops['dcn'].summary() if replica_ops['dcn'] is not None else None)
+        training_summary['Channel Compression Parameters'] = '{}'.format(distribution['compression_params'])
+        training_summary['Camera name'] = '{}'.format(replica_training['camera_name'])
+        training_summary['Joint optimization'] = '{}'.format(joint_opt)
+        training_summary['NIP Regularization'] = '{}'.format(replica_training['lambda_nip'])
+        training_summary['DCN Regularization'] = '{}'.format(replica_training['lambda_dcn'])
+        training_summary['FAN model'] = '{}'.format(replica_ops['fan'].summary())
+        training_summary['NIP model'] = '{}'.format(replica_ops['nip'].summary())
+        training_summary['NIP loss'] = '{}'.format(replica_ops['nip'].loss_metric)
+        training_summary['Use pre-trained NIP'] = '{}'.format(replica_training['use_pretrained_nip'])
+        training_summary['# Epochs'] = '{}'.format(settings['n_epochs'])
+        training_summary['Patch size'] = '{}'.format(patch_size)
+        training_summary['Batch size'] = '{}'.format(batch_size)
+        training_summary['Learning rate'] = '{}'.format(settings['learning_rate'])
+        training_summary['Learning rate decay schedule'] = '{}'.format(learning_rate_decay_schedule)
+        training_summary['Learning rate decay rate'] = '{}'.format(learning_rate_decay_rate)
+        training_summary['Dataset'] = '{}'.format(data.description)
+        training_summary['# train. images'] = '{}'.format(data.count_training)
+        training_summary['# valid. images'] = '{}'.format(data.count_validation)
+        training_summary['Batch shape'] = '{}'.format(batch_x.shape)
+        training_summary['NIP input patch'] = '{}'.format(replica_ops['nip'].x.shape)
+        training_summary['NIP output patch'] = '{}'.format(replica_ops['nip'].y.shape)
+        training_summary['FAN input patch'] = '{}'.format(replica_ops['fan'].x.shape)
+        if len(tf_ops) > 1:
+            training_summary['Replicas'] = '{}'.format(len(tf_ops))
+        if any(collect_memory_stats.values()):
+            training_summary['memory_consumption'] = memory
+
+        runs.append({
+            'tf_ops': replica_ops,
+            'training': replica_training,
+            'save_dir': nip_save_dir,
+            'model_directory': model_directory,
+            'summary': training_summary,
+            'loss_epoch': loss_epoch,
+            'loss_last_k_epochs': loss_last_k_epochs,
+            'conf': np.identity(n_classes),
+            'state': state,
+            'resume': resuming,
+            'start_epoch': 0,
+            'learning_rate': settings['learning_rate']
+        })
+
+    if len(runs) == 0:
+        return model_directories
+
+    # Initialize models (all replicas share the graph, so global initialization happens before loading any snapshots)
+    for run in runs:
+        run['tf_ops']['fan'].init()
+        run['tf_ops']['nip'].init()
+    sess.run(tf.global_variables_initializer())
+
+    for run in runs:
+        if run['training']['use_pretrained_nip'] and run['tf_ops']['nip'].count_parameters() > 0:
+            run['tf_ops']['nip'].load_model(os.path.join(directories['nip_snapshots'], run['training']['camera_name'], run['tf_ops']['nip'].checkpoint_name))
+
+        if distribution['compression'] == 'dcn':
+            run['tf_ops']['dcn'].load_model(distribution['compression_params']['dirname'])
+
+        if run['resume']:
+            run['start_epoch'], extra = run['state'].restore()
+            print('Resuming {} from epoch {}'.format(run['save_dir'], run['start_epoch']))
+            for key in ['loss_epoch', 'loss_last_k_epochs', 'conf', 'learning_rate']:
+                run[key] = extra[key]
+            for key, performance in extra['performance'].items():
+                run['tf_ops'][key].performance = performance
+
+    def save_state(run, next_epoch, finished=False):
+        extra = {key: run[key] for key in ['loss_epoch', 'loss_last_k_epochs', 'conf', 'learning_rate']}
+        extra['performance'] = {key: run['tf_ops'][key].performance for key in ['nip', 'fan', 'dcn'] if isinstance(run['tf_ops'][key], TFModel)}
+        run['state'].save(next_epoch, extra, finished, writer=writer)
+
+    def save_models(run, epoch):
+        ops = run['tf_ops']
+        models = [ops['fan']]
+
+        if joint_optimization[0]:
+            models.append(ops['nip'])
+
+        if isinstance(ops['dcn'], compression.DCN) and joint_optimization[1]:
+            models.append(ops['dcn'])
+
+        # Snapshot all models with a single sess.run - checkpoints are written in the background
+        writer.save_models(models, [os.path.join(run['model_directory'], model.checkpoint_name) for model in models], epoch)
 
     print('')
-    for k, v in training_summary.items():
+    for k, v in runs[0]['summary'].items():
         print('{:30s}: {}'.format(k, v))
     print('\n', flush=True)
 
-    with tqdm.tqdm(total=training['n_epochs'], ncols=120, desc='Train') as pbar:
+    # Figures are rendered in a background process (off the critical path)
+    renderer = rendering.AsyncRenderer()
+
+    # Checkpoints are written in a background thread (the training loop only fetches the variables)
+    writer = checkpoints.AsyncCheckpointWriter()
+
+    # Per-stage profiling - replicas share the training step, so a single profile is stored for the whole group (in
+    # the common directory of the replicas) and progress files of the replicas refer to it
+    group_dir = os.path.commonpath([run['save_dir'] for run in runs])
+    profile_file = os.path.join(group_dir, 'profiling.json')
+    profiler = profiling.Profiler(trace_every, os.path.join(group_dir, 'traces'))
+    summary_writer = tf.summary.FileWriter(os.path.join(group_dir, 'profiling'))
+
+    for run in runs:
+        run['summary']['Profiling'] = '{}'.format(profile_file)
+
+    def save_profile():
+        with open(profile_file, 'w') as f:
+            json.dump(profiler.summary(), f, indent=4)
+
+    start_epoch = min(run['start_epoch'] for run in runs)
+
+    try:
+        with tqdm.tqdm(total=settings['n_epochs'], initial=start_epoch, ncols=120, desc='Train') as pbar:
         
-        epoch = 0
-        conf = np.identity(len(distribution['forensics_classes']))
-
-        for epoch in range(0, training['n_epochs']):
-
-            for batch_id in range(n_batches):
-
-                # Extract random patches for the current batch of images
-                if data._loaded_data == 'xy':
-                    batch_x, batch_y = data.next_training_batch(batch_id, batch_size, 2 * patch_size)
-                else:
-                    batch_x = data.next_training_batch(batch_id, batch_size, 2 * patch_size)
-                    batch_y = batch_x
-
-                if any(joint_optimization):
-                    # Make custom optimization step                    
-                    comb_loss, nip_loss, _ = tf_ops['sess'].run([tf_ops['loss'], tf_ops['nip'].loss, tf_ops['opt']], feed_dict={
-                        tf_ops['nip'].x if data._loaded_data == 'xy' else tf_ops['nip'].yy: batch_x,
-                        tf_ops['nip'].y_gt: batch_y,
-                        tf_ops['fan'].y: batch_l,
-                        tf_ops['lr']: learning_rate,
-                        tf_ops['lambda_nip']: training['lambda_nip'],
-                        tf_ops['lambda_dcn']: training['lambda_dcn']
-                    })                    
-                    
-                    loss_epoch['nip'].append(nip_loss)
-                else:
-                    # Update only the forensics network
-                    comb_loss = tf_ops['fan'].training_step(batch_x, batch_l, learning_rate)
-                    nip_loss = np.nan
-
-                loss_epoch['fan'].append(comb_loss)
-                loss_epoch['nip'].append(nip_loss)
-
-            # Average and record loss values
-            for model_name in model_list:
-                tf_ops[model_name].performance['loss']['training'].append(float(np.mean(loss_epoch[model_name])))
-                loss_last_k_epochs[model_name].append(tf_ops[model_name].performance['loss']['training'][-1])
-
-            if epoch % sampling_rate == 0:
-
-                # Validate the NIP model
-                if joint_optimization[0]:
-                    values = validation.validate_nip(tf_ops['nip'], data, nip_save_dir, epoch=epoch, show_ref=True, loss_type=tf_ops['nip'].loss_metric)
-                    for metric, val_array in zip(['ssim', 'psnr', 'loss'], values):
-                        tf_ops['nip'].performance[metric]['validation'].append(float(np.mean(val_array)))
-                        
-                # Validate the DCN model
-                if joint_optimization[1]:
-                    values = validation.validate_dcn(tf_ops['dcn'], data, nip_save_dir, epoch=epoch, show_ref=True)
-                    for metric, val_array in zip(['ssim', 'psnr', 'loss', 'entropy'], values):
-                        tf_ops['dcn'].performance[metric]['validation'].append(float(np.mean(val_array)))                    
+            epoch = 0
+
+            for epoch in range(start_epoch, settings['n_epochs']):
+
+                # Resumed runs join when their saved epoch is reached
+                active_runs = [run for run in runs if run['start_epoch'] <= epoch]
+
+                for batch_id in range(n_batches):
+
+                    # Build a single step for all replicas - each replica gets its own batch of random patches
+                    fetches = []
+                    feed_dict = {}
+
+                    for run in active_runs:
+                        ops = run['tf_ops']
+
+                        with profiler.stage('sampling'):
+                            # Extract random patches for the current batch of images
+                            if data._loaded_data == 'xy':
+                                batch_x, batch_y = data.next_training_batch(batch_id, batch_size, 2 * patch_size)
+                            else:
+                                batch_x = data.next_training_batch(batch_id, batch_size, 2 * patch_size)
+                                batch_y = batch_x
+
+                        if any(joint_optimization):
+                            # Make custom optimization step
+                            fetches.append([ops['loss'], ops['nip'].loss, ops['opt']])
+                            feed_dict.update({
+                                ops['nip'].x if data._loaded_data == 'xy' else ops['nip'].yy: batch_x,
+                                ops['nip'].y_gt: batch_y,
+                                ops['fan'].y: batch_l,
+                                ops['lr']: run['learning_rate'],
+                                ops['lambda_nip']: run['training']['lambda_nip'],
+                                ops['lambda_dcn']: run['training']['lambda_dcn']
+                            })
+                        else:
+                            # Update only the forensics network (see FAN.training_step)
+                            fan_fetches, fan_feed_dict = ops['fan'].training_fetches(batch_x, batch_l, run['learning_rate'])
+                            fetches.append(fan_fetches)
+                            feed_dict.update(fan_feed_dict)
+
+                    outputs = profiler.run(sess, fetches, feed_dict)
+
+                    for run, output in zip(active_runs, outputs):
+                        if any(joint_optimization):
+                            comb_loss, nip_loss = output[0], output[1]
+                            run['loss_epoch']['nip'].append(nip_loss)
+                        else:
+                            comb_loss, nip_loss = output[1], np.nan
+
+                        run['loss_epoch']['fan'].append(comb_loss)
+                        run['loss_epoch']['nip'].append(nip_loss)
+
+                # Average and record loss values
+                for run in active_runs:
+                    for model_name in model_list:
+                        run['tf_ops'][model_name].performance['loss']['training'].append(float(np.mean(run['loss_epoch'][model_name])))
+                        run['loss_last_k_epochs'][model_name].append(run['tf_ops'][model_name].performance['loss']['training'][-1])
+
+                if epoch % sampling_rate == 0:
+
+                    for run in active_runs:
+                        ops = run['tf_ops']
+
+                        with profiler.stage('validation'):
+                            # Validate all models with a single forward pass per batch (NIP -> channel -> FAN)
+                            results = validation.validate_manipulation(ops, data, lambda x: batch_labels(x, n_classes), run['save_dir'], epoch=epoch, show_ref=True, loss_type=ops['nip'].loss_metric, nip_metrics=joint_optimization[0], dcn_metrics=joint_optimization[1], renderer=renderer)
+
+                            if results['nip'] is not None:
+                                for metric, val_array in zip(['ssim', 'psnr', 'loss'], results['nip']):
+                                    ops['nip'].performance[metric]['validation'].append(float(np.mean(val_array)))
+
+                            if results['dcn'] is not None:
+                                for metric, val_array in zip(['ssim', 'psnr', 'loss', 'entropy'], results['dcn']):
+                                    ops['dcn'].performance[metric]['validation'].append(float(np.mean(val_array)))
+
+                            ops['fan'].performance['accuracy']['validation'].append(float(results['fan']['accuracy']))
+                            run['conf'] = results['fan']['confusion']
+
+                        with profiler.stage('plotting'):
+                            # Visualize current progress (in the background renderer - matplotlib memory stays out of the trainer)
+                            validation.visualize_manipulation_training(ops['nip'], ops['fan'], ops['dcn'], run['conf'], epoch, run['save_dir'], classes=distribution['forensics_classes'], renderer=renderer)
+
+                        with profiler.stage('checkpointing'):
+                            # Save progress stats
+                            validation.save_training_progress(run['summary'], ops['nip'], ops['fan'], ops['dcn'], run['conf'], run['save_dir'])
+
+                            # Save models
+                            save_models(run, epoch)
+
+                    # Monitor memory usage
+                    # gc.collect()
+                    if collect_memory_stats['tf']:
+                        memory['tf-ram'].append(round(tf_helpers.memory_usage_tf(sess) / 1024 / 1024, 1))
+                        memory['tf-vars'].append(round(tf_helpers.memory_usage_tf_variables() / 1024 / 1024, 1))
+
+                    if collect_memory_stats['ram']:
+                        memory['cpu-proc'].append(round(coreutils.memory_usage_proc(), 1))
+                        memory['cpu-resource'].append(round(coreutils.memory_usage_resource(), 1))
+
+                if epoch % learning_rate_decay_schedule == 0:
+                    for run in active_runs:
+                        run['learning_rate'] *= learning_rate_decay_rate
+
+                # Save the training state (after the learning rate update - ready for the next epoch)
+                if epoch % sampling_rate == 0:
+                    with profiler.stage('checkpointing'):
+                        for run in active_runs:
+                            save_state(run, epoch + 1)
+
+                profiler.end_epoch(epoch)
+
+                if epoch % sampling_rate == 0:
+                    profiler.write_summaries(summary_writer, epoch)
+                    save_profile()
+
+                # Update the progress bar (averaged over replicas)
+                progress_stats = {
+                    'nip': np.log10(np.mean([np.mean(run['loss_last_k_epochs']['nip']) for run in active_runs])).round(1),
+                    'fan': np.mean([np.mean(run['loss_last_k_epochs']['fan']) for run in active_runs]),
+                    'acc': np.mean([run['tf_ops']['fan'].performance['accuracy']['validation'][-1] for run in active_runs]),
+                }
+            
+                if distribution['compression'] == 'dcn' and joint_optimization[1]:
+                    progress_stats['dcn'] = np.mean([run['tf_ops']['dcn'].performance['ssim']['validation'][-1] for run in active_runs])
+                    progress_stats['H'] = np.mean([run['tf_ops']['dcn'].performance['entropy']['validation'][-1] for run in active_runs])
 
-                # Validate the forensics network
-                accuracy = validation.validate_fan(tf_ops['fan'], data, lambda x: batch_labels(x, n_classes), n_classes)
-                tf_ops['fan'].performance['accuracy']['validation'].append(accuracy)
+                if len(active_runs[0]['tf_ops']['nip'].performance['psnr']['validation']) > 0:
+                    progress_stats['psnr'] = np.mean([run['tf_ops']['nip'].performance['psnr']['validation'][-1] for run in active_runs])
 
-                # Confusion matrix
-                conf = validation.confusion(tf_ops['fan'], data, lambda x: batch_labels(x, n_classes))
+                if collect_memory_stats['ram']:
+                    progress_stats['ram'] = round(memory['cpu-proc'][-1]//1024, 2)
 
-                # Visualize current progress
-                # TODO Memory is leaking here - looks like some problem in matplotlib - skip for now
-                # validation.visualize_manipulation_training(model, fan, conf, epoch, nip_save_dir, classes=distribution['forensics_classes'])
+                pbar.set_postfix(**progress_stats)
+                pbar.update(1)
 
-                # Save progress stats
-                validation.save_training_progress(training_summary, tf_ops['nip'], tf_ops['fan'], tf_ops['dcn'], conf, nip_save_dir)
+        # Wait for pending figures - final results are plotted inline (cannot be dropped)
+        renderer.close()
 
-                # Save models
-                tf_ops['fan'].save_model(os.path.join(model_directory, tf_ops['fan'].scoped_name), epoch)
+        for run in runs:
+            ops = run['tf_ops']
 
-                if joint_optimization[0]:
-                    tf_ops['nip'].save_model(os.path.join(model_directory, tf_ops['nip'].scoped_name), epoch)
+            # Plot final results
+            if joint_optimization[0]:
+                values = validation.validate_nip(ops['nip'], data, run['save_dir'], epoch=epoch, show_ref=True, loss_type='L2')
+                for metric, val_array in zip(['ssim', 'psnr', 'loss'], values):
+                    ops['nip'].performance[metric]['validation'].append(float(np.mean(val_array)))
 
-                if isinstance(tf_ops['dcn'], compression.DCN) and joint_optimization[1]:
-                    tf_ops['dcn'].save_model(os.path.join(model_directory, tf_ops['dcn'].scoped_name), epoch)
+            if joint_optimization[1]:
+                if isinstance(ops['dcn'], compression.DCN):
+                    values = validation.validate_dcn(ops['dcn'], data, run['save_dir'], epoch=epoch, show_ref=True)
+                    for metric, val_array in zip(['ssim', 'psnr', 'loss', 'entropy'], values):
+                        ops['dcn'].performance[metric]['validation'].append(float(np.mean(val_array)))
 
-                # Monitor memory usage
-                # gc.collect()
-                if collect_memory_stats['tf']:
-                    memory['tf-ram'].append(round(tf_helpers.memory_usage_tf(tf_ops['sess']) / 1024 / 1024, 1))
-                    memory['tf-vars'].append(round(tf_helpers.memory_usage_tf_variables() / 1024 / 1024, 1))
+            # Compute confusion matrix
+            conf = validation.confusion(ops['fan'], data, lambda x: batch_labels(x, n_classes))
 
-                if collect_memory_stats['ram']:
-                    memory['cpu-proc'].append(round(coreutils.memory_usage_proc(), 1))
-                    memory['cpu-resource'].append(round(coreutils.memory_usage_resource(), 1))
+            # Save model progress
+            validation.save_training_progress(run['summary'], ops['nip'], ops['fan'], ops['dcn'], conf, run['save_dir'])
 
-            if epoch % learning_rate_decay_schedule == 0:
-                learning_rate *= learning_rate_decay_rate
+            # Visualize final progress
+            validation.visualize_manipulation_training(ops['nip'], ops['fan'], ops['dcn'], conf, epoch, run['save_dir'], classes=distribution['forensics_classes'])
 
-            # Update the progress bar
-            progress_stats = {
-                'nip': np.log10(np.mean(loss_last_k_epochs['nip'])).round(1),                
-                'fan': np.mean(loss_last_k_epochs['fan']),
-                'acc': tf_ops['fan'].performance['accuracy']['validation'][-1],
-            }
-            
-            if distribution['compression'] == 'dcn' and joint_optimization[1]:
-                progress_stats['dcn'] = tf_ops['dcn'].performance['ssim']['validation'][-1]
-                progress_stats['H'] = tf_ops['dcn'].performance['entropy']['validation'][-1]
-
-            if len(tf_ops['nip'].performance['psnr']['validation']) > 0:
-                progress_stats['psnr'] = tf_ops['nip'].performance['psnr']['validation'][-1]
-
-            if collect_memory_stats['ram']:
-                progress_stats['ram'] = round(memory['cpu-proc'][-1]//1024, 2)
-
-            pbar.set_postfix(**progress_stats)
-            pbar.update(1)
-
-    # Plot final results
-    if joint_optimization[0]:
-        values = validation.validate_nip(tf_ops['nip'], data, nip_save_dir, epoch=epoch, show_ref=True, loss_type='L2')
-        for metric, val_array in zip(['ssim', 'psnr', 'loss'], values):
-            tf_ops['nip'].performance[metric]['validation'].append(float(np.mean(val_array)))
-
-    if joint_optimization[1]:
-        if isinstance(tf_ops['dcn'], compression.DCN):
-            values = validation.validate_dcn(tf_ops['dcn'], data, nip_save_dir, epoch=epoch, show_ref=True)
-            for metric, val_array in zip(['ssim', 'psnr', 'loss', 'entropy'], values):
-                tf_ops['dcn'].performance[metric]['validation'].append(float(np.mean(val_array)))
-        
-    # Compute confusion matrix
-    conf = validation.confusion(tf_ops['fan'], data, lambda x: batch_labels(x, n_classes))
+            # Save models
+            save_models(run, epoch)
 
-    # Save model progress
-    validation.save_training_progress(training_summary, tf_ops['nip'], tf_ops['fan'], tf_ops['dcn'], conf, nip_save_dir)
+            if isinstance(ops['dcn'], compression.DCN) and joint_optimization[1]:
+                dcn_dirname = os.path.join(run['model_directory'], ops['dcn'].checkpoint_name)
+                os.makedirs(dcn_dirname, exist_ok=True)
+                shutil.copyfile(os.path.join(distribution['compression_params']['dirname'], ops['dcn'].checkpoint_name, 'progress.json'),
+                                os.path.join(dcn_dirname, 'progress.json'))
 
-    # Visualize current progress
-    validation.visualize_manipulation_training(tf_ops['nip'], tf_ops['fan'], tf_ops['dcn'], conf, epoch, nip_save_dir, classes=distribution['forensics_classes'])
+            # Mark the training state as finished (nothing to resume)
+            save_state(run, settings['n_epochs'], finished=True)
 
-    # Save models
-    print('Saving models...', end='')
+        # Wait for pending checkpoints
+        print('Saving models...', end='', flush=True)
+        writer.close()
+        print(' done')
 
-    tf_ops['fan'].save_model(os.path.join(model_directory, tf_ops['fan'].scoped_name), epoch)
-    print(' fan', end='')
-    
-    if joint_optimization[0]:
-        tf_ops['nip'].save_model(os.path.join(model_directory, tf_ops['nip'].scoped_name), epoch)
-        print(' nip', end='')
-    
-    if isinstance(tf_ops['dcn'], compression.DCN) and joint_optimization[1]:
-        tf_ops['dcn'].save_model(os.path.join(model_directory, tf_ops['dcn'].scoped_name), epoch)
-        shutil.copyfile(os.path.join(distribution['compression_params']['dirname'], tf_ops['dcn'].scoped_name, 'progress.json'),
-                        os.path.join(model_directory, tf_ops['dcn'].scoped_name, 'progress.json'))
-        print(' dcn', end='')
-    
-    print('')  # \newline
-    
-    return model_directory
+        save_profile()
+
+    finally:
+        # Write pending checkpoints & figures (also if the training fails or is interrupted)
+        writer.close()
+        renderer.close()
+        summary_writer.close()
+
+    return model_directories
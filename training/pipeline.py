@@ -1,13 +1,15 @@
 #!/usr/bin/env python3
 # coding: utf-8
 import os
+import copy
 import json
 from collections import deque, OrderedDict
 
 import numpy as np
 import matplotlib.pylab as plt
 from tqdm import tqdm
-from skimage.measure import compare_ssim, compare_psnr, compare_mse
+
+from helpers import metrics, rendering, profiling
 
 # Set progress bar width
 TQDM_WIDTH = 120
@@ -16,61 +18,34 @@ TQDM_WIDTH = 120
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
 
-def validate(model, data, out_directory, savefig=False, epoch=0, show_ref=False, loss_metric='L2'):
+def validate(model, data, out_directory, savefig=False, epoch=0, show_ref=False, loss_metric='L2', batch_size=10, renderer=None):
     
-    ssims, psnrs, losss = [], [], []
-
     if loss_metric not in ['L2', 'L1']:
         raise ValueError('Unsupported loss ({})!'.format(loss_metric))
 
-    if savefig:
-        images_x = np.minimum(data.count_validation, 10 if not show_ref else 5)
-        images_y = np.ceil(data.count_validation / images_x)
-        plt.figure(figsize=(20, 20 / images_x * images_y * (1 if not show_ref else 0.5)))
-        
-    developed_out = np.zeros_like(data['validation']['y'], dtype=np.float32)
-
-    for b in range(data.count_validation):
-
-        # Fetch the next example and develop the RGB image
-        example_x, example_y = data.next_validation_batch(b, 1)
-        developed = model.process(example_x)
-        developed = np.clip(developed, 0, 1)
-        developed_out[b, :, :, :] = developed
-        developed = developed[:, :, :, :].squeeze()        
-        reference = example_y.squeeze()
-
-        # Compute loss & quality metrics
-        ssim = float(compare_ssim(reference, developed, multichannel=True))
-        psnr = float(compare_psnr(reference, developed))
-
-        if loss_metric == 'L2':
-            loss = float(np.mean(np.power(255.0*reference - 255.0*developed, 2.0)))
-        elif loss_metric == 'L1':
-            loss = float(np.mean(np.abs(255.0*reference - 255.0*developed)))
-        else:
-            raise ValueError('Unsupported loss ({})!'.format(loss_metric))
-
-        ssims.append(ssim)
-        psnrs.append(psnr)
-        losss.append(loss)
-
-        if savefig:
-            plt.subplot(images_y, images_x, b+1)
-            if show_ref:
-                plt.imshow(np.concatenate((reference, developed), axis=1))
-            else:
-                plt.imshow(developed)
-            plt.xticks([])
-            plt.yticks([])
-            label_index = int(b // (data.count_validation / len(data.files['validation'])))
-            plt.title('{} : {:.1f} dB / {:.2f}'.format(data.files['validation'][label_index], psnr, ssim), fontsize=6)
+    # Develop the RGB images & compute loss and quality metrics in a few passes
+    # (SSIM w.r.t. the full float range [-1, 1] for consistency with earlier results)
+    batch_x, references = data.next_validation_batch(0, data.count_validation)
+    evaluation = model.evaluate(batch_x, references, batch_size, ssim_data_range=2)
+    developed_out = evaluation['y']
+    ssims = evaluation['ssim'].tolist()
+    psnrs = evaluation['psnr'].tolist()
+
+    if loss_metric == model.loss_metric:
+        losss = evaluation['loss'].tolist()
+    elif loss_metric == 'L2':
+        losss = np.mean(np.power(255.0*references - 255.0*developed_out, 2.0), axis=(1, 2, 3)).tolist()
+    else:
+        losss = np.mean(np.abs(255.0*references - 255.0*developed_out), axis=(1, 2, 3)).tolist()
 
     if savefig:
-        if not os.path.exists(out_directory):
-            os.makedirs(out_directory)
-        plt.savefig(os.path.join(out_directory, 'validation_{:05d}.jpg'.format(epoch)), bbox_inches='tight', dpi=150)
-        plt.close()
+        n_per_file = data.count_validation / len(data.files['validation'])
+        titles = ['{} : {:.1f} dB / {:.2f}'.format(data.files['validation'][int(b // n_per_file)], psnr, ssim)
+                  for b, (psnr, ssim) in enumerate(zip(psnrs, ssims))]
+        rendering.submit(renderer, rendering.save_image_grid,
+                         filename=os.path.join(out_directory, 'validation_{:05d}.jpg'.format(epoch)),
+                         images=rendering.to_uint8(np.concatenate((references, developed_out), axis=2) if show_ref else developed_out),
+                         titles=titles, n_cols=10 if not show_ref else 5, fontsize=6, dpi=150)
     
     return ssims, psnrs, losss, developed_out
 
@@ -116,17 +91,24 @@ def visualize_progress(arch, performance, patch_size, camera_name, out_directory
         plt.close()
 
 
-def save_progress(performance, training_summary, out_directory):
+def save_progress(performance, training_summary, out_directory, profiler=None):
 
     filename = os.path.join(out_directory, 'progress.json')
     output_stats = {'performance': performance}
     output_stats.update(training_summary)
+    if profiler is not None:
+        output_stats['profiling'] = profiler.summary()
     with open(filename, 'w') as f:
         json.dump(output_stats, f, indent=4)
 
 
-def train_nip_model(model, camera_name, n_epochs=10000, validation_loss_threshold=1e-3, sampling_rate=100, resume=False, patch_size=64, batch_size=20, data=None, out_directory_root='./data/models/nip'):
-    
+def train_nip_model(model, camera_name, n_epochs=10000, validation_loss_threshold=1e-3, sampling_rate=100, resume=False, patch_size=64, batch_size=20, data=None, out_directory_root='./data/models/nip', trace_every=None):
+    """
+    Train a NIP model. Time spent in training stages (sampling, sess.run, validation, plotting, checkpointing) and
+    memory usage are recorded for every epoch (see helpers.profiling) - set 'trace_every' to capture full step traces
+    of every N-th training step.
+    """
+
     if data is None:
         raise ValueError('Training data seems not to be loaded!')
         
@@ -200,59 +182,83 @@ def train_nip_model(model, camera_name, n_epochs=10000, validation_loss_threshol
         print('{:30s}: {}'.format(k, v))
     print('', flush=True)
 
-    with tqdm(total=n_epochs, ncols=TQDM_WIDTH, desc='Train {} for {}'.format(type(model).__name__, camera_name)) as pbar:
-        pbar.update(start_epoch)
-
-        for epoch in range(start_epoch, n_epochs):
-
-            for batch_id in range(n_batches):
-                batch_x, batch_y = data.next_training_batch(batch_id, batch_size, patch_size, discard_flat=False)
-                loss = model.training_step(batch_x, batch_y, learning_rate)
-                loss_local.append(loss)
+    # Figures are rendered in a background process (off the critical path)
+    renderer = rendering.AsyncRenderer()
 
-            model.performance['loss']['training'].append(float(np.mean(loss_local)))
-            losses_buf.append(model.performance['loss']['training'][-1])
+    # Per-stage profiling (reported in progress.json and TensorBoard)
+    profiler = profiling.Profiler(trace_every, os.path.join(out_directory, 'traces'))
+    model.profiler = profiler
 
-            if epoch == start_epoch:
-                developed = np.zeros_like(data['validation']['y'], dtype=np.float32)
-
-            if epoch % sampling_rate == 0:
-                # Use the current model to develop images in the validation set
-                developed_old = developed
-                ssims, psnrs, v_losses, developed = validate(model, data, out_directory, True, epoch, True, loss_metric=model.loss_metric)
-                model.performance['ssim']['validation'].append(float(np.mean(ssims)))
-                model.performance['psnr']['validation'].append(float(np.mean(psnrs)))
-                model.performance['loss']['validation'].append(float(np.mean(v_losses)))
-
-                # Compare the current images to the ones from a previous model iteration
-                dmses = []
-                for v in range(data['validation']['x'].shape[0]):
-                    dmses.append(compare_mse(developed_old[v, :, :, :], developed[v, :, :, :]))
-
-                model.performance['dmse']['validation'].append(np.mean(dmses))
-
-                # Generate progress summary
-                training_summary['Epoch'] = epoch
-                visualize_progress(model.class_name, model.performance, patch_size, camera_name, out_directory, False, sampling_rate)
-                save_progress(model.performance, training_summary, out_directory)
-                model.save_model(out_directory, epoch)
-
-                # Check for convergence
-                if len(model.performance['loss']['validation']) > 10:
-                    current = np.mean(model.performance['loss']['validation'][-n_tail:-1])
-                    previous = np.mean(model.performance['loss']['validation'][-(n_tail + 1):-2])
-                    vloss_change = abs((current - previous) / previous)
-
-                    if vloss_change < validation_loss_threshold:
-                        print('Early stopping - the model converged, validation loss change {}'.format(vloss_change))
-                        break
-
-            pbar.set_postfix(loss=np.mean(losses_buf), psnr=model.performance['psnr']['validation'][-1], dmse=np.log10(model.performance['dmse']['validation'][-1]))
-            pbar.update(1)
-
-    training_summary['Epoch'] = epoch
-    visualize_progress(model.class_name, model.performance, patch_size, camera_name, out_directory, False, sampling_rate)
-    save_progress(model.performance, training_summary, out_directory)
-    model.save_model(out_directory, epoch)
+    try:
+        with tqdm(total=n_epochs, ncols=TQDM_WIDTH, desc='Train {} for {}'.format(type(model).__name__, camera_name)) as pbar:
+            pbar.update(start_epoch)
+
+            for epoch in range(start_epoch, n_epochs):
+
+                for batch_id in range(n_batches):
+                    with profiler.stage('sampling'):
+                        batch_x, batch_y = data.next_training_batch(batch_id, batch_size, patch_size, discard_flat=False)
+                    loss = model.training_step(batch_x, batch_y, learning_rate)
+                    loss_local.append(loss)
+
+                model.performance['loss']['training'].append(float(np.mean(loss_local)))
+                losses_buf.append(model.performance['loss']['training'][-1])
+
+                if epoch == start_epoch:
+                    developed = np.zeros_like(data['validation']['y'], dtype=np.float32)
+
+                if epoch % sampling_rate == 0:
+                    # Use the current model to develop images in the validation set
+                    with profiler.stage('validation'):
+                        developed_old = developed
+                        ssims, psnrs, v_losses, developed = validate(model, data, out_directory, True, epoch, True, loss_metric=model.loss_metric, renderer=renderer)
+                        model.performance['ssim']['validation'].append(float(np.mean(ssims)))
+                        model.performance['psnr']['validation'].append(float(np.mean(psnrs)))
+                        model.performance['loss']['validation'].append(float(np.mean(v_losses)))
+
+                        # Compare the current images to the ones from a previous model iteration
+                        dmses = metrics.mse(developed_old, developed)
+                        model.performance['dmse']['validation'].append(float(np.mean(dmses)))
+
+                    # Generate progress summary
+                    training_summary['Epoch'] = epoch
+                    with profiler.stage('plotting'):
+                        renderer.submit(visualize_progress, arch=model.class_name, performance=copy.deepcopy(model.performance),
+                                        patch_size=patch_size, camera_name=camera_name, out_directory=out_directory,
+                                        sampling_rate=sampling_rate)
+
+                    with profiler.stage('checkpointing'):
+                        save_progress(model.performance, training_summary, out_directory, profiler)
+                        model.save_model(out_directory, epoch)
+
+                    # Check for convergence
+                    if len(model.performance['loss']['validation']) > 10:
+                        current = np.mean(model.performance['loss']['validation'][-n_tail:-1])
+                        previous = np.mean(model.performance['loss']['validation'][-(n_tail + 1):-2])
+                        vloss_change = abs((current - previous) / previous)
+
+                        if vloss_change < validation_loss_threshold:
+                            print('Early stopping - the model converged, validation loss change {}'.format(vloss_change))
+                            break
+
+                profiler.end_epoch(epoch)
+
+                if epoch % sampling_rate == 0:
+                    profiler.write_summaries(model.get_summary_writer(out_directory), epoch)
+
+                pbar.set_postfix(loss=np.mean(losses_buf), psnr=model.performance['psnr']['validation'][-1], dmse=np.log10(model.performance['dmse']['validation'][-1]))
+                pbar.update(1)
+
+        # Wait for pending figures
+        renderer.close()
+
+        training_summary['Epoch'] = epoch
+        visualize_progress(model.class_name, model.performance, patch_size, camera_name, out_directory, False, sampling_rate)
+        save_progress(model.performance, training_summary, out_directory, profiler)
+        model.save_model(out_directory, epoch)
+
+    finally:
+        renderer.close()
+        model.profiler = None
 
     return out_directory
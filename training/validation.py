@@ -1,56 +1,97 @@
 import os
+import copy
 import types
 import json
 import numpy as np
 import matplotlib.pyplot as plt
 from collections import OrderedDict
-from helpers import utils, plotting
-from skimage.measure import compare_ssim, compare_psnr
+from helpers import utils, rendering
 from models.pipelines import NIPModel
 from models.compression import DCN
 
 
-def confusion(fan, data, label_generator, label_multiplier=1):
+def evaluate_fan(fan, data, label_generator, label_multiplier=1, batch_size=10, soft=False):
     """
-    Generates a confusion matrix for the FAN model on the validation set.
+    Evaluates the FAN model on the validation set in a single pass (including the last, incomplete batch).
 
     :param fan: FAN model
     :param data: the dataset (instance of IPDataset)
-    :param label_generator: a lambda function which generates GT class labels given the size of the batch
-    :param label_multiplier:
-    :return: 2-D numpy array with the confusion matrix
+    :param label_generator: a lambda function which generates GT class labels given the size of the batch (or an
+           array with labels for the whole validation set)
+    :param label_multiplier: number of labels per validation image (if labels are given as an array)
+    :param batch_size: number of validation images processed in a single pass
+    :param soft: whether to also compute average class probabilities (soft confusion matrix)
+    :return: dict with accuracy, confusion matrix (rows - true class, normalized by the number of images), predicted
+             labels and (optionally) 'confidence' - average predicted probabilities for each true class
     """
 
-    batch_size = np.minimum(10, data.count_validation)
-    n_batches = data.count_validation // batch_size
+    batch_size = int(np.minimum(batch_size, data.count_validation))
     n_classes = fan.n_classes
-    
-    conf = np.zeros((n_classes, n_classes))
-    
-    for batch in range(n_batches):
 
-        batch_x = data.next_validation_batch(batch, batch_size)
-        if isinstance(batch_x, tuple):
-            batch_x = batch_x[0]
+    counts = np.zeros((n_classes * n_classes,), dtype=np.int64)
+    confidence = np.zeros((n_classes, n_classes))
+    out_labels = []
+
+    # Fetch the whole validation set - consecutive batches are sliced from it
+    data_x = data.next_validation_batch(0, data.count_validation)
+    if isinstance(data_x, tuple):
+        data_x = data_x[0]
+
+    for start in range(0, data.count_validation, batch_size):
+
+        batch_x = data_x[start:start + batch_size]
 
         if isinstance(label_generator, types.FunctionType):
             batch_y = label_generator(len(batch_x))
         else:
-            batch_y = label_generator[(batch * batch_size * label_multiplier):(batch + 1) * batch_size * label_multiplier]
+            batch_y = label_generator[(start * label_multiplier):(start + len(batch_x)) * label_multiplier]
 
-        predicted_labels = fan.process(batch_x)
+        probabilities = fan.process_soft(batch_x)
+        predicted_labels = np.argmax(probabilities, axis=1)
 
-        for c in range(n_classes):
-            for c_ in range(n_classes):
-                conf[c, c_] += np.sum((batch_y == c) * (predicted_labels == c_))
+        if len(predicted_labels) != len(batch_y):
+            raise RuntimeError('Number of labels is not equal to the number of predictions! {} vs. {}'.format(len(batch_y), len(predicted_labels)))
 
-    if n_batches * batch_size != data.count_validation:
-        print('WARNING Not enough images to fill the last batch ({})'.format(batch_size))
+        counts += np.bincount(n_classes * batch_y + predicted_labels, minlength=n_classes * n_classes)
+        out_labels.append(predicted_labels)
 
-    return conf / (n_batches * batch_size)
+        if soft:
+            confidence += np.eye(n_classes)[batch_y].T @ probabilities
 
+    return _fan_results(counts, out_labels, data.count_validation, confidence if soft else None)
 
-def validate_dcn(dcn, data, save_dir=False, epoch=0, show_ref=False):
+
+def _fan_results(counts, out_labels, n_images, confidence=None):
+    """ Summarize accumulated FAN predictions (see 'evaluate_fan'). """
+    n_classes = int(np.sqrt(len(counts)))
+    counts = counts.reshape((n_classes, n_classes))
+
+    results = {
+        'accuracy': np.trace(counts) / counts.sum(),
+        'confusion': counts / n_images,
+        'labels': np.concatenate(out_labels)
+    }
+
+    if confidence is not None:
+        results['confidence'] = confidence / np.maximum(counts.sum(axis=1, keepdims=True), 1)
+
+    return results
+
+
+def confusion(fan, data, label_generator, label_multiplier=1):
+    """
+    Generates a confusion matrix for the FAN model on the validation set.
+
+    :param fan: FAN model
+    :param data: the dataset (instance of IPDataset)
+    :param label_generator: a lambda function which generates GT class labels given the size of the batch
+    :param label_multiplier:
+    :return: 2-D numpy array with the confusion matrix
+    """
+    return evaluate_fan(fan, data, label_generator, label_multiplier)['confusion']
+
+
+def validate_dcn(dcn, data, save_dir=False, epoch=0, show_ref=False, batch_size=10, renderer=None):
     """
     Computes validation metrics for a compression model (DCN). (If not a DCN, the function returns immediately).
     If requested, plot compressed images to a JPEG image.
@@ -60,6 +101,8 @@ def validate_dcn(dcn, data, save_dir=False, epoch=0, show_ref=False):
     :param save_dir: path to the directory where figures should be generated
     :param epoch: epoch counter to be appended to the output filename
     :param show_ref: whether to show only the compressed image or also the input image as reference
+    :param batch_size: number of images processed in a single pass
+    :param renderer: background renderer for the figure (see helpers.rendering) - rendered inline if None
     :return: tuple of lists with per-image measurements of (ssims, psnrs, losses, entropies)
     """
     
@@ -70,42 +113,28 @@ def validate_dcn(dcn, data, save_dir=False, epoch=0, show_ref=False):
     batch_x = data.next_validation_batch(0, data.count_validation)
     if isinstance(batch_x, tuple):
         batch_x = batch_x[-1]
-    batch_z = dcn.compress(batch_x, direct=True)
-    batch_y = dcn.process(batch_x, direct=True)
 
-    # Compute quality measures and entropy statistics
-    codebook = dcn.get_codebook()
-    
-    ssims = [compare_ssim(batch_x[b], batch_y[b], multichannel=True, data_range=1) for b in range(data.count_validation)]
-    psnrs = [compare_psnr(batch_x[b], batch_y[b], data_range=1) for b in range(data.count_validation)]
-    losses = [dcn.sess.run(dcn.loss, feed_dict={dcn.x: batch_x[b:b + 1]}) for b in range(data.count_validation)]
-    entropies = [utils.entropy(batch_z[b], codebook) for b in range(data.count_validation)]
+    # Compute compressed output, quality measures and entropy statistics in a single pass
+    evaluation = dcn.evaluate(batch_x, direct=True, batch_size=batch_size)
+    batch_y = evaluation['y']
+
+    ssims = evaluation['ssim'].tolist()
+    psnrs = evaluation['psnr'].tolist()
+    losses = evaluation['loss'].tolist()
+    entropies = evaluation['entropy'].tolist()
 
     # If requested, plot a figure with input/output pairs
     if save_dir is not None:
-        images_x = np.minimum(data.count_validation, 10 if not show_ref else 5)
-        images_y = np.ceil(data.count_validation / images_x)
-        fig = plt.figure(figsize=(20, 20 / images_x * images_y * (1 if not show_ref else 0.5)))
-
-        for b in range(data.count_validation):
-            ax = fig.add_subplot(images_y, images_x, b + 1)
-            plotting.quickshow(
-                np.concatenate((batch_x[b], batch_y[b]), axis=1) if show_ref else batch_y[b],
-                '{:.1f} / {:.2f}'.format(psnrs[b], ssims[b]),
-                axes=ax
-            )
-
-        if not os.path.exists(save_dir):
-            os.makedirs(save_dir)
-
-        fig.savefig('{}/dcn_validation_{:05d}.jpg'.format(save_dir, epoch), bbox_inches='tight', dpi=100, quality=90)
-        plt.close(fig)
-        del fig
+        rendering.submit(renderer, rendering.save_image_grid,
+                         filename='{}/dcn_validation_{:05d}.jpg'.format(save_dir, epoch),
+                         images=rendering.to_uint8(np.concatenate((batch_x, batch_y), axis=2) if show_ref else batch_y),
+                         titles=['{:.1f} / {:.2f}'.format(psnr, ssim) for psnr, ssim in zip(psnrs, ssims)],
+                         n_cols=10 if not show_ref else 5, quality=90)
     
     return ssims, psnrs, losses, entropies
 
 
-def validate_nip(model, data, save_dir=False, epoch=0, show_ref=False, loss_type='L2'):
+def validate_nip(model, data, save_dir=False, epoch=0, show_ref=False, loss_type='L2', batch_size=10, renderer=None):
     """
     Develops image patches using the given NIP and returns standard image quality measures.
     If requested, resulting patches are visualized as thumbnails and saved to a directory.
@@ -116,65 +145,40 @@ def validate_nip(model, data, save_dir=False, epoch=0, show_ref=False, loss_type
     :param epoch: epoch counter to be appended to the output filename
     :param show_ref: whether to show only the developed image or also the GT target
     :param loss_type: L1 or L2
+    :param batch_size: number of patches developed in a single pass
+    :param renderer: background renderer for the figure (see helpers.rendering) - rendered inline if None
     :return: tuple of lists with per-image measurements of (ssims, psnrs, losss)
     """
 
-    ssims = []
-    psnrs = []
-    losss = []
+    if loss_type not in ['L1', 'L2']:
+        raise ValueError('Invalid loss! Use either L1 or L2.')
+
+    # Develop all patches and compute stats
+    batch_x, references = data.next_validation_batch(0, data.count_validation)
+    evaluation = model.evaluate(batch_x, references, batch_size)
+    developed_out = evaluation['y']
+    ssims = evaluation['ssim'].tolist()
+    psnrs = evaluation['psnr'].tolist()
+
+    if loss_type == 'L2':
+        losss = np.mean(np.power(references - developed_out, 2.0), axis=(1, 2, 3)).tolist()
+    else:
+        losss = np.mean(np.abs(references - developed_out), axis=(1, 2, 3)).tolist()
 
     # If requested, plot a figure with output/target pairs
     if save_dir is not None:
-        images_x = np.minimum(data.count_validation, 10 if not show_ref else 5)
-        images_y = np.ceil(data.count_validation / images_x)
-        fig = plt.figure(figsize=(20, 20 / images_x * images_y * (1 if not show_ref else 0.5)))
-        
-    developed_out = np.zeros_like(data['validation']['y'], dtype=np.float32)
-
-    for b in range(data.count_validation):
-        example_x, example_y = data.next_validation_batch(b, 1)
-        developed = model.process(example_x).clip(0, 1)
-        developed_out[b, :, :, :] = developed
-        developed = developed[:, :, :, :].squeeze()
-        reference = example_y.squeeze()
-
-        # Compute stats
-        ssim = compare_ssim(reference, developed, multichannel=True, data_range=1)
-        psnr = compare_psnr(reference, developed, data_range=1)
-        
-        if loss_type == 'L2':
-            loss = np.mean(np.power(reference - developed, 2.0))
-        elif loss_type == 'L1':
-            loss = np.mean(np.abs(reference - developed))
-        else:
-            raise ValueError('Invalid loss! Use either L1 or L2.')
-            
-        ssims.append(ssim)
-        psnrs.append(psnr)
-        losss.append(loss)
-        
-        # Add images to the plot
-        if save_dir is not None:
-            ax = fig.add_subplot(images_y, images_x, b+1)
-            plotting.quickshow(
-                np.concatenate((reference, developed), axis=1) if show_ref else developed,
-                '{:.1f} dB / {:.2f}'.format(psnr, ssim),
-                axes=ax
-            )
+        rendering.submit(renderer, rendering.save_image_grid,
+                         filename='{}/nip_validation_{:05d}.jpg'.format(save_dir, epoch),
+                         images=rendering.to_uint8(np.concatenate((references, developed_out), axis=2) if show_ref else developed_out),
+                         titles=['{:.1f} dB / {:.2f}'.format(psnr, ssim) for psnr, ssim in zip(psnrs, ssims)],
+                         n_cols=10 if not show_ref else 5, quality=90)
 
-    if save_dir is not None:
-        if not os.path.exists(save_dir):
-            os.makedirs(save_dir)
-        fig.savefig('{}/nip_validation_{:05d}.jpg'.format(save_dir, epoch), bbox_inches='tight', dpi=100, quality=90)
-        plt.close(fig)
-        del fig
-    
     return ssims, psnrs, losss
 
 
 def validate_fan(fan, data, label_generator, label_multiplier, get_labels=False):
     """
-    Generates a confusion matrix for the FAN model on the validation set.
+    Computes the accuracy of the FAN model on the validation set.
 
     :param fan: FAN model
     :param data: the dataset (instance of IPDataset)
@@ -183,40 +187,113 @@ def validate_fan(fan, data, label_generator, label_multiplier, get_labels=False)
     :param get_labels: whether to return the predicted labels
     :return: either the accuracy or tuple (accuracy, predicted labels)
     """
+    results = evaluate_fan(fan, data, label_generator, label_multiplier)
+
+    if get_labels:
+        return results['accuracy'], results['labels'].tolist()
+    else:
+        return results['accuracy']
+
+
+def validate_manipulation(tf_ops, data, label_generator, save_dir=None, epoch=0, show_ref=False, loss_type='L2', batch_size=10, nip_metrics=True, dcn_metrics=True, renderer=None):
+    """
+    Validates the whole manipulation detection workflow (NIP -> manipulations -> channel -> FAN) with a single forward
+    pass per batch. Developed images and FAN predictions are fetched together and NIP / FAN metrics are derived from
+    them - results are equivalent to 'validate_nip' and 'evaluate_fan'. DCN metrics are computed by 'validate_dcn' on
+    the RGB validation patches (the same measurement as in standalone DCN validation).
+
+    :param tf_ops: dictionary with the models (see 'training.manipulation.construct_models')
+    :param data: the dataset (instance of IPDataset)
+    :param label_generator: a lambda function which generates GT class labels given the size of the batch
+    :param save_dir: path to the directory where figures should be generated (no figures if None)
+    :param epoch: epoch counter to be appended to the output filenames
+    :param show_ref: whether to show also the reference images in the figures
+    :param loss_type: L1 or L2 (NIP loss)
+    :param batch_size: number of validation images processed in a single pass
+    :param nip_metrics: whether to compute image quality metrics for the NIP
+    :param dcn_metrics: whether to compute image quality metrics for the DCN (only if the channel uses a DCN)
+    :param renderer: background renderer for the figures (see helpers.rendering) - rendered inline if None
+    :return: dict with keys 'nip' - (ssims, psnrs, losss) or None, 'dcn' - (ssims, psnrs, losses, entropies) or None,
+             'fan' - see 'evaluate_fan'
+    """
+
+    if loss_type not in ['L1', 'L2']:
+        raise ValueError('Invalid loss! Use either L1 or L2.')
+
+    nip, fan, dcn = tf_ops['nip'], tf_ops['fan'], tf_ops['dcn']
+    dcn_metrics = dcn_metrics and isinstance(dcn, DCN)
+    n_classes = fan.n_classes
+    batch_size = int(np.minimum(batch_size, data.count_validation))
+
+    # Fetches and feeds shared by all batches
+    fetches = {'fan': fan.y_}
+    feed_dict = {}
+
+    if nip_metrics:
+        fetches['nip'] = {key: nip.evaluation[key] for key in ['y', 'psnr', 'ssim']}
+        if hasattr(nip, 'is_training'):
+            feed_dict[nip.is_training] = False
 
-    batch_size = np.minimum(10, data.count_validation)
-    n_batches = data.count_validation // batch_size
+    # Fetch the whole validation set - consecutive batches are sliced from it
+    data_x = data.next_validation_batch(0, data.count_validation)
+    data_x, data_y = data_x if isinstance(data_x, tuple) else (data_x, data_x)
+
+    counts = np.zeros((n_classes * n_classes,), dtype=np.int64)
     out_labels = []
-    accuracies = []
+    nip_out = {key: [] for key in ['y', 'psnr', 'ssim']}
 
-    for batch in range(n_batches):
+    for start in range(0, data.count_validation, batch_size):
 
-        batch_x = data.next_validation_batch(batch, batch_size)
-        if isinstance(batch_x, tuple):
-            batch_x = batch_x[0]
+        batch_x = data_x[start:start + batch_size]
+        batch_y = label_generator(len(batch_x))
 
-        if isinstance(label_generator, types.FunctionType):
-            batch_y = label_generator(len(batch_x))
+        batch_feed_dict = dict(feed_dict)
+        batch_feed_dict[nip.x] = batch_x
+        if nip_metrics and nip.y_gt is not nip.x:
+            batch_feed_dict[nip.y_gt] = data_y[start:start + batch_size]
+
+        with fan.graph.as_default():
+            outputs = fan.sess.run(fetches, feed_dict=batch_feed_dict)
+
+        predicted_labels = np.argmax(outputs['fan'], axis=1)
+
+        if len(predicted_labels) != len(batch_y):
+            raise RuntimeError('Number of labels is not equal to the number of predictions! {} vs. {}'.format(len(batch_y), len(predicted_labels)))
+
+        counts += np.bincount(n_classes * batch_y + predicted_labels, minlength=n_classes * n_classes)
+        out_labels.append(predicted_labels)
+
+        if nip_metrics:
+            for key in nip_out.keys():
+                nip_out[key].append(outputs['nip'][key])
+
+    results = {'fan': _fan_results(counts, out_labels, data.count_validation), 'nip': None, 'dcn': None}
+
+    if nip_metrics:
+        nip_out = {key: np.concatenate(values) for key, values in nip_out.items()}
+        developed_out, references = nip_out['y'], data_y
+
+        if loss_type == 'L2':
+            losss = np.mean(np.power(references - developed_out, 2.0), axis=(1, 2, 3)).tolist()
         else:
-            batch_y = label_generator[(batch * batch_size * label_multiplier):(batch + 1) * batch_size * label_multiplier]
+            losss = np.mean(np.abs(references - developed_out), axis=(1, 2, 3)).tolist()
 
-        if label_multiplier * len(batch_x) != len(batch_y):
-            raise RuntimeError('Number of labels is not equal to the number of examples! {} x {} vs. {}'.format(label_multiplier, len(batch_x), len(batch_y)))
+        results['nip'] = (nip_out['ssim'].tolist(), nip_out['psnr'].tolist(), losss)
 
-        predicted_labels = fan.process(batch_x)
+        if save_dir is not None:
+            rendering.submit(renderer, rendering.save_image_grid,
+                             filename='{}/nip_validation_{:05d}.jpg'.format(save_dir, epoch),
+                             images=rendering.to_uint8(np.concatenate((references, developed_out), axis=2) if show_ref else developed_out),
+                             titles=['{:.1f} dB / {:.2f}'.format(psnr, ssim) for psnr, ssim in zip(nip_out['psnr'], nip_out['ssim'])],
+                             n_cols=10 if not show_ref else 5, quality=90)
 
-        if get_labels:
-            out_labels += [x for x in predicted_labels]
+    if dcn_metrics:
+        results['dcn'] = validate_dcn(dcn, data, save_dir, epoch=epoch, show_ref=show_ref, batch_size=batch_size, renderer=renderer)
 
-        accuracies.append(np.mean(predicted_labels == batch_y))
+    return results
 
-    if out_labels:
-        return np.mean(accuracies), out_labels
-    else:
-        return np.mean(accuracies)
-        
 
-def visualize_manipulation_training(nip, fan, dcn, conf, epoch, save_dir=None, classes=None):
+def visualize_manipulation_training(nip, fan, dcn, conf, epoch, save_dir=None, classes=None, renderer=None):
     """
     Visualize progress of manipulation training.
 
@@ -227,43 +304,67 @@ def visualize_manipulation_training(nip, fan, dcn, conf, epoch, save_dir=None, c
     :param epoch: epoch counter to be appended to the output filename
     :param save_dir: path to the directory where figures should be generated (figure handle returned otherwise)
     :param classes: labels for the classes to be used for plotting the confusion matrix
+    :param renderer: background renderer for the figure (see helpers.rendering) - rendered inline if None
     :return: None (if output to file requested) or figure handle
     """
+    # Snapshot of the stats (the job may be serialized later, while training continues)
+    job = {
+        'nip_name': type(nip).__name__,
+        'nip_performance': copy.deepcopy(nip.performance),
+        'fan_performance': copy.deepcopy(fan.performance),
+        'dcn_performance': copy.deepcopy(dcn.performance) if isinstance(dcn, DCN) else None,
+        'conf': conf,
+        'epoch': epoch,
+        'save_dir': save_dir,
+        'classes': classes
+    }
+
+    if save_dir is None:
+        return plot_manipulation_training(**job)
+
+    rendering.submit(renderer, plot_manipulation_training, **job)
+
+
+def plot_manipulation_training(nip_name, nip_performance, fan_performance, dcn_performance, conf, epoch, save_dir=None, classes=None):
+    """
+    Plot progress of manipulation training from recorded performance stats (see 'visualize_manipulation_training').
+    """
 
     # Basic figure setup
+    n_classes = conf.shape[0]
     images_x = 3
-    images_y = 3 if isinstance(dcn, DCN) else 2
+    images_y = 3 if dcn_performance is not None else 2
     fig = plt.figure(figsize=(18, 10 / images_x * images_y))
         
     # Draw the plots
     ax = fig.add_subplot(images_y, images_x, 1)
-    ax.plot(nip.performance['loss']['training'], '.', alpha=0.25)
-    ax.plot(utils.ma_conv(nip.performance['loss']['training'], 0))
-    ax.set_ylabel('{} NIP loss'.format(type(nip).__name__))
+    ax.plot(nip_performance['loss']['training'], '.', alpha=0.25)
+    ax.plot(utils.ma_conv(nip_performance['loss']['training'], 0))
+    ax.set_ylabel('{} NIP loss'.format(nip_name))
     ax.set_title('Loss')
 
     ax = fig.add_subplot(images_y, images_x, 2)
-    ax.plot(nip.performance['psnr']['validation'], '.', alpha=0.25)
-    ax.plot(utils.ma_conv(nip.performance['psnr']['validation'], 0))
-    ax.set_ylabel('{} NIP psnr'.format(type(nip).__name__))
+    ax.plot(nip_performance['psnr']['validation'], '.', alpha=0.25)
+    ax.plot(utils.ma_conv(nip_performance['psnr']['validation'], 0))
+    ax.set_ylabel('{} NIP psnr'.format(nip_name))
     ax.set_title('PSNR')
     ax.set_ylim([30, 50])
 
     ax = fig.add_subplot(images_y, images_x, 3)
-    ax.plot(nip.performance['ssim']['validation'], '.', alpha=0.25)
-    ax.plot(utils.ma_conv(nip.performance['ssim']['validation'], 0))
-    ax.set_ylabel('{} NIP ssim'.format(type(nip).__name__))
+    ax.plot(nip_performance['ssim']['validation'], '.', alpha=0.25)
+    ax.plot(utils.ma_conv(nip_performance['ssim']['validation'], 0))
+    ax.set_ylabel('{} NIP ssim'.format(nip_name))
     ax.set_title('SSIM')
     ax.set_ylim([0.8, 1])
     
     ax = fig.add_subplot(images_y, images_x, 4)
-    ax.plot(fan.performance['loss']['training'], '.', alpha=0.25)
-    ax.plot(utils.ma_conv(fan.performance['loss']['training'], 0))
+    ax.plot(fan_performance['loss']['training'], '.', alpha=0.25)
+    ax.plot(utils.ma_conv(fan_performance['loss']['training'], 0))
     ax.set_ylabel('FAN loss')
 
     ax = fig.add_subplot(images_y, images_x, 5)
-    ax.plot(fan.performance['accuracy']['validation'], '.', alpha=0.25)
-    ax.plot(utils.ma_conv(fan.performance['accuracy']['validation'], 0))
+    ax.plot(fan_performance['accuracy']['validation'], '.', alpha=0.25)
+    ax.plot(utils.ma_conv(fan_performance['accuracy']['validation'], 0))
     ax.set_ylabel('FAN accuracy')
     ax.set_ylim([0, 1])
 
@@ -272,12 +373,12 @@ def visualize_manipulation_training(nip, fan, dcn, conf, epoch, save_dir=None, c
     ax.imshow(conf, vmin=0, vmax=1)
 
     if classes is not None:
-        ax.set_xticks(range(fan.n_classes))
+        ax.set_xticks(range(n_classes))
         ax.set_xticklabels(classes, rotation='vertical')
-        ax.set_yticks(range(fan.n_classes))
+        ax.set_yticks(range(n_classes))
         ax.set_yticklabels(classes)
 
-    for r in range(fan.n_classes):
+    for r in range(n_classes):
         ax.text(r, r, '{:.2f}'.format(conf[r, r]), horizontalalignment='center', color='b' if conf[r, r] > 0.5 else 'w')
 
     ax.set_xlabel('PREDICTED class')
@@ -287,19 +388,19 @@ def visualize_manipulation_training(nip, fan, dcn, conf, epoch, save_dir=None, c
     # If the compression model is a trainable DCN, include it's validation metrics
     if images_y == 3:
         ax = fig.add_subplot(images_y, images_x, 7)
-        ax.plot(dcn.performance['loss']['validation'], '.', alpha=0.25)
-        ax.plot(utils.ma_conv(dcn.performance['loss']['validation'], 0))
+        ax.plot(dcn_performance['loss']['validation'], '.', alpha=0.25)
+        ax.plot(utils.ma_conv(dcn_performance['loss']['validation'], 0))
         ax.set_ylabel('DCN loss')
 
         ax = fig.add_subplot(images_y, images_x, 8)
-        ax.plot(dcn.performance['ssim']['validation'], '.', alpha=0.25)
-        ax.plot(utils.ma_conv(dcn.performance['ssim']['validation'], 0))
+        ax.plot(dcn_performance['ssim']['validation'], '.', alpha=0.25)
+        ax.plot(utils.ma_conv(dcn_performance['ssim']['validation'], 0))
         ax.set_ylabel('DCN ssim')
         ax.set_ylim([0.8, 1])
 
         ax = fig.add_subplot(images_y, images_x, 9)
-        ax.plot(dcn.performance['entropy']['validation'], '.', alpha=0.25)
-        ax.plot(utils.ma_conv(dcn.performance['entropy']['validation'], 0))
+        ax.plot(dcn_performance['entropy']['validation'], '.', alpha=0.25)
+        ax.plot(utils.ma_conv(dcn_performance['entropy']['validation'], 0))
         ax.set_ylabel('DCN entropy')
 
     if save_dir is not None: